@@ -3,6 +3,7 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
 from flask_apscheduler import APScheduler
+from sqlalchemy.exc import OperationalError, ProgrammingError
 import os
 
 db = SQLAlchemy()
@@ -27,8 +28,11 @@ def create_app(config_class=Config):
     login_manager.init_app(app)
     migrate.init_app(app, db)
 
-    # Initialize APScheduler
-    if not scheduler.running:
+    # Initialize APScheduler (异步网关等辅助进程通过 SCHEDULER_ENABLED=False 关闭定时任务)
+    scheduler_enabled = app.config.get('SCHEDULER_ENABLED', True)
+    if not scheduler_enabled:
+        print("APScheduler disabled for this process.")
+    elif not scheduler.running:
         scheduler.init_app(app)
         scheduler.start()
         print("APScheduler started.")
@@ -50,8 +54,14 @@ def create_app(config_class=Config):
     # 取消注释自动创建管理员的逻辑
     with app.app_context():
         from .models.user import User # 移到 app_context内部以避免循环导入问题
-        # Temporarily comment out the user query and default admin creation during migration
-        if User.query.first() is None:
+        # 数据库结构还没升级到当前模型时 (例如正在执行 flask db upgrade) 查询会失败，跳过创建管理员
+        try:
+            has_users = User.query.first() is not None
+        except (OperationalError, ProgrammingError) as e:
+            db.session.rollback()
+            has_users = True
+            print(f"Skipping default admin check, database schema is not up to date: {e.orig}")
+        if not has_users:
             print("No users found. Creating default admin user.")
             default_admin = User(
                 username='admin',
@@ -68,9 +78,53 @@ def create_app(config_class=Config):
                 print(f"Error creating default admin user: {e}")
         # pass # Add pass if the entire block is commented out and it's the only thing in the with block
 
+    # 数据库连接占用时长统计 (/api/admin/db-pool)
+    from . import db_pool
+    db_pool.init_app(app)
+
+    # AI 服务 HTTP 连接池 (读取池大小配置，按需预热默认系统服务)
+    from . import http_pool
+    http_pool.init_app(app)
+
+    # 非流式 AI 生成结果缓存 (默认关闭)
+    from . import result_cache
+    result_cache.init_app(app)
+
+    # AIService / 提示词模板的进程内配置缓存 (跨 worker 按版本号失效)
+    from . import config_cache
+    config_cache.init_app(app)
+
+    # 服务端组装上下文用的书籍纯文本/设定缓存 (按内容版本号校验)
+    from . import book_context
+    book_context.init_app(app)
+
+    # AI 服务熔断 (连续失败后快速失败) 与后台健康探测
+    from . import circuit_breaker
+    circuit_breaker.init_app(app)
+
+    # 流式生成的断线续传与幂等键 (replay store)
+    from . import single_flight
+    single_flight.init_app(app)
+
+    # AI 调用准入控制 (并发上限与按用户组加权的公平排队)
+    from . import admission
+    admission.init_app(app)
+
+    # 本地 token 估算 (dry-run 预览、点数预检查、缺少 usage 时的兜底计费)
+    from . import token_estimator
+    token_estimator.init_app(app)
+
+    # 计费与调用日志的后台批量写入 (并重放上次崩溃遗留的计费事件)
+    from . import billing
+    billing.init_app(app)
+
+    # 后台生成作业的 worker 线程池 (POST /api/generations)
+    from . import generation_jobs
+    generation_jobs.init_app(app)
+
     # Register scheduled tasks after app is fully initialized and blueprints are registered
     # to ensure tasks have access to app context and configurations.
-    if app.config.get('SCHEDULER_API_ENABLED', False) or not app.testing: # Check if API is enabled or not in testing
+    if scheduler_enabled and (app.config.get('SCHEDULER_API_ENABLED', False) or not app.testing): # Check if API is enabled or not in testing
         from . import tasks
         if not scheduler.get_job('distribute_points_job'):
              # Pass the app instance to the function that registers tasks if needed for context
@@ -0,0 +1,323 @@
+"""
+AI 调用的准入控制与按用户公平排队。
+
+原来对上游调用没有任何并发限制：一个用户可以同时打开很多个流把别人饿死，
+服务商的限流也会波及整个站点。生成路由在调用 call_ai_service 之前先向这里申请
+一个名额:
+
+- 每个 AI 服务 (服务池按池整体计算) 最多同时 AI_SERVICE_MAX_CONCURRENCY 个上游调用
+- 每个用户最多同时 AI_USER_MAX_CONCURRENCY 个上游调用
+- 一个请求同时发起多个上游调用 (多候选生成) 时按调用数申请名额 (slots)，全部结束后一起释放；
+  超过用户上限或服务上限的请求直接拒绝
+- 名额不够时按加权公平排队 (WFQ)：每个请求的虚拟完成时间为
+  max(服务虚拟时间, 该用户上一个请求的虚拟完成时间) + 1 / 权重，
+  名额空出来时放行虚拟完成时间最小的请求。权重由用户所在的 Group 决定
+  (AI_ADMISSION_GROUP_WEIGHTS，例如 "VIP=4,付费用户=2")，付费组排得更靠前
+- 队列过长或等待超过 AI_ADMISSION_MAX_WAIT 秒 (默认 2 秒：排队期间同步路由占着一个
+  Web worker) 时抛出 AdmissionRejected，路由返回 429 并附上排队位置和预计等待时间，
+  而不是让请求一直挂到超时
+- 后台生成作业 (app/generation_jobs.py) 不排队，认领时用 try_acquire() 申请，没有名额就
+  留在队列里下次再认领；异步网关 (app/async_gateway.py) 在网关进程中同样调用 acquire()
+
+计数保存在进程内，每个 worker 各自限制。
+"""
+import math
+import threading
+import time
+
+DEFAULT_HOLD_SECONDS = 20.0  # 还没有样本时假设的单次调用耗时
+HOLD_EWMA_ALPHA = 0.2
+
+
+def parse_group_weights(value):
+    """把 "VIP=4,付费用户=2" 解析成 {'VIP': 4.0, '付费用户': 2.0}，忽略格式错误的项。"""
+    weights = {}
+    for item in (value or '').split(','):
+        name, sep, weight = item.partition('=')
+        if not sep or not name.strip():
+            continue
+        try:
+            weights[name.strip()] = max(float(weight), 0.1)
+        except ValueError:
+            print(f"[Admission] Ignoring invalid group weight: {item!r}")
+    return weights
+
+
+class AdmissionRejected(Exception):
+    """队列已满或等待超时。"""
+    code = 'AI_QUEUE_FULL'
+
+    def __init__(self, message, queue_position, estimated_wait, code=None):
+        super().__init__(message)
+        self.queue_position = queue_position
+        self.estimated_wait = estimated_wait
+        if code:
+            self.code = code
+
+    def to_dict(self):
+        return {
+            'error': str(self),
+            'code': self.code,
+            'queue_position': self.queue_position,
+            'estimated_wait_seconds': self.estimated_wait,
+        }
+
+
+class AdmissionTicket:
+    """已放行的上游调用名额 (slots 个并发调用)；release() 可以重复调用。"""
+
+    def __init__(self, controller, service_key, user_id, waited, slots=1):
+        self._controller = controller
+        self.service_key = service_key
+        self.user_id = user_id
+        self.waited = waited
+        self.slots = slots
+        self.granted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        self._controller._release(self)
+
+
+class _Waiter:
+    def __init__(self, user_id, tag, seq, capacity, slots=1):
+        self.user_id = user_id
+        self.tag = tag
+        self.seq = seq  # 虚拟完成时间相同时先到先得
+        self.capacity = capacity
+        self.slots = slots
+        self.granted = False
+
+
+class _ServiceState:
+    def __init__(self):
+        self.running = 0
+        self.capacity = 1
+        self.waiters = []
+        self.vtime = 0.0
+        self.last_tags = {}  # user_id -> 该用户最近一个请求的虚拟完成时间
+        self.hold_ewma = None
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+
+class AdmissionController:
+
+    def __init__(self, service_limit=8, user_limit=2, max_wait=2.0, max_queue=200):
+        self.service_limit = service_limit
+        self.user_limit = user_limit
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._services = {}
+        self._user_running = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def configure(self, service_limit, user_limit, max_wait, max_queue):
+        with self._cond:
+            self.service_limit = service_limit
+            self.user_limit = user_limit
+            self.max_wait = max_wait
+            self.max_queue = max_queue
+            self._cond.notify_all()
+
+    def acquire(self, service_key, user_id, weight=1.0, members=1, timeout=None, slots=1):
+        """
+        申请上游调用名额，必要时排队等待。
+
+        Args:
+            service_key: 服务 (或服务池) 的标识，见 service_slot().
+            user_id: 发起请求的用户.
+            weight: 用户权重 (见 user_weight())，越大排得越靠前.
+            members: 服务池成员数，服务的并发上限为 service_limit * members.
+            timeout: 最长等待秒数，默认 max_wait.
+            slots: 本次请求同时发起的上游调用数 (多候选生成时为候选数).
+
+        Returns:
+            AdmissionTicket，全部调用结束后必须 release().
+
+        Raises:
+            AdmissionRejected: 队列已满、等待超时，或 slots 超过用户/服务的并发上限.
+        """
+        timeout = self.max_wait if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        started = time.monotonic()
+        slots = max(int(slots), 1)
+        with self._cond:
+            state = self._services.get(service_key)
+            if state is None:
+                state = self._services[service_key] = _ServiceState()
+            capacity = max(self.service_limit * max(members, 1), 1)
+            state.capacity = capacity
+            limit = min(self.user_limit, capacity)
+            if slots > limit:
+                # 永远不可能放行，排队只会白白占着 worker 等到超时
+                state.rejected += 1
+                raise AdmissionRejected(
+                    f'一次最多同时发起 {limit} 个 AI 调用，本次请求需要 {slots} 个，请减少候选数。',
+                    0, 0, code='AI_TOO_MANY_CALLS')
+            if len(state.waiters) >= self.max_queue:
+                state.rejected += 1
+                position = len(state.waiters) + 1
+                raise AdmissionRejected(
+                    f'AI 服务繁忙，排队人数已满 (前方 {len(state.waiters)} 个请求)，请稍后再试。',
+                    position, self._estimate_wait(state, position))
+
+            tag = max(state.vtime, state.last_tags.get(user_id, 0.0)) + slots / max(weight, 0.1)
+            state.last_tags[user_id] = tag
+            self._seq += 1
+            waiter = _Waiter(user_id, tag, self._seq, capacity, slots)
+            state.waiters.append(waiter)
+            self._grant_locked(state)
+            if not waiter.granted:
+                state.queued += 1
+                print(f"[Admission] User {user_id}: Queued for AI service {service_key} "
+                      f"(position {self._position(state, waiter)}, running {state.running}/{capacity}).")
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    position = self._position(state, waiter)
+                    state.waiters.remove(waiter)
+                    state.rejected += 1
+                    estimated = self._estimate_wait(state, position)
+                    # 当前请求退出后，排在后面的请求可能可以放行了 (例如被用户上限卡住的情况)
+                    self._grant_all_locked()
+                    raise AdmissionRejected(
+                        f'AI 服务繁忙，您前面还有 {position - 1} 个请求，预计还需等待约 {estimated} 秒，请稍后重试。',
+                        position, estimated)
+                self._cond.wait(remaining)
+            state.admitted += 1
+            return AdmissionTicket(self, service_key, user_id, round(time.monotonic() - started, 3), slots)
+
+    def try_acquire(self, service_key, user_id, weight=1.0, members=1, slots=1):
+        """
+        不排队地申请名额：服务和用户都有空余、且没有请求在排队时返回 AdmissionTicket，否则返回 None。
+
+        供能够稍后重试的调用方 (后台生成作业) 使用，不会插到排队中的请求前面；没拿到名额时
+        不推进该用户的虚拟完成时间。
+        """
+        slots = max(int(slots), 1)
+        with self._cond:
+            state = self._services.get(service_key)
+            if state is None:
+                state = self._services[service_key] = _ServiceState()
+            state.capacity = max(self.service_limit * max(members, 1), 1)
+            if state.waiters or state.running + slots > state.capacity or not self._user_has_room(user_id, slots):
+                return None
+            tag = max(state.vtime, state.last_tags.get(user_id, 0.0)) + slots / max(weight, 0.1)
+            state.last_tags[user_id] = tag
+            state.vtime = max(state.vtime, tag)
+            state.running += slots
+            self._user_running[user_id] = self._user_running.get(user_id, 0) + slots
+            state.admitted += 1
+            return AdmissionTicket(self, service_key, user_id, 0, slots)
+
+    def _user_has_room(self, user_id, slots=1):
+        return self._user_running.get(user_id, 0) + slots <= self.user_limit
+
+    def _grant_locked(self, state):
+        granted = False
+        while state.waiters:
+            candidates = [w for w in state.waiters if self._user_has_room(w.user_id, w.slots)]
+            if not candidates:
+                break
+            waiter = min(candidates, key=lambda w: (w.tag, w.seq))
+            if state.running + waiter.slots > state.capacity:
+                # 不让后面的小请求插队，否则需要多个名额的请求可能一直等不到
+                break
+            state.waiters.remove(waiter)
+            state.vtime = max(state.vtime, waiter.tag)
+            state.running += waiter.slots
+            self._user_running[waiter.user_id] = self._user_running.get(waiter.user_id, 0) + waiter.slots
+            waiter.granted = True
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _grant_all_locked(self):
+        for state in self._services.values():
+            if state.waiters:
+                self._grant_locked(state)
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            state = self._services[ticket.service_key]
+            state.running -= ticket.slots
+            if len(state.last_tags) > 1000:
+                # 虚拟完成时间不超过服务虚拟时间的记录不再影响排队顺序
+                state.last_tags = {uid: tag for uid, tag in state.last_tags.items() if tag > state.vtime}
+            held = time.monotonic() - ticket.granted_at
+            state.hold_ewma = held if state.hold_ewma is None else \
+                state.hold_ewma + HOLD_EWMA_ALPHA * (held - state.hold_ewma)
+            remaining = self._user_running.get(ticket.user_id, ticket.slots) - ticket.slots
+            if remaining > 0:
+                self._user_running[ticket.user_id] = remaining
+            else:
+                self._user_running.pop(ticket.user_id, None)
+            # 用户名额可能跨服务共享，所有有排队的服务都重新检查一遍
+            self._grant_all_locked()
+
+    @staticmethod
+    def _position(state, waiter):
+        """1 表示下一个就轮到。"""
+        return sum(1 for w in state.waiters if (w.tag, w.seq) < (waiter.tag, waiter.seq)) + 1
+
+    @staticmethod
+    def _estimate_wait(state, position):
+        hold = state.hold_ewma if state.hold_ewma is not None else DEFAULT_HOLD_SECONDS
+        return int(math.ceil(math.ceil(position / max(state.capacity, 1)) * hold))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'service_limit': self.service_limit,
+                'user_limit': self.user_limit,
+                'max_wait': self.max_wait,
+                'max_queue': self.max_queue,
+                'users_running': len(self._user_running),
+                'services': {
+                    str(key): {
+                        'running': state.running,
+                        'capacity': state.capacity,
+                        'waiting': len(state.waiters),
+                        'hold_ewma_seconds': round(state.hold_ewma, 3) if state.hold_ewma is not None else None,
+                        'admitted': state.admitted,
+                        'queued': state.queued,
+                        'rejected': state.rejected,
+                    } for key, state in self._services.items()
+                },
+            }
+
+
+# 生成请求共用的准入控制器，参数由 init_app 根据配置设置
+ai_admission = AdmissionController()
+_group_weights = {}
+
+
+def service_slot(ai_config, members=1):
+    """服务池按池整体限流，其余服务按 ID 限流。返回 (service_key, members)。"""
+    if ai_config.is_system_service and ai_config.pool_name:
+        return f'pool:{ai_config.pool_name}', members
+    return ai_config.id, 1
+
+
+def user_weight(user):
+    """用户所在各 Group 中最高的权重，没有配置时为 1。"""
+    if not _group_weights:
+        return 1.0
+    return max([_group_weights.get(group.name, 1.0) for group in user.groups] or [1.0])
+
+
+def init_app(app):
+    global _group_weights
+    _group_weights = parse_group_weights(app.config.get('AI_ADMISSION_GROUP_WEIGHTS', ''))
+    ai_admission.configure(
+        service_limit=app.config.get('AI_SERVICE_MAX_CONCURRENCY', 8),
+        user_limit=app.config.get('AI_USER_MAX_CONCURRENCY', 2),
+        max_wait=app.config.get('AI_ADMISSION_MAX_WAIT', 2),
+        max_queue=app.config.get('AI_ADMISSION_MAX_QUEUE', 200),
+    )
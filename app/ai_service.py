@@ -4,7 +4,12 @@ from app import db
 from app.models.ai_service import AIService
 import requests
 from flask import jsonify
-import json
+from .http_pool import get_session
+from .stream_parsers import get_stream_adapter
+from .result_cache import get_result_cache, make_cache_key
+from .service_router import is_retryable_status
+from .token_estimator import estimate_usage
+from .config_cache import get_service, bump_config_version
 
 print("--- LOADING app/ai_service.py (Top Level) ---") # <-- 添加顶级打印
 
@@ -30,10 +35,14 @@ def manage():
         api_key = request.form.get('api_key') # Handle sensitive data carefully!
         base_url = request.form.get('base_url')
         model_name = request.form.get('model_name')
+        context_token_budget = request.form.get('context_token_budget', '').strip()
         
         if not name or not service_type: # Basic validation
              flash('名称和服务类型是必填项')
              return redirect(url_for('ai_service.manage'))
+        if context_token_budget and not context_token_budget.lstrip('-').isdigit():
+             flash('上下文 token 预算必须是整数')
+             return redirect(url_for('ai_service.manage'))
 
         new_config = AIService(
             name=name,
@@ -41,10 +50,12 @@ def manage():
             api_key=api_key, # Again, handle with care
             base_url=base_url,
             model_name=model_name,
+            context_token_budget=int(context_token_budget) if context_token_budget else None,
             is_system_service=False, # User adding their own service
             owner_id=current_user.id
         )
         db.session.add(new_config)
+        bump_config_version()
         db.session.commit()
         flash('自定义AI服务配置已添加')
         return redirect(url_for('ai_service.manage'))
@@ -65,6 +76,7 @@ def delete(config_id):
     # Allow deletion only if user owns it AND it's not a system service
     if config and config.owner_id == current_user.id and not config.is_system_service:
         db.session.delete(config)
+        bump_config_version()
         db.session.commit()
         flash('配置已删除')
     # TODO: Add admin deletion logic later if needed
@@ -76,11 +88,55 @@ def delete(config_id):
         flash('无权限或配置不存在')
     return redirect(url_for('ai_service.manage')) 
 
-def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool = False, 
+OPENAI_COMPATIBLE_TYPES = ['openai', 'deepseek', 'custom_openai_compatible', 'groq', 'ollama']
+
+def build_chat_request(service_type, base_url, model_name, prompt, enable_streaming, messages=None, max_tokens=None):
+    """
+    构造聊天补全请求的 (api_endpoint, payload)。
+    同步的 call_ai_service 与异步网关 (app/async_gateway.py) 共用。
+    传入 messages (前缀稳定模式的 system + user 消息) 时直接使用，否则把 prompt 作为单条 user 消息。
+    传入 max_tokens 时限制输出长度 (Ollama 原生接口为 options.num_predict，见 app/length_control.py)。
+    不支持的服务类型返回 (None, None)。
+    """
+    if service_type not in OPENAI_COMPATIBLE_TYPES:
+        return None, None
+
+    payload = {
+        "model": model_name,
+        "messages": messages or [{"role": "user", "content": prompt}],
+    }
+    if enable_streaming:
+        payload["stream"] = True
+        # For OpenAI compatible services, request usage statistics in the stream
+        if service_type != 'ollama':
+            payload["stream_options"] = {"include_usage": True}
+
+    processed_base_url = base_url.rstrip('/')
+    api_path = "/v1/chat/completions"
+    if service_type == 'ollama':
+         if '/v1' not in processed_base_url: api_path = "/api/chat"
+         else: api_path = "/chat/completions"
+    if max_tokens:
+        if api_path == "/api/chat":
+            payload["options"] = {"num_predict": max_tokens}
+        else:
+            payload["max_tokens"] = max_tokens
+    return f"{processed_base_url}{api_path}", payload
+
+def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool = False,
                     # Add optional pre-fetched config details for streaming:
                     config_details: dict = None,
                     # Add optional dictionary to store token info
-                    token_info: dict = None): 
+                    token_info: dict = None,
+                    # 非流式调用是否使用结果缓存 (需启用 AI_RESULT_CACHE_ENABLED)
+                    use_cache: bool = True,
+                    # 前缀稳定模式下的消息列表 (此时 prompt 为拼接后的文本，仅用于日志/估算/缓存键)
+                    messages: list = None,
+                    # 流式调用收到上游响应后回调，调用方可借此在客户端断开时中止上游
+                    on_response=None,
+                    # 输出长度上限与流式长度调节器 (见 app/length_control.py)
+                    max_tokens: int = None,
+                    length_governor=None): 
     print("--- INSIDE NEW call_ai_service FUNCTION (with token_info) --- ") 
     """
     Calls the specified AI service configuration with the given prompt.
@@ -95,14 +151,23 @@ def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool =
                         Required if enable_streaming is True.
         token_info: If streaming, an optional dictionary that will be updated 
                     with {'total': total_tokens_consumed}.
+        use_cache: If not streaming, look up / store the result in the exact-match
+                   result cache (app/result_cache.py). Pass False to bypass it.
+        messages: Optional pre-built chat messages (prefix-stable template mode).
+                  When given they are sent instead of a single user message.
+        on_response: If streaming, called with the upstream requests.Response as soon
+                     as it is available (e.g. to abort it via http_pool.abort_response).
+                     If the stream ends early, token_info gets the partial (estimated)
+                     usage with 'completed': False.
+        max_tokens: Optional output token ceiling sent to the provider.
+        length_governor: If streaming, an optional LengthGovernor. Once it stops, the
+                         upstream connection is closed and token_info gets the usage of
+                         what was produced with 'completed': True, 'truncated': True.
 
     Returns/Yields:
         If streaming enabled: Generator yielding text chunks.
         If streaming disabled: Dictionary with response or error.
     """
-    # Needs access to the AIService model definition
-    from .models.ai_service import AIService
-
     service_config = None
     api_key = None
     base_url = None
@@ -135,7 +200,7 @@ def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool =
         if config_id is None:
              return {"error": "config_id is required when enable_streaming is False"}
              
-        service_config = AIService.query.get(config_id)
+        service_config = get_service(config_id)
         if not service_config:
             return {"error": "AI 服务配置未找到"}
         config_name_for_error = f"'{service_config.name}' (ID: {config_id})" # Use actual name
@@ -164,42 +229,32 @@ def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool =
         # Only warn if not streaming and it's a user service
         print(f"警告：用户服务 {config_name_for_error} 缺少 API Key")
 
-    payload = {}
-    api_endpoint = None
-    stream_param = {"stream": True} if enable_streaming else {} 
-
     try:
-        # --- Payload and Endpoint Construction (Remains largely the same) --- 
-        if service_type in ['openai', 'deepseek', 'custom_openai_compatible', 'groq', 'ollama']:
-            payload = {
-                "model": model_name,
-                "messages": [{"role": "user", "content": prompt}],
-                **stream_param 
-            }
-            # For OpenAI compatible services, request usage statistics in the stream
-            if enable_streaming and service_type in ['openai', 'deepseek', 'custom_openai_compatible', 'groq']:
-                payload["stream_options"] = {"include_usage": True}
-                print(f"[Stream Debug] Added stream_options for {service_type}")
-
-            processed_base_url = base_url.rstrip('/')
-            api_path = "/v1/chat/completions"
-            if service_type == 'ollama':
-                 if '/v1' not in processed_base_url: api_path = "/api/chat"
-                 else: api_path = "/chat/completions"
-            api_endpoint = f"{processed_base_url}{api_path}"
-        else:
+        # --- Payload and Endpoint Construction --- 
+        api_endpoint, payload = build_chat_request(service_type, base_url, model_name, prompt, enable_streaming, messages,
+                                                   max_tokens)
+        if api_endpoint is None:
             error_msg = f"不支持的服务类型: {service_type}"
             if enable_streaming: raise TypeError(error_msg)
             return {"error": error_msg}
 
-        if not api_endpoint:
-            error_msg = "未能为支持的服务类型确定 API 端点"
-            if enable_streaming: raise ValueError(error_msg)
-            return {"error": error_msg}
+        # --- 非流式结果缓存 (精确匹配) ---
+        result_cache = get_result_cache() if not enable_streaming and use_cache else None
+        cache_key = None
+        if result_cache is not None:
+            cache_params = {k: v for k, v in payload.items() if k != 'messages'}
+            if messages:
+                cache_params['prefix_stable'] = True
+            cache_key = make_cache_key(config_id, model_name, prompt, cache_params)
+            cached_content = result_cache.get(cache_key)
+            if cached_content is not None:
+                print(f"AI 结果缓存命中: ({config_name_for_error}), key={cache_key[:12]}")
+                return {"success": True, "content": cached_content, "cached": True}
 
         # --- Request Sending (Remains the same) --- 
         print(f"调用 AI 服务: ({config_name_for_error}), Type='{service_type}', Endpoint='{api_endpoint}', Model='{model_name}', Streaming={enable_streaming}")
-        response = requests.post(
+        # 使用按 base_url 复用的长连接 Session，避免每次生成都重新握手
+        response = get_session(base_url).post(
              api_endpoint, 
              headers=headers, 
              json=payload, 
@@ -207,6 +262,8 @@ def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool =
              stream=enable_streaming 
         )
         response.raise_for_status() 
+        if enable_streaming and on_response is not None:
+            on_response(response)
 
         # 6. 处理响应 (区分流式和非流式)
         if enable_streaming:
@@ -221,79 +278,84 @@ def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool =
                 
                 print(f"AI 服务 ({config_name_for_error}) 开始流式传输响应...")
                 chunk_counter = 0 
-                try:
-                    for line in response.iter_lines():
-                        if line:
-                            decoded_line = line.decode('utf-8')
-                            # print(f"[Stream Debug] Received line: {decoded_line}") # Can be very verbose
-                            if decoded_line.startswith('data: '):
-                                json_str = decoded_line[len('data: '):]
-                                if json_str.strip() == '[DONE]':
-                                    print(f"[Stream Debug] Received [DONE] marker for {config_name_for_error}.")
-                                    break
-                                try:
-                                    chunk_data = json.loads(json_str)
-                                    # print(f"[Stream Debug] Parsed JSON chunk: {chunk_data}")
+                # 按服务商选择增量解析器 (SSE / Ollama 原生 NDJSON)，直接在字节上分帧
+                adapter = get_stream_adapter(service_type, api_endpoint)
+                produced_chunks = []
+                completed = False
 
-                                    # Check for usage information (OpenAI compatible with stream_options)
-                                    if "usage" in chunk_data and isinstance(chunk_data["usage"], dict):
-                                        usage = chunk_data["usage"]
-                                        # Update local counters from usage chunk
-                                        _local_prompt_tokens = usage.get("prompt_tokens", _local_prompt_tokens)
-                                        _local_completion_tokens = usage.get("completion_tokens", _local_completion_tokens)
-                                        _local_total_tokens = usage.get("total_tokens", 
-                                            _local_prompt_tokens + _local_completion_tokens)
-                                        print(f"[Stream Debug] Usage found in chunk for {config_name_for_error}: Prompt={_local_prompt_tokens}, Completion={_local_completion_tokens}, Total={_local_total_tokens}")
-                                    
-                                    # Extract content
-                                    if service_type in ['openai', 'deepseek', 'custom_openai_compatible', 'groq', 'ollama']:
-                                        if chunk_data.get("choices") and len(chunk_data["choices"]) > 0:
-                                            delta = chunk_data["choices"][0].get("delta")
-                                            if delta and "content" in delta:
-                                                content_chunk = delta["content"]
-                                                if content_chunk:
-                                                    # print(f"[Stream Debug] Yielding chunk #{chunk_counter}: {content_chunk[:50]}...")
-                                                    yield content_chunk
-                                                    chunk_counter += 1
-                                        elif chunk_data.get('done', False) and service_type == 'ollama':
-                                            # For Ollama, 'done' message often contains final token counts
-                                            # Update local counters from Ollama's done message
-                                            _local_prompt_tokens = chunk_data.get('prompt_eval_count', _local_prompt_tokens)
-                                            _local_completion_tokens = chunk_data.get('eval_count', _local_completion_tokens)
-                                            _local_total_tokens = _local_prompt_tokens + _local_completion_tokens
-                                            print(f"[Stream Debug] Ollama stream finished (done=True) for {config_name_for_error}. Tokens: P={_local_prompt_tokens}, C={_local_completion_tokens}, Total={_local_total_tokens}")
-                                            break # Stop iteration on Ollama's done message
-                                        # else:
-                                            # print(f"[Stream Debug] Unknown chunk structure (not choices/delta): {chunk_data}")
-                                    # else:
-                                        # print(f"[Stream Debug] Service type '{service_type}' stream parsing not implemented for content.")
-                                except json.JSONDecodeError:
-                                    print(f"[Stream Debug] JSONDecodeError for line: {json_str} in {config_name_for_error}")
+                def governed(chunks):
+                    return chunks if length_governor is None else length_governor.govern(chunks)
+
+                def truncated():
+                    return length_governor is not None and length_governor.stopped
+                try:
+                    for data in response.iter_content(chunk_size=None):
+                        for content_chunk in governed(adapter.feed(data)):
+                            produced_chunks.append(content_chunk)
+                            yield content_chunk
+                            chunk_counter += 1
+                        if truncated():
+                            # 超出目标长度并到了句子边界：不再读取，finally 中关闭连接，剩余部分不生成也不计费
+                            print(f"AI 服务 ({config_name_for_error}) 输出达到长度上限 ({length_governor.chars} 字)，提前结束。")
+                            break
+                    if not truncated():
+                        for content_chunk in governed(adapter.close()):
+                            produced_chunks.append(content_chunk)
+                            yield content_chunk
+                            chunk_counter += 1
+                    # 结束帧 ([DONE] / Ollama done) 后不提前 break：读到流末尾，连接才能归还连接池复用
+                    usage = adapter.usage
+                    usage_estimated = False
+                    if (not usage['total'] or truncated()) and produced_chunks:
+                        # 服务商没有返回 usage (或被截止，还没收到 usage)：用本地估算兜底，避免生成了内容却完全不计费
+                        usage = estimate_usage(prompt, ''.join(produced_chunks))
+                        usage_estimated = True
+                        if not truncated():
+                            print(f"[Stream Warning] AI 服务 ({config_name_for_error}) 未返回 usage，使用本地估算: {usage}")
+                    _local_prompt_tokens = usage['prompt']
+                    _local_completion_tokens = usage['completion']
+                    _local_total_tokens = usage['total']
                     # --- After the loop, update the passed token_info dictionary --- 
                     if token_info is not None:
                         token_info['total'] = _local_total_tokens
-                        # Optionally add prompt/completion tokens too if needed later
-                        # token_info['prompt'] = _local_prompt_tokens
-                        # token_info['completion'] = _local_completion_tokens
+                        token_info['estimated'] = usage_estimated
+                        token_info['prompt'] = _local_prompt_tokens
+                        token_info['completion'] = _local_completion_tokens
+                        token_info['cached'] = usage.get('cached', 0)
+                        token_info['completed'] = True
+                        token_info['truncated'] = truncated()
                         print(f"[Stream Info] Updated token_info dict: {token_info}")
                     else:
                         print(f"[Stream Warning] token_info dictionary was not provided.")
+                    completed = True
 
                     print(f"AI 服务 ({config_name_for_error}) 流处理完成. Yielded {chunk_counter} content chunks. Final recorded tokens: Total={_local_total_tokens}")
                 except Exception as e:
                     print(f"!!! Error during response iteration for AI service {config_name_for_error}: {e}")
                     # Optionally re-raise or yield an error marker
+                finally:
+                    # 释放连接 (已读完的连接回到连接池，未读完的被关闭)
+                    response.close()
+                    if not completed and token_info is not None and produced_chunks:
+                        # 流被中止 (客户端断开 / 上游出错)：中途一般还没有 usage，按已输出的内容估算
+                        partial = adapter.usage if adapter.usage['total'] else estimate_usage(prompt, ''.join(produced_chunks))
+                        token_info.update(total=partial['total'], prompt=partial['prompt'],
+                                          completion=partial['completion'], cached=partial.get('cached', 0),
+                                          estimated=partial is not adapter.usage, completed=False)
+                        print(f"[Stream Info] Stream from AI service ({config_name_for_error}) ended early, partial usage: {token_info}")
             
             return _stream_generator_with_tokens() # Return the generator instance
         else:
             # --- 非流式响应处理 --- 
             response_data = response.json()
-            if service_type in ['openai', 'deepseek', 'custom_openai_compatible', 'groq', 'ollama']:
+            if service_type in OPENAI_COMPATIBLE_TYPES:
                  if "choices" in response_data and len(response_data["choices"]) > 0:
                      first_choice = response_data["choices"][0]
                      if "message" in first_choice and "content" in first_choice["message"]:
                           ai_content = first_choice["message"]["content"]
                           print(f"AI 响应成功接收: {ai_content[:100]}...")
+                          if result_cache is not None and ai_content:
+                              result_cache.set(cache_key, ai_content)
                           return {"success": True, "content": ai_content}
                  print(f"AI 服务 {service_type} ({config_name_for_error}) 返回了意外的响应结构: {response_data}")
                  error_message = "AI 响应格式不符合预期"
@@ -307,7 +369,7 @@ def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool =
          error_msg = f"调用 AI 服务 {config_name_for_error} 超时 (180秒)"
          print(error_msg)
          if enable_streaming: raise TimeoutError(error_msg) from e
-         return {"error": error_msg}
+         return {"error": error_msg, "retryable": True}
     except requests.exceptions.RequestException as e:
         # ... (RequestException handling remains the same) ...
         error_detail = str(e)
@@ -327,7 +389,9 @@ def call_ai_service(prompt: str, config_id: int = None, enable_streaming: bool =
         user_facing_error = f"调用 AI 服务时出错: {error_detail}"
         if "API key" in error_detail: user_facing_error = "AI 服务认证失败或配置错误"
         if enable_streaming: raise ConnectionError(user_facing_error) from e 
-        return {"error": user_facing_error}
+        # 连接错误、429 和 5xx 可以换服务池中的其他成员重试 (见 app/service_router.py)
+        retryable = e.response is None or is_retryable_status(e.response.status_code)
+        return {"error": user_facing_error, "retryable": retryable}
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
@@ -1,20 +1,43 @@
-from flask import Blueprint, jsonify, request, Response, current_app
+from flask import Blueprint, jsonify, request, Response, current_app, copy_current_request_context
 from flask_login import login_required, current_user # 导入 login_required 和 current_user
 # 确保从 .models 包导入，依赖 __init__.py
-from .models import FileSystemItem, User, Group, PromptTemplate, AIService, ApiCallLog # 导入 ApiCallLog
+from .models import FileSystemItem, User, Group, PromptTemplate, AIService, ApiCallLog, GenerationJob # 导入 ApiCallLog
 from . import db # db 通常从 app 包导入
 from sqlalchemy import func
 from sqlalchemy.orm import joinedload
-from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
 from .ai_service import call_ai_service
-from .utils import process_prompt_template # 导入处理函数
+from .utils import process_prompt_template, collect_placeholder_values, build_prefix_stable_messages, flatten_messages # 导入处理函数
+from .billing import bill_stream_usage, billing_stats, TOKENS_PER_POINT
+from .token_estimator import estimate_tokens
+from .context_packer import pack_context, resolve_budget
+from .async_gateway import issue_stream_ticket
+from .result_cache import get_result_cache
+from .single_flight import generation_flights, make_flight_key
+from .service_router import pool_candidates, pool_members, record_success, record_failure, is_retryable_error, timed_stream, get_member_stats
+from .circuit_breaker import CircuitOpenError, get_health, summarize as circuit_summary
+from .config_cache import (get_service, get_default_service, get_template, get_system_services, get_user_services,
+                           bump_config_version, get_config_cache)
+from .admission import ai_admission, AdmissionRejected, service_slot, user_weight
+from .stream_flush import ChunkCoalescer, flush_policy
+from .sse import SSE_MIMETYPE, wants_sse, resume_offset, sse_events
+from .http_pool import abort_response
+from .db_pool import pool_status, release_session
+from .generation_jobs import cancel_job, get_runner, notify_workers, tail_job_result
+from .length_control import LengthGovernor, max_tokens_for, requested_length
+from .book_context import BookContextError, expand_input_data, get_book_context_cache
+from .candidates import parse_candidate_count, merge_candidate_streams, NDJSON_MIMETYPE
+from .points_ledger import (get_balance, get_balance_after, get_available_balance, grant_points, reservation_points, reserve_points,
+                            release_reservation, InsufficientPoints)
+from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
 import os # For file path operations
 import json # For JSON handling
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
-TOKENS_PER_POINT = 100
-
 # --- 获取项目列表 ---
 @api_bp.route('/items', methods=['GET'])
 @login_required
@@ -267,6 +290,7 @@ def get_content(item_id):
             }
         return jsonify({
             'content': item.content or '', 
+            'version': item.content_version,
             'associatedSetting': associated_setting_info
         })
     elif item.item_type == 'setting':
@@ -292,6 +316,7 @@ def get_content(item_id):
             'name': item.name, 
             'type': item.item_type, 
             'settings': item.settings_data or [],
+            'version': item.content_version,
             'associatedBookInfo': associated_book_info # 新增字段，用于前端判断
         })
     else:
@@ -322,8 +347,10 @@ def update_content(item_id):
     else:
          return jsonify({'error': 'Cannot update content for this item type'}), 400
 
+    # 版本号加一，生成时服务端据此判断编辑器内容是否已保存 (见 app/book_context.py)
+    item.content_version = FileSystemItem.content_version + 1
     db.session.commit()
-    return jsonify({'message': f'Content for item {item_id} updated'}), 200
+    return jsonify({'message': f'Content for item {item_id} updated', 'version': item.content_version}), 200
 
 # --- （可选）更新文件夹折叠状态 ---
 @api_bp.route('/items/<int:item_id>/toggle', methods=['PUT'])
@@ -400,12 +427,12 @@ def grant_points_to_user(user_id):
         return jsonify({'error': 'User not found'}), 404
 
     try:
-        user_to_update.points = (user_to_update.points or 0) + points_to_add
+        grant_points(user_to_update.id, points_to_add, 'grant', reference=f'admin:{current_user.id}')
         db.session.commit()
         return jsonify({
             'success': True, 
             'message': f'Successfully granted {points_to_add} points to {user_to_update.username}',
-            'new_balance': user_to_update.points
+            'new_balance': get_balance(user_to_update.id)
         }), 200
     except Exception as e:
         db.session.rollback()
@@ -597,9 +624,11 @@ def create_prompt_template():
         name=name,
         template_string=data['template_string'],
         is_default=bool(is_default),
+        prefix_stable=bool(data.get('prefix_stable', False)),
         user_id=owner_id # 设置所有者 ID
     )
     db.session.add(new_template)
+    bump_config_version()  # 模板/服务变更使各 worker 的配置缓存失效 (见 app/config_cache.py)
     db.session.commit()
     return jsonify(new_template.to_dict()), 201
 
@@ -680,11 +709,15 @@ def update_prompt_template(template_id):
     if 'template_string' in data:
         template.template_string = data['template_string']
 
+    if 'prefix_stable' in data:
+        template.prefix_stable = bool(data['prefix_stable'])
+
     # 只有管理员能修改系统模板的 is_default 状态
     if 'is_default' in data and current_user.is_admin and template.user_id is None:
          template.is_default = bool(data['is_default'])
 
     template.updated_at = datetime.utcnow()
+    bump_config_version()
     db.session.commit()
     return jsonify(template.to_dict())
 
@@ -706,6 +739,7 @@ def delete_prompt_template(template_id):
         return jsonify({'error': '无权删除此模板'}), 403
 
     db.session.delete(template)
+    bump_config_version()
     db.session.commit()
     return '', 204
 
@@ -727,6 +761,328 @@ def admin_get_user_prompt_templates():
     return jsonify([t.to_dict() for t in user_templates])
 
 # --- 使用模板生成提示词 API ---
+# --- 确定本次生成使用的 AI 服务 (生成与 dry-run 预览共用) ---
+def resolve_ai_config(requested_ai_config_id, user_id):
+    """
+    按请求中的 ai_service_config_id、用户启用的服务、系统默认服务的顺序确定 AI 服务，并检查使用权限。
+
+    Returns:
+        (ai_config, error_message)：ai_config 是配置缓存中的只读快照 (见 app/config_cache.py)
+    """
+    ai_config = None
+    error_message = None
+    config_id_to_use = None
+
+    # Determine config_id_to_use (logic remains the same)
+    if requested_ai_config_id and str(requested_ai_config_id).isdigit():
+        try:
+            config_id_to_use = int(requested_ai_config_id)
+        except (ValueError, TypeError):
+            error_message = "无效的 AI 服务 ID"
+    elif requested_ai_config_id == "" or requested_ai_config_id is None:
+        if current_user.is_authenticated and current_user.active_ai_service_id:
+            config_id_to_use = current_user.active_ai_service_id
+        else:
+            system_default_config = get_default_service()
+            if system_default_config:
+                config_id_to_use = system_default_config.id
+            else:
+                error_message = "未配置默认 AI 服务"
+    else:
+         error_message = "无效的 AI 服务 ID"
+    
+    # Get ai_config (logic remains the same, uses config_id_to_use)
+    if config_id_to_use and not error_message:
+        ai_config = get_service(config_id_to_use)
+        if not ai_config:
+            error_message = f"找不到 ID 为 {config_id_to_use} 的 AI 服务"
+        else: # Check access permission using captured user_id
+             user_owns = ai_config.owner_id == user_id # Use captured user_id
+             is_accessible = ai_config.is_system_service or user_owns
+             if not is_accessible:
+                 error_message = f"无权使用 AI 服务 '{ai_config.name}'"
+
+    return ai_config, error_message
+
+# --- 提示词组装 (生成与 dry-run 预览共用) ---
+def assemble_final_prompt(template_id, input_data, user_id_for_log):
+    """
+    根据模板 (或直接使用 提示词 + markdown指令) 组装最终提示词。
+
+    Returns:
+        (final_prompt, template, messages, error_response)：出错时 error_response 为可直接返回的
+        (jsonify(...), status)，否则为 None；未使用模板时 template 为 None。
+        模板启用了前缀稳定模式时 messages 为 [system, user] 消息列表，final_prompt 为其拼接文本；
+        否则 messages 为 None。模板从配置缓存读取 (只读快照)。
+    """
+    if template_id:
+        try:
+            template_id_int = int(template_id)
+            template = get_template(template_id_int)
+            if not template:
+                return None, None, None, (jsonify({'error': f'Template with id {template_id_int} not found'}), 404)
+            if template.prefix_stable:
+                messages = build_prefix_stable_messages(template.template_string, input_data)
+                return flatten_messages(messages), template, messages, None
+            return process_prompt_template(template.template_string, input_data), template, None, None
+        except ValueError:
+            return None, None, None, (jsonify({'error': 'Invalid template_id format'}), 400)
+        except Exception as e:
+            print(f"User {user_id_for_log}: Error processing template {template_id}: {e}")
+            return None, None, None, (jsonify({'error': f'Error processing template: {e}'}), 500)
+
+    user_core_prompt = input_data.get('提示词', '')
+    markdown_preference_instructions = input_data.get('markdown指令', '')
+
+    if not user_core_prompt:
+        return None, None, None, (jsonify({'error': 'No "提示词" provided and no template selected.'}), 400)
+
+    if markdown_preference_instructions:
+        return f"{user_core_prompt}\n\n{markdown_preference_instructions}", None, None, None
+    return user_core_prompt, None, None, None
+
+# --- 断线续传 / 幂等重复提交：从 replay store 重新订阅一个流式生成 (见 app/single_flight.py) ---
+def stream_trailer(flask_app, generation_id, user_id):
+    """SSE 流结束后的 usage / balance 事件 (见 app/sse.py)，生成没有计费结果时返回空列表。"""
+    shared = generation_flights.get_generation(generation_id, user_id)
+    usage = dict(shared.usage) if shared is not None and shared.usage else None
+    if usage is None:
+        return []
+    billing_event_id = usage.pop('billing_event_id')
+    with flask_app.app_context():
+        balance = get_balance_after(user_id, billing_event_id, -usage['points'])
+    return [('usage', usage), ('balance', {'balance': balance})]
+
+def stream_response(flask_app, body, generation_id, candidates, sse):
+    """
+    流式生成的 Response：纯文本 / NDJSON (多候选)，或 SSE 事件流。
+
+    返回之前释放请求 session 的数据库连接，流式输出期间不占用连接 (见 app/db_pool.py)。
+    """
+    release_session()
+    if sse:
+        response = Response(body, mimetype=SSE_MIMETYPE)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no' # 反向代理不要缓冲事件流
+    else:
+        response = Response(body, mimetype='text/plain' if candidates == 1 else NDJSON_MIMETYPE)
+    response.headers['X-Generation-Id'] = generation_id
+    return response
+
+def replay_generation_response(flask_app, generation_id, user_id, offset, starting_ok=False, sse=False):
+    """
+    返回从 offset (已收到的字符数) 处继续输出 generation_id 的流式响应，不会调用上游。
+
+    starting_ok: 幂等键已登记但生成还没开始 (原请求的响应尚未开始输出) 时返回 409 而不是 404.
+    sse: 以 SSE 事件流输出 (offset 延续原来的编号).
+    """
+    coalescer = ChunkCoalescer(*flush_policy(flask_app.config))
+    idle_timeout = flask_app.config.get('AI_SSE_HEARTBEAT_SECONDS', 15) if sse else None
+    subscription, shared = generation_flights.resume(generation_id, user_id, offset, coalescer, idle_timeout)
+    if subscription is None:
+        if starting_ok:
+            return jsonify({'error': '相同的生成请求正在启动，请稍后重试', 'code': 'GENERATION_STARTING'}), 409, {'Retry-After': '1'}
+        return jsonify({'error': '生成不存在或已过期，请重新生成', 'code': 'GENERATION_NOT_FOUND'}), 404
+    output = sse_events(subscription, offset, lambda: stream_trailer(flask_app, generation_id, user_id)) \
+        if sse else subscription
+
+    def replay():
+        try:
+            for chunk in output:
+                yield chunk
+        except GeneratorExit:
+            print(f"User {user_id}: Client disconnected while resuming generation {generation_id}.")
+            raise
+        except Exception as e:
+            print(f"!!! User {user_id}: Generation {generation_id} ended with an error during replay: {e}")
+        finally:
+            output.close()
+            subscription.close()
+
+    candidates = shared.key[3] if isinstance(shared.key, tuple) and len(shared.key) > 3 else 1
+    return stream_response(flask_app, replay(), generation_id, candidates, sse)
+
+@api_bp.route('/generations/<generation_id>/stream', methods=['GET'])
+@login_required
+def resume_generation_stream(generation_id):
+    """
+    断线续传：?offset=已收到的字符数 (SSE 模式也可以用 Last-Event-ID)，从断点继续读取进行中 (或刚结束) 的流式生成。
+    Accept: text/event-stream 时以 SSE 事件流输出。
+    """
+    offset = resume_offset(request)
+    if offset < 0:
+        return jsonify({'error': 'offset 不能为负数'}), 400
+    app = current_app._get_current_object()
+    if generation_flights.get_generation(generation_id, current_user.id) is None:
+        # 不在本进程 replay store 中的后台生成作业 (在其他进程中运行或早已结束)：从数据库跟读
+        job = GenerationJob.query.filter_by(id=generation_id, user_id=current_user.id).first()
+        if job is not None:
+            return job_stream_response(app, job.id, current_user.id, offset, sse=wants_sse(request))
+    return replay_generation_response(app, generation_id, current_user.id, offset, sse=wants_sse(request))
+
+def job_stream_response(flask_app, job_id, user_id, offset, sse=False):
+    """从数据库跟读后台生成作业的输出 (每次写回后可见)，格式同 replay_generation_response。"""
+    idle_timeout = flask_app.config.get('AI_SSE_HEARTBEAT_SECONDS', 15) if sse else None
+    subscription = tail_job_result(flask_app, job_id, offset,
+                                   flask_app.config.get('AI_GENERATION_JOB_CHECKPOINT_SECONDS', 1.0), idle_timeout)
+
+    def trailer():
+        with flask_app.app_context():
+            job = GenerationJob.query.get(job_id)
+            if job is None or not job.billing_event_id:
+                return []
+            balance = get_balance_after(user_id, job.billing_event_id, -(job.points or 0))
+            return [('usage', {'total_tokens': job.tokens, 'prompt_tokens': None, 'cached_tokens': None,
+                               'points': job.points, 'status': job.status}),
+                    ('balance', {'balance': balance})]
+
+    output = sse_events(subscription, offset, trailer) if sse else subscription
+
+    def tail():
+        try:
+            for chunk in output:
+                yield chunk
+        except GeneratorExit:
+            print(f"User {user_id}: Client disconnected while following generation job {job_id}.")
+            raise
+        except Exception as e:
+            print(f"!!! User {user_id}: Generation job {job_id} ended with an error: {e}")
+        finally:
+            output.close()
+            subscription.close()
+
+    return stream_response(flask_app, tail(), job_id, 1, sse)
+
+# --- 后台生成作业 (见 app/generation_jobs.py)：提交后立即返回，生成不占用 Web worker ---
+@api_bp.route('/generations', methods=['POST'])
+@login_required
+def submit_generation_job():
+    """
+    请求体与 /generate-with-template 相同 (不支持多候选)，作业入队后立即返回 202 和作业 ID；
+    之后轮询 GET /api/generations/<id>，或用 GET /api/generations/<id>/stream 接收实时输出。
+    Idempotency-Key 相同的重复提交返回已有的作业。
+    """
+    app = current_app._get_current_object()
+    user_id = current_user.id
+    is_admin_flag = current_user.is_admin
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    if parse_candidate_count(data.get('candidates'), app.config.get('AI_MAX_CANDIDATES', 4)) != 1:
+        return jsonify({'error': '后台生成作业不支持多候选'}), 400
+
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    idempotency_key = str(idempotency_key)[:200] if idempotency_key else None
+    if idempotency_key:
+        existing = GenerationJob.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+        if existing is not None:
+            return jsonify(existing.to_dict(include_result=False)), 200
+
+    ai_config, error_message = resolve_ai_config(data.get('ai_service_config_id'), user_id)
+    if error_message:
+        print(f"User {user_id}: AI service config lookup failed: {error_message}")
+        return jsonify({'error': error_message}), 400
+    try:
+        pool_candidates(ai_config)
+    except CircuitOpenError as e:
+        print(f"User {user_id}: AI service '{ai_config.name}' circuit is open: {e}")
+        return jsonify(e.to_dict()), 503, {'Retry-After': str(e.retry_after)}
+
+    try:
+        input_data = expand_input_data(data, user_id)
+    except BookContextError as e:
+        return jsonify(e.to_dict()), e.status
+    input_data, context_report = pack_context(input_data, resolve_budget(ai_config, app.config))
+    final_prompt, prompt_template, prompt_messages, prompt_error = assemble_final_prompt(
+        data.get('template_id'), input_data, user_id)
+    if prompt_error:
+        return prompt_error
+    target_chars = requested_length(prompt_template, input_data)
+
+    # 按预估费用预留点数，作业结束计费时结算 (排队时间也算在有效期内)
+    reservation_id = None
+    if not is_admin_flag:
+        points = reservation_points(estimate_tokens(final_prompt), 1,
+                                    max_tokens_for(target_chars, app.config) or
+                                    app.config.get('AI_POINTS_RESERVATION_COMPLETION_TOKENS', 1000))
+        reservation_id = reserve_points(user_id, points, app.config.get('AI_GENERATION_JOB_RESERVATION_TTL', 3600))
+        if reservation_id is None:
+            available, held = get_available_balance(user_id)
+            return jsonify({
+                'error': f'点数不足：本次生成预计最多需要约 {points} 点 (您可用 {available} 点，另有 {held} 点被进行中的生成占用)。',
+                'code': 'INSUFFICIENT_POINTS'
+            }), 402
+
+    job = GenerationJob(
+        id=generation_flights.new_generation_id(),
+        user_id=user_id,
+        status='queued',
+        cancel_requested=False,
+        service_id=ai_config.id,
+        template_id=prompt_template.id if prompt_template else None,
+        prompt=final_prompt,
+        messages=json.dumps(prompt_messages, ensure_ascii=False) if prompt_messages else None,
+        target_chars=target_chars,
+        idempotency_key=idempotency_key,
+        reservation_id=reservation_id,
+        created_at=datetime.utcnow()
+    )
+    try:
+        db.session.add(job)
+        db.session.commit()
+    except IntegrityError:
+        # 相同幂等键的并发提交：返回先写入的作业
+        db.session.rollback()
+        release_reservation(reservation_id)
+        existing = GenerationJob.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+        if existing is None:
+            raise
+        return jsonify(existing.to_dict(include_result=False)), 200
+    notify_workers()
+    print(f"User {user_id}: Queued generation job {job.id} for AI service '{ai_config.name}'.")
+    response = jsonify({**job.to_dict(include_result=False),
+                        'status_url': f'/api/generations/{job.id}',
+                        'stream_url': f'/api/generations/{job.id}/stream',
+                        'context_packing': context_report})
+    return response, 202, {'Location': f'/api/generations/{job.id}'}
+
+@api_bp.route('/generations', methods=['GET'])
+@login_required
+def list_generation_jobs():
+    """当前用户最近的生成作业 (不含结果)，?status= 可按状态过滤，?limit= 默认 20、最多 100。"""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    query = GenerationJob.query.filter_by(user_id=current_user.id)
+    if request.args.get('status'):
+        query = query.filter_by(status=request.args['status'])
+    jobs = query.order_by(GenerationJob.created_at.desc()).limit(limit).all()
+    return jsonify([job.to_dict(include_result=False) for job in jobs])
+
+@api_bp.route('/generations/<generation_id>', methods=['GET'])
+@login_required
+def get_generation_job(generation_id):
+    """作业状态与结果 (运行中时为最近一次写回的部分)。"""
+    job = GenerationJob.query.filter_by(id=generation_id, user_id=current_user.id).first()
+    if job is None:
+        return jsonify({'error': '生成作业不存在', 'code': 'GENERATION_NOT_FOUND'}), 404
+    return jsonify(job.to_dict())
+
+@api_bp.route('/generations/<generation_id>', methods=['DELETE'])
+@login_required
+def cancel_generation_job(generation_id):
+    """取消作业：排队中的直接取消，运行中的尽快中止 (已生成部分照常计费)。"""
+    job = GenerationJob.query.filter_by(id=generation_id, user_id=current_user.id).first()
+    if job is None:
+        return jsonify({'error': '生成作业不存在', 'code': 'GENERATION_NOT_FOUND'}), 404
+    if job.finished:
+        return jsonify({'error': '生成作业已结束', 'status': job.status}), 409
+    try:
+        status = cancel_job(job)
+    except Exception as e:
+        db.session.rollback()
+        print(f"User {current_user.id}: Error cancelling generation job {generation_id}: {e}")
+        return jsonify({'error': '取消失败'}), 500
+    return jsonify({'id': generation_id, 'status': status, 'cancel_requested': True})
+
 @api_bp.route('/generate-with-template', methods=['POST'])
 @login_required
 def generate_prompt_with_template():
@@ -749,42 +1105,19 @@ def generate_prompt_with_template():
             return jsonify({'error': 'No data provided'}), 400
 
         template_id = data.get('template_id')
-        input_data = data.get('input_data', {})
+        # 请求带 book_id + 光标时由服务端读取已保存的正文和设定，不再上传整本书 (见 app/book_context.py)
+        try:
+            input_data = expand_input_data(data, user_id)
+        except BookContextError as e:
+            print(f"User {user_id_for_log}: Book context rejected ({e.code}): {e}")
+            return jsonify(e.to_dict()), e.status
         requested_ai_config_id = data.get('ai_service_config_id') 
+        # "candidates": N 时并发生成 N 个候选版本供挑选 (见 app/candidates.py)
+        candidate_count = parse_candidate_count(data.get('candidates'), app.config.get('AI_MAX_CANDIDATES', 4))
+        if candidate_count is None:
+            return jsonify({'error': 'candidates 必须是正整数'}), 400
 
-        ai_config = None
-        error_message = None
-        config_id_to_use = None
-
-        # Determine config_id_to_use (logic remains the same)
-        if requested_ai_config_id and str(requested_ai_config_id).isdigit():
-            try:
-                config_id_to_use = int(requested_ai_config_id)
-            except (ValueError, TypeError):
-                error_message = "无效的 AI 服务 ID"
-        elif requested_ai_config_id == "" or requested_ai_config_id is None:
-            # Use current_user here as it's still valid
-            if current_user.is_authenticated and current_user.active_ai_service_id:
-                config_id_to_use = current_user.active_ai_service_id
-            else:
-                system_default_config = AIService.query.filter_by(is_default=True, is_system_service=True).first()
-                if system_default_config:
-                    config_id_to_use = system_default_config.id
-                else:
-                    error_message = "未配置默认 AI 服务"
-        else:
-             error_message = "无效的 AI 服务 ID"
-        
-        # Get ai_config (logic remains the same, uses config_id_to_use)
-        if config_id_to_use and not error_message:
-            ai_config = AIService.query.get(config_id_to_use)
-            if not ai_config:
-                error_message = f"找不到 ID 为 {config_id_to_use} 的 AI 服务"
-            else: # Check access permission using captured user_id
-                 user_owns = ai_config.owner_id == user_id # Use captured user_id
-                 is_accessible = ai_config.is_system_service or user_owns
-                 if not is_accessible:
-                     error_message = f"无权使用 AI 服务 '{ai_config.name}'"
+        ai_config, error_message = resolve_ai_config(requested_ai_config_id, user_id)
 
         if error_message:
             print(f"User {user_id_for_log}: AI service config lookup failed: {error_message}")
@@ -795,45 +1128,70 @@ def generate_prompt_with_template():
             
         print(f"User {user_id_for_log}: Determined to use AI Service: ID={ai_config.id}, Name='{ai_config.name}', Streaming={ai_config.enable_streaming}")
 
-        # --- 点数预检查 (使用 current_user.points 和 is_admin_flag) ---
+        # 服务池中的成员按实测延迟排序，依次尝试 (未加入服务池时只有 ai_config 自己)；
+        # 熔断中的成员被跳过，全部熔断时立即返回 503，不再等待连接超时 (见 app/circuit_breaker.py)
+        try:
+            pool_services = pool_candidates(ai_config)
+        except CircuitOpenError as e:
+            print(f"User {user_id_for_log}: AI service '{ai_config.name}' circuit is open: {e}")
+            return jsonify(e.to_dict()), 503, {'Retry-After': str(e.retry_after)}
+
+        # --- 点数预检查 (可用余额 = 余额 - 进行中的生成预留的点数，见 app/points_ledger.py) ---
         MINIMUM_POINTS_REQUIRED = 1 
+        available_points = None
         if not is_admin_flag: # Use the captured flag
-            # It's okay to use current_user.points here as context is still valid
-            user_points_to_check = current_user.points 
-            if user_points_to_check < MINIMUM_POINTS_REQUIRED:
-                print(f"User {user_id_for_log}: Insufficient points ({user_points_to_check}) ...")
+            available_points, held_points = get_available_balance(user_id)
+            if available_points < MINIMUM_POINTS_REQUIRED:
+                print(f"User {user_id_for_log}: Insufficient points (available {available_points}, reserved {held_points}) ...")
                 return jsonify({
-                    'error': f'点数不足 (您有 {user_points_to_check} 点)，请充值后再使用AI服务。',
+                    'error': f'点数不足 (可用 {available_points} 点，另有 {held_points} 点被进行中的生成占用)，请充值后再使用AI服务。',
                     'code': 'INSUFFICIENT_POINTS'
                 }), 402
             else:
-                print(f"User {user_id_for_log}: Points check passed ({user_points_to_check} points) ...")
+                print(f"User {user_id_for_log}: Points check passed ({available_points} points available) ...")
 
-        # --- 提示词处理 --- 
-        final_prompt = None
-        if template_id:
-            try:
-                template_id_int = int(template_id)
-                template = PromptTemplate.query.get(template_id_int)
-                if not template:
-                    return jsonify({'error': f'Template with id {template_id_int} not found'}), 404
-                final_prompt = process_prompt_template(template.template_string, input_data)
-            except ValueError:
-                return jsonify({'error': 'Invalid template_id format'}), 400
-            except Exception as e:
-                print(f"User {user_id_for_log}: Error processing template {template_id}: {e}")
-                return jsonify({'error': f'Error processing template: {e}'}), 500
-        else:
-            user_core_prompt = input_data.get('提示词', '')
-            markdown_preference_instructions = input_data.get('markdown指令', '')
+        # --- 按 AI 服务的 token 预算裁剪 前文/后文/设定 (优先保留靠近光标的内容) ---
+        input_data, context_report = pack_context(input_data, resolve_budget(ai_config, app.config))
+        if context_report:
+            print(f"User {user_id_for_log}: Context packed to budget {context_report['budget']}: {context_report['placeholders']}")
 
-            if not user_core_prompt:
-                return jsonify({'error': 'No "提示词" provided and no template selected.'}), 400
+        # --- 提示词处理 --- 
+        final_prompt, prompt_template, prompt_messages, prompt_error = assemble_final_prompt(template_id, input_data, user_id_for_log)
+        if prompt_error:
+            return prompt_error
+        prompt_template_id = prompt_template.id if prompt_template else None
+        # 模板要求了字数时按目标字数限制输出长度 (见 app/length_control.py)
+        target_chars = requested_length(prompt_template, input_data)
+        max_tokens = max_tokens_for(target_chars, app.config)
+
+        # 提示词本身 (按本地估算，多候选时每个候选各发送一次) 就超出剩余点数时不再调用上游
+        if not is_admin_flag:
+            estimated_prompt_points = estimate_tokens(final_prompt) * candidate_count // TOKENS_PER_POINT
+            if estimated_prompt_points > available_points:
+                print(f"User {user_id_for_log}: Prompt alone needs ~{estimated_prompt_points} points, user has {available_points} available.")
+                return jsonify({
+                    'error': f'点数不足：提示词预计需要约 {estimated_prompt_points} 点 (您可用 {available_points} 点)，请缩短前文/设定或充值。',
+                    'code': 'INSUFFICIENT_POINTS'
+                }), 402
 
-            if markdown_preference_instructions:
-                final_prompt = f"{user_core_prompt}\n\n{markdown_preference_instructions}"
-            else:
-                final_prompt = user_core_prompt
+        def take_reservation():
+            """
+            流式生成前按预估费用预留点数 (计费时结算)，返回 (reservation_id, error_message)；管理员不预留。
+            需要在 app context 中调用 (后台线程中补预留时也是)。
+            """
+            if is_admin_flag:
+                return None, None
+            points = reservation_points(estimate_tokens(final_prompt), candidate_count,
+                                        max_tokens or app.config.get('AI_POINTS_RESERVATION_COMPLETION_TOKENS', 1000))
+            reservation_id = reserve_points(user_id, points, app.config.get('AI_POINTS_RESERVATION_TTL', 600))
+            if reservation_id is None:
+                available, held = get_available_balance(user_id)
+                print(f"User {user_id_for_log}: Cannot reserve {points} points (available {available}, reserved {held}).")
+                return None, f'点数不足：本次生成预计最多需要约 {points} 点 (您可用 {available} 点，另有 {held} 点被进行中的生成占用)。'
+            return reservation_id, None
+
+        def insufficient_points_response(message):
+            return jsonify({'error': message, 'code': 'INSUFFICIENT_POINTS'}), 402
 
         # --- 新增：打印最终提示词到后台日志 ---
         print(f"\n--- User {user_id_for_log} | Final Prompt for AI Service ID {ai_config.id} ---")
@@ -842,103 +1200,365 @@ def generate_prompt_with_template():
         # --- 结束打印 ---
 
         # --- 调用 AI 服务 --- 
+        gateway_url = app.config.get('AI_ASYNC_GATEWAY_URL')
+        # 请求选择 SSE 协议时 (见 app/sse.py)，由网关处理的流仍是纯文本 (客户端按 Content-Type 区分)
+        use_sse = wants_sse(request, data)
+        # 准入控制：按服务 (或服务池) 限制并发上游调用，满了按用户组权重公平排队；
+        # 多候选生成同时发起 candidate_count 个上游调用，按候选数申请名额，最后一个候选结束后一起释放
+        admission_key, admission_members = service_slot(ai_config, len(pool_services))
+        admission_weight = user_weight(current_user)
+        if ai_config.enable_streaming and gateway_url and candidate_count == 1:
+            # 交给异步网关处理流式生成，释放当前 worker (见 app/async_gateway.py)；多候选生成仍由当前 worker 处理
+            reservation_id, reservation_error = take_reservation()
+            if reservation_error:
+                return insufficient_points_response(reservation_error)
+            ticket = issue_stream_ticket(app, {
+                'user_id': user_id,
+                'username': username,
+                'is_admin': is_admin_flag,
+                'service_id': ai_config.id,
+                'prompt': final_prompt,
+                'messages': prompt_messages,
+                'template_id': prompt_template_id,
+                'reservation_id': reservation_id,
+                'target_chars': target_chars,
+                # 网关在发起上游调用前按同样的服务键和权重申请名额
+                'admission_key': admission_key,
+                'admission_members': admission_members,
+                'admission_weight': admission_weight
+            })
+            print(f"User {user_id_for_log}: Handing off streaming generation to async gateway at {gateway_url}.")
+            return jsonify({'stream_url': f"{gateway_url.rstrip('/')}/stream", 'stream_ticket': ticket,
+                            'context_packing': context_report})
+        flight_key = make_flight_key(user_id, ai_config.id, final_prompt, candidate_count)
+
         if ai_config.enable_streaming:
-            config_details_for_stream = { # ... (remains the same) ...
-                 'api_key': ai_config.api_key,
-                 'base_url': ai_config.base_url,
-                 'model_name': ai_config.model_name,
-                 'service_type': ai_config.service_type,
-                 'name': ai_config.name 
-            }
+            # 已有相同的流在进行时会直接共享它，不占用新的名额。这只是预判，真正由谁发起上游调用在
+            # generation_flights.stream() 中才确定：预判为跟随者却成了发起者时，由 produce_stream 补上预留和名额
+            admission_ticket = None
+            reservation_id = None
+            guarded = not generation_flights.has_stream(flight_key)
+            if guarded:
+                reservation_id, reservation_error = take_reservation()
+                if reservation_error:
+                    return insufficient_points_response(reservation_error)
+                try:
+                    admission_ticket = ai_admission.acquire(admission_key, user_id, admission_weight, admission_members,
+                                                            slots=candidate_count)
+                except AdmissionRejected as e:
+                    release_reservation(reservation_id)
+                    print(f"User {user_id_for_log}: Rejected by admission control for AI service '{ai_config.name}': {e}")
+                    return jsonify(e.to_dict()), 429, {'Retry-After': str(max(e.estimated_wait, 1))}
+                if admission_ticket.waited:
+                    print(f"User {user_id_for_log}: Admitted after waiting {admission_ticket.waited}s in queue.")
+            # 每次流式生成有一个 ID，断线后可以用它续传 (见 app/single_flight.py)；
+            # 同一个幂等键的重复提交直接附着到已有的生成，不再调用上游
+            generation_id = generation_flights.new_generation_id()
+            idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+            if idempotency_key:
+                idempotency_key = str(idempotency_key)[:200]
+                existing_generation_id = generation_flights.claim_idempotency_key(user_id, idempotency_key, generation_id)
+                if existing_generation_id:
+                    if admission_ticket is not None:
+                        admission_ticket.release()
+                    release_reservation(reservation_id)
+                    print(f"User {user_id_for_log}: Idempotency key already used, attaching to generation {existing_generation_id}.")
+                    return replay_generation_response(app, existing_generation_id, user_id, 0, starting_ok=True,
+                                                      sse=use_sse)
+            # billed: 预留已交给计费结算；否则生成结束 (失败、无用量) 时释放预留
+            generation_state = {'started': False, 'billed': False}
+
+            member_specs = [{
+                'config': {
+                    'api_key': member.api_key,
+                    'base_url': member.base_url,
+                    'model_name': member.model_name,
+                    'service_type': member.service_type,
+                    'name': member.name
+                },
+                'billing': {
+                    'id': member.id,
+                    'name': member.name,
+                    'is_system_service': member.is_system_service
+                }
+            } for member in pool_services]
+            if len(member_specs) > 1:
+                print(f"User {user_id_for_log}: AI service pool '{ai_config.pool_name}' order: {[m['billing']['id'] for m in member_specs]}")
             
+            # 上游调用与计费：在 single-flight 后台线程中执行，相同的并发请求共享同一个上游流，只计费一次
+            def produce_stream(shared, flask_app, gen_user_id, gen_username, gen_is_admin):
+                nonlocal admission_ticket, reservation_id
+                if not guarded:
+                    # 预判时相同的流还在进行，但在本请求订阅之前已经结束，本请求成了发起者：
+                    # 同样要先预留点数、取得准入名额，失败时以错误结束流 (SSE 客户端收到 error 事件)
+                    print(f"User {gen_user_id}: In-flight stream finished before attaching, taking reservation and admission as leader.")
+                    with flask_app.app_context():
+                        reservation_id, reservation_error = take_reservation()
+                    if reservation_error:
+                        raise InsufficientPoints(reservation_error)
+                    try:
+                        admission_ticket = ai_admission.acquire(admission_key, gen_user_id, admission_weight, admission_members,
+                                                                slots=candidate_count)
+                    except AdmissionRejected:
+                        release_reservation(reservation_id, flask_app)
+                        raise
+                try:
+                    _produce_stream(shared, flask_app, gen_user_id, gen_username, gen_is_admin)
+                finally:
+                    if admission_ticket is not None:
+                        admission_ticket.release()
+                    if not generation_state['billed']:
+                        release_reservation(reservation_id, flask_app)
+
+            def open_member_stream(gen_user_id, token_info, on_response):
+                """依次尝试服务池成员，返回 (记录延迟的流, 所用成员, 发出请求的时刻)。"""
+                for index, member in enumerate(member_specs):
+                    member_name = member['config']['name']
+                    print(f"User {gen_user_id}: Starting stream generation with AI service '{member_name}'.")
+                    started_at = time.monotonic()
+                    try:
+                        raw_iterator = call_ai_service(final_prompt, 
+                                                       config_details=member['config'], 
+                                                       enable_streaming=True, 
+                                                       token_info=token_info,
+                                                       messages=prompt_messages,
+                                                       on_response=on_response,
+                                                       max_tokens=max_tokens,
+                                                       length_governor=LengthGovernor.from_config(target_chars, app.config))
+                    except Exception as e:
+                        record_failure(member['billing']['id'], e)
+                        # 尚未输出任何内容，连接错误 / 超时 / 5xx 时换下一个成员
+                        if index + 1 < len(member_specs) and is_retryable_error(e):
+                            print(f"User {gen_user_id}: AI service '{member_name}' failed before streaming ({e}), failing over to next pool member.")
+                            continue
+                        raise
+                    return (timed_stream(member['billing']['id'], raw_iterator, started_at, token_info),
+                            member, started_at)
+
+            def _produce_stream(shared, flask_app, gen_user_id, gen_username, gen_is_admin):
+                if candidate_count > 1:
+                    _produce_candidates(shared, flask_app, gen_user_id, gen_username, gen_is_admin)
+                    return
+                token_info = {'total': 0}
+                first_chunk_at = None
+                stream_iterator, member, started_at = open_member_stream(
+                    gen_user_id, token_info,
+                    # 所有客户端断开时立即中止上游连接，不必等模型生成完
+                    lambda response: shared.on_abandon(lambda: abort_response(response)))
+                member_name = member['config']['name']
+                service_info_for_billing = member['billing']
+                
+                for chunk in stream_iterator:
+                    if shared.cancelled:
+                        # 所有客户端都已断开 (且没有在宽限期内重连)，不再继续读取上游
+                        print(f"User {gen_user_id}: All subscribers disconnected, stopping stream for AI service '{member_name}'.")
+                        stream_iterator.close()
+                        break
+                    if first_chunk_at is None:
+                        first_chunk_at = time.monotonic()
+                    shared.publish(chunk)
+                
+                # 客户端断开导致上游被中止时，已生成的部分 (按估算的 usage) 照常计费，日志状态记为 cancelled；
+                # 超出目标长度被截止的记为 truncated
+                cancelled = shared.cancelled and not token_info.get('completed')
+                status = 'cancelled' if cancelled else ('truncated' if token_info.get('truncated') else 'completed')
+                if not cancelled and not token_info.get('completed'):
+                    print(f"User {gen_user_id}: Stream from AI service '{member_name}' ended with an error. No billing.")
+                    # 作为流的错误结束 (SSE 客户端收到 error 事件)
+                    raise RuntimeError(f"AI 服务 '{member_name}' 的响应异常中断")
+                print(f"User {gen_user_id}: Stream generation {'cancelled' if cancelled else 'finished'} for AI service '{member_name}'.")
+                total_tokens_consumed_stream = token_info.get('total', 0) 
+                print(f"User {gen_user_id}: Tokens consumed: {total_tokens_consumed_stream}. Attempting billing and logging.")
+                
+                generation_state['billed'] = True
+                billing_event_id = uuid.uuid4().hex
+                points = bill_stream_usage(flask_app, gen_user_id, gen_username, gen_is_admin,
+                                           service_info_for_billing, total_tokens_consumed_stream,
+                                           len(final_prompt) if final_prompt else 0,
+                                           call_stats={
+                                               'prompt_template_id': prompt_template_id,
+                                               'prompt_tokens': token_info.get('prompt'),
+                                               'cached_tokens': token_info.get('cached'),
+                                               'ttft_ms': int((first_chunk_at - started_at) * 1000) if first_chunk_at else None,
+                                               'status': status
+                                           },
+                                           reservation_id=reservation_id, event_id=billing_event_id)
+                # SSE 订阅者在流末尾收到的 usage / balance 事件
+                shared.usage = {'billing_event_id': billing_event_id, 'total_tokens': total_tokens_consumed_stream,
+                                'prompt_tokens': token_info.get('prompt'), 'cached_tokens': token_info.get('cached'),
+                                'points': points, 'status': status}
+
+            def _produce_candidates(shared, flask_app, gen_user_id, gen_username, gen_is_admin):
+                # 并发生成 candidate_count 个候选，以 NDJSON 行输出 (见 app/candidates.py)，合并用量后计费一次
+                token_infos = [{'total': 0} for _ in range(candidate_count)]
+                used_members = [None] * candidate_count
+                upstream_responses = []
+                # 所有客户端断开时中止全部候选的上游连接
+                shared.on_abandon(lambda: [abort_response(response) for response in list(upstream_responses)])
+
+                def opener(index):
+                    def open_stream():
+                        stream_iterator, member, _ = open_member_stream(gen_user_id, token_infos[index],
+                                                                        upstream_responses.append)
+                        used_members[index] = member
+                        return stream_iterator
+                    return open_stream
+
+                started_at = time.monotonic()
+                first_chunk_at = None
+                for line in merge_candidate_streams([opener(index) for index in range(candidate_count)],
+                                                    should_stop=lambda: shared.cancelled):
+                    if first_chunk_at is None:
+                        first_chunk_at = time.monotonic()
+                    shared.publish(line)
+
+                cancelled = shared.cancelled and not all(info.get('completed') for info in token_infos)
+                billable = [info for info in token_infos if info.get('completed') or (cancelled and info.get('total'))]
+                status = 'cancelled' if cancelled else \
+                    ('truncated' if any(info.get('truncated') for info in billable) else 'completed')
+                if not billable:
+                    print(f"User {gen_user_id}: All {candidate_count} candidates failed. No billing.")
+                    raise RuntimeError(f"{candidate_count} 个候选全部生成失败")
+                total_tokens_consumed_stream = sum(info.get('total', 0) for info in billable)
+                print(f"User {gen_user_id}: {len(billable)}/{candidate_count} candidates {'cancelled' if cancelled else 'finished'}. "
+                      f"Tokens consumed: {total_tokens_consumed_stream}. Attempting billing and logging.")
+                # 候选可能落在服务池的不同成员上，日志记在第一个成功打开的成员名下
+                service_info_for_billing = next(member['billing'] for member in used_members if member is not None)
+                generation_state['billed'] = True
+                billing_event_id = uuid.uuid4().hex
+                prompt_tokens = sum(info.get('prompt') or 0 for info in billable)
+                cached_tokens = sum(info.get('cached') or 0 for info in billable)
+                points = bill_stream_usage(flask_app, gen_user_id, gen_username, gen_is_admin,
+                                           service_info_for_billing, total_tokens_consumed_stream,
+                                           len(final_prompt) if final_prompt else 0,
+                                           call_stats={
+                                               'prompt_template_id': prompt_template_id,
+                                               'prompt_tokens': prompt_tokens,
+                                               'cached_tokens': cached_tokens,
+                                               'ttft_ms': int((first_chunk_at - started_at) * 1000) if first_chunk_at else None,
+                                               'status': status
+                                           },
+                                           reservation_id=reservation_id, event_id=billing_event_id)
+                shared.usage = {'billing_event_id': billing_event_id, 'total_tokens': total_tokens_consumed_stream,
+                                'prompt_tokens': prompt_tokens, 'cached_tokens': cached_tokens,
+                                'points': points, 'status': status}
+
             # 定义 stream_generator，接收 app, user_id, username, is_admin
             def stream_generator(flask_app, gen_user_id, gen_username, gen_is_admin):
+                generation_state['started'] = True
                 try:
-                    print(f"User {gen_user_id}: Starting stream generation with AI service '{ai_config.name}'.")
-                    token_info = {'total': 0}
-                    stream_iterator = call_ai_service(final_prompt, 
-                                                      config_details=config_details_for_stream, 
-                                                      enable_streaming=True, 
-                                                      token_info=token_info)
-                    
-                    for chunk in stream_iterator:
-                        yield chunk
-                    
-                    print(f"User {gen_user_id}: Stream generation finished for AI service '{ai_config.name}'.")
-                    total_tokens_consumed_stream = token_info.get('total', 0) 
-                    print(f"User {gen_user_id}: Tokens consumed: {total_tokens_consumed_stream}. Attempting billing and logging.")
-                    
-                    with flask_app.app_context():
-                        actual_points_deducted = 0 
-                        billing_success = False
-                        log_success = False
-                        try:
-                            if total_tokens_consumed_stream > 0:
-                                points_to_deduct_calc = total_tokens_consumed_stream // TOKENS_PER_POINT
-                                if points_to_deduct_calc > 0:
-                                    if not gen_is_admin: # 使用传入的 is_admin 标志
-                                        user_for_billing = User.query.get(gen_user_id) # 使用传入的 user_id
-                                        if user_for_billing:
-                                            if user_for_billing.points is None: user_for_billing.points = 0
-                                            old_points = user_for_billing.points
-                                            user_for_billing.points -= points_to_deduct_calc
-                                            actual_points_deducted = points_to_deduct_calc 
-                                            db.session.add(user_for_billing) 
-                                            billing_success = True 
-                                            print(f"User {gen_user_id} will be billed {points_to_deduct_calc} points. Tokens: {total_tokens_consumed_stream}. Points before: {old_points}, After: {user_for_billing.points}. AI: {ai_config.name}")
-                                        else:
-                                            print(f"CRITICAL ERROR: User {gen_user_id} not found in DB for billing.")
-                                    else:
-                                        print(f"User {gen_user_id} (admin) used {total_tokens_consumed_stream} tokens. Billing skipped.")
-                                else:
-                                    print(f"User {gen_user_id}: Points to deduct is 0 for {total_tokens_consumed_stream} tokens. No billing action.")
-                            else:
-                                print(f"User {gen_user_id}: Token usage was 0 or not found. No billing or logging.")
-
-                            if total_tokens_consumed_stream > 0:
-                                new_log_entry = ApiCallLog(
-                                    user_id=gen_user_id, # 使用传入的 user_id
-                                    username=gen_username, # 使用传入的 username
-                                    ai_service_id=ai_config.id,
-                                    ai_service_name=ai_config.name,
-                                    is_system_service=ai_config.is_system_service,
-                                    tokens_consumed=total_tokens_consumed_stream,
-                                    points_deducted=actual_points_deducted, 
-                                    prompt_length=len(final_prompt) if final_prompt else 0 
-                                )
-                                db.session.add(new_log_entry)
-                                log_success = True 
-                                print(f"User {gen_user_id}: API call log entry created. Tokens: {total_tokens_consumed_stream}, Points deducted: {actual_points_deducted}.")
-                        
-                        except Exception as db_op_ex:
-                            print(f"CRITICAL ERROR during billing/logging setup for User {gen_user_id}: {db_op_ex}")
-                            db.session.rollback()
-                        
-                        else: 
-                            if billing_success or log_success:
-                                try:
-                                    db.session.commit()
-                                    print(f"User {gen_user_id}: Database session committed for billing/logging.")
-                                except Exception as commit_ex:
-                                    db.session.rollback()
-                                    print(f"CRITICAL ERROR: Failed to commit database session for User {gen_user_id}: {commit_ex}")
-                            else:
-                                print(f"User {gen_user_id}: No database changes to commit for this request.")
+                    # 合并细碎的增量后再写出 (第一块立即输出)，减少传输帧数和前端渲染次数
+                    coalescer = ChunkCoalescer(*flush_policy(flask_app.config))
+                    subscription, is_leader = generation_flights.stream(
+                        flight_key,
+                        lambda shared: produce_stream(shared, flask_app, gen_user_id, gen_username, gen_is_admin),
+                        coalescer, generation_id=generation_id,
+                        idle_timeout=flask_app.config.get('AI_SSE_HEARTBEAT_SECONDS', 15) if use_sse else None)
+                    # SSE 模式下错误、用量与余额作为事件发给客户端
+                    output = sse_events(subscription, 0, lambda: stream_trailer(flask_app, generation_id, gen_user_id)) \
+                        if use_sse else subscription
+                    if not is_leader:
+                        print(f"User {gen_user_id}: Identical generation already in flight, attaching to its stream.")
+                        if admission_ticket is not None:
+                            admission_ticket.release()
+                        # 共享的流由发起者计费，本请求的预留不会被结算
+                        release_reservation(reservation_id, flask_app)
+                    try:
+                        for chunk in output:
+                            yield chunk
+                    except GeneratorExit:
+                        # 客户端断开：立即退订，最后一个订阅者退订且宽限期内没有续传时会中止上游连接
+                        print(f"User {gen_user_id}: Client disconnected during streaming generation {generation_id}.")
+                        raise
+                    finally:
+                        output.close()
+                        subscription.close()
                 except Exception as e:
-                     print(f"!!! User {gen_user_id}: Error during streaming generation for AI '{config_details_for_stream.get('name', 'N/A')}': {e}") # Log gen_user_id
+                     print(f"!!! User {gen_user_id}: Error during streaming generation for AI '{ai_config.name}': {e}") # Log gen_user_id
                      import traceback
                      print(traceback.format_exc())
             
             # 返回 Response 时，调用 stream_generator 并传入 app 和用户信息
-            return Response(stream_generator(app, user_id, username, is_admin_flag), mimetype='text/plain') 
+            response = stream_response(app, stream_generator(app, user_id, username, is_admin_flag),
+                                       generation_id, candidate_count, use_sse)
+            if context_report:
+                # 流式响应体是纯文本，裁剪报告放在响应头里 (ASCII JSON)
+                response.headers['X-Context-Packing'] = json.dumps(context_report)
+            # 客户端在生成器开始之前就断开时，名额和预留不会被后台线程释放，这里兜底
+            def release_if_not_started():
+                if generation_state['started']:
+                    return
+                if admission_ticket is not None:
+                    admission_ticket.release()
+                release_reservation(reservation_id, app)
+                if idempotency_key:
+                    generation_flights.release_idempotency_key(user_id, idempotency_key, generation_id)
+            response.call_on_close(release_if_not_started)
+            return response
         else:
              # ... (非流式逻辑保持不变) ...
             print(f"User {user_id_for_log}: Non-streaming path taken for AI service '{ai_config.name}'. Billing logic for non-streaming is disabled.")
-            result = call_ai_service(final_prompt, config_id=ai_config.id, enable_streaming=False)
+            # 请求体中 "use_cache": false 可绕过结果缓存 (例如重试时希望得到不同结果)；多候选生成不使用缓存
+            use_cache = data.get('use_cache', True) is not False and candidate_count == 1
+            # 相同的并发请求只调用一次上游
+            pool_member_ids = [member.id for member in pool_services]
+
+            def call_pool():
+                try:
+                    admission_ticket = ai_admission.acquire(admission_key, user_id, admission_weight, admission_members,
+                                                            slots=candidate_count)
+                except AdmissionRejected as e:
+                    print(f"User {user_id}: Rejected by admission control for AI service '{ai_config.name}': {e}")
+                    return {**e.to_dict(), 'status_code': 429}
+                try:
+                    if candidate_count > 1:
+                        return call_candidates()
+                    return call_pool_members()
+                finally:
+                    admission_ticket.release()
+
+            def call_candidates():
+                # 每个候选在自己的线程里走一遍服务池故障转移 (各用一份请求上下文的拷贝)
+                calls = [copy_current_request_context(call_pool_members) for _ in range(candidate_count)]
+                with ThreadPoolExecutor(max_workers=candidate_count) as executor:
+                    results = list(executor.map(lambda call: call(), calls))
+                succeeded = [r for r in results if 'error' not in r]
+                if not succeeded:
+                    return results[0]
+                return {'success': True, 'content': succeeded[0]['content'],
+                        'contents': [r.get('content') if 'error' not in r else None for r in results]}
+
+            def call_pool_members():
+                # 依次尝试服务池成员，可重试的错误 (连接错误 / 超时 / 429 / 5xx) 换下一个
+                for index, member_id in enumerate(pool_member_ids):
+                    started_at = time.monotonic()
+                    member_result = call_ai_service(final_prompt, config_id=member_id, enable_streaming=False, use_cache=use_cache,
+                                                    messages=prompt_messages, max_tokens=max_tokens)
+                    if 'error' not in member_result:
+                        if not member_result.get('cached'):
+                            record_success(member_id, time.monotonic() - started_at)
+                        return member_result
+                    if not member_result.get('retryable'):
+                        return member_result
+                    record_failure(member_id, member_result['error'])
+                    if index + 1 < len(pool_member_ids):
+                        print(f"User {user_id}: AI service {member_id} failed ({member_result['error']}), failing over to next pool member.")
+                return member_result
+
+            # 上游调用可能长达 180 秒，先归还请求的数据库连接
+            release_session()
+            result = generation_flights.do(flight_key, call_pool)
+            if result.get('code') == 'AI_QUEUE_FULL':
+                return jsonify({k: v for k, v in result.items() if k != 'status_code'}), 429, \
+                    {'Retry-After': str(max(result['estimated_wait_seconds'], 1))}
             if 'error' in result: 
                 return jsonify({'error': result['error']}), result.get('status_code', 500)
             else:
-                 return jsonify({'generated_text': result.get('content', '')}) 
+                 response_data = {'generated_text': result.get('content', ''), 'cached': result.get('cached', False),
+                                  'context_packing': context_report}
+                 if candidate_count > 1:
+                     response_data['generated_texts'] = result.get('contents', [])
+                 return jsonify(response_data) 
                 
     except Exception as e:
         # ... (外部错误处理保持不变) ...
@@ -946,6 +1566,62 @@ def generate_prompt_with_template():
         print(f"User {user_id_for_log}: Unhandled error in generate_prompt_with_template: {traceback.format_exc()}")
         return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
 
+# --- 新增：生成前预览最终提示词及 token 估算 (不调用 AI 服务、不扣点) ---
+@api_bp.route('/generate-with-template/dry-run', methods=['POST'])
+@login_required
+def dry_run_generate_with_template():
+    """ 接收与 /generate-with-template 相同的请求体，返回组装好的提示词和各占位符的本地 token 估算。"""
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    try:
+        input_data = expand_input_data(data, current_user.id)
+    except BookContextError as e:
+        return jsonify(e.to_dict()), e.status
+    # 与真正生成时一样按所选 AI 服务的预算裁剪上下文
+    ai_config, error_message = resolve_ai_config(data.get('ai_service_config_id'), current_user.id)
+    if error_message:
+        return jsonify({'error': error_message}), 400
+    context_report = None
+    if ai_config:
+        input_data, context_report = pack_context(input_data, resolve_budget(ai_config, current_app.config))
+    final_prompt, template, messages, prompt_error = assemble_final_prompt(data.get('template_id'), input_data, current_user.id)
+    if prompt_error:
+        return prompt_error
+
+    placeholders = {}
+    if template is not None:
+        for name, entry in collect_placeholder_values(template.template_string, input_data).items():
+            tokens = estimate_tokens(entry['text'])
+            # 前缀稳定模式下每个占位符的内容只在 user 消息中出现一次
+            occurrences = 1 if messages else entry['occurrences']
+            placeholders[name] = {
+                'chars': len(entry['text']),
+                'tokens': tokens,
+                'occurrences': occurrences,
+                'total_tokens': tokens * occurrences
+            }
+    prompt_tokens = estimate_tokens(final_prompt)
+    target_chars = requested_length(template, input_data)
+    return jsonify({
+        'prompt': final_prompt,
+        # 前缀稳定模式下实际发送的 system + user 消息 (system 消息在同一模板的多次生成之间保持不变)
+        'messages': messages,
+        'prompt_chars': len(final_prompt),
+        'prompt_tokens': prompt_tokens,
+        'placeholders': placeholders,
+        # 模板中固定文字部分的 token 数 (估算值相减，可能有 ±1 的误差)
+        'template_tokens': max(prompt_tokens - sum(p['total_tokens'] for p in placeholders.values()), 0),
+        'estimated_prompt_points': prompt_tokens // TOKENS_PER_POINT,
+        'tokens_per_point': TOKENS_PER_POINT,
+        'user_points': current_user.balance,
+        'context_packing': context_report,
+        # 按 @[字数] 设置的输出上限 (见 app/length_control.py)
+        'target_chars': target_chars,
+        'max_tokens': max_tokens_for(target_chars, current_app.config),
+        'estimated': True
+    })
+
 # --- 新增：将用户 AI 服务配置设为系统服务 ---
 @api_bp.route('/ai-services/<int:config_id>/make-system', methods=['PUT'])
 @login_required
@@ -967,6 +1643,7 @@ def make_ai_service_system(config_id):
         original_owner_id = service_config.owner_id # 可选：记录原始所有者？
         service_config.is_system_service = True
         # service_config.owner_id = None # Keep the original owner ID (admin)
+        bump_config_version()
         db.session.commit()
         print(f"Admin {current_user.id} marked AI Service {config_id} (owned by {original_owner_id}) as system service.") # Updated log message
         return jsonify({'success': True, 'message': f'配置 "{service_config.name}" 已成功设为系统预设服务。'}), 200
@@ -992,6 +1669,7 @@ def delete_ai_service(config_id):
         config_name = service_config.name
         config_type = "系统预设" if service_config.is_system_service else "用户自定义"
         db.session.delete(service_config)
+        bump_config_version()
         db.session.commit()
         print(f"Admin {current_user.id} deleted AI Service {config_id} ('{config_name}', type: {config_type}).")
         return jsonify({'success': True, 'message': f'{config_type}配置 "{config_name}" 已成功删除。'}), 200
@@ -1050,10 +1728,30 @@ def update_ai_service(config_id):
          service_config.api_key = data['api_key'] 
          updated_fields.append('api_key')
 
+    if 'context_token_budget' in data:
+        raw_budget = data['context_token_budget']
+        if raw_budget in (None, ''):
+            new_budget = None
+        else:
+            try:
+                new_budget = int(raw_budget)
+            except (ValueError, TypeError):
+                return jsonify({'error': '上下文 token 预算必须是整数'}), 400
+        if new_budget != service_config.context_token_budget:
+            service_config.context_token_budget = new_budget
+            updated_fields.append('context_token_budget')
+    # 服务池只对系统服务生效，仅管理员可修改；空字符串表示移出服务池
+    if 'pool_name' in data and current_user.is_admin and service_config.is_system_service:
+        new_pool_name = (data['pool_name'] or '').strip() or None
+        if new_pool_name != service_config.pool_name:
+            service_config.pool_name = new_pool_name
+            updated_fields.append('pool_name')
+
     if not updated_fields:
         return jsonify({'message': '未提供有效更新字段'}), 400 # Or maybe 304 Not Modified?
 
     try:
+        bump_config_version()
         db.session.commit()
         print(f"User {current_user.id} updated AI Service {config_id}. Fields: {updated_fields}")
         # Return the updated config (excluding API key for safety)
@@ -1119,19 +1817,26 @@ def set_active_ai_service():
 @login_required
 def get_available_ai_services():
     """ 获取当前用户可以使用的 AI 服务配置列表 (系统服务 + 用户自己的服务)。"""
-    # 查询系统服务
-    system_services = AIService.query.filter_by(is_system_service=True).all()
-    # 查询用户自己的服务
-    user_services = AIService.query.filter_by(owner_id=current_user.id, is_system_service=False).all()
+    # 系统服务与用户自己的服务 (读配置缓存，见 app/config_cache.py)
+    system_services = get_system_services()
+    user_services = get_user_services(current_user.id)
     
-    # 合并列表并转换为字典格式 (仅包含必要信息 id 和 name)
+    # 服务池成员 ID (服务池里有任一成员没有熔断就算可用)
+    pool_member_ids = {}
+    for config in system_services:
+        if config.pool_name:
+            pool_member_ids.setdefault(config.pool_name, []).append(config.id)
+
+    # 合并列表并转换为字典格式 (id、name 以及熔断状态，见 app/circuit_breaker.py)
     available_configs = []
     for config in system_services + user_services:
         # 添加标记区分系统服务和用户服务 (可选)
         config_type = "(系统)" if config.is_system_service else "(我的)"
+        member_ids = pool_member_ids.get(config.pool_name, [config.id]) if config.is_system_service else [config.id]
         available_configs.append({
             'id': config.id,
-            'name': f"{config.name} {config_type}" # 在名称后添加类型标记
+            'name': f"{config.name} {config_type}", # 在名称后添加类型标记
+            **circuit_summary(member_ids)
         })
         
     # 可以根据需要添加排序逻辑，例如将用户自己的排在前面
@@ -1168,6 +1873,169 @@ def admin_get_api_call_logs():
         print(traceback.format_exc())
         return jsonify({'error': '获取 API 调用日志失败'}), 500
 
+# --- 新增：管理员按模板查看提示词缓存命中与首字延迟 ---
+@api_bp.route('/admin/prompt-cache-stats', methods=['GET'])
+@login_required
+def admin_get_prompt_cache_stats():
+    """(仅管理员) 按提示词模板汇总 ApiCallLog 中服务商报告的缓存命中 token 数与平均首字延迟。可选 ?days=N 只统计最近 N 天。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    query = db.session.query(
+        ApiCallLog.prompt_template_id,
+        func.count(ApiCallLog.id),
+        func.sum(ApiCallLog.prompt_tokens),
+        func.sum(ApiCallLog.cached_tokens),
+        func.avg(ApiCallLog.ttft_ms)
+    ).filter(ApiCallLog.prompt_tokens.isnot(None))
+    days = request.args.get('days', type=int)
+    if days:
+        query = query.filter(ApiCallLog.timestamp >= datetime.utcnow() - timedelta(days=days))
+    rows = query.group_by(ApiCallLog.prompt_template_id).all()
+
+    template_ids = [row[0] for row in rows if row[0] is not None]
+    templates = {t.id: t for t in PromptTemplate.query.filter(PromptTemplate.id.in_(template_ids)).all()} if template_ids else {}
+    result = []
+    for template_id, calls, prompt_tokens, cached_tokens, avg_ttft in rows:
+        template = templates.get(template_id)
+        prompt_tokens = int(prompt_tokens or 0)
+        cached_tokens = int(cached_tokens or 0)
+        result.append({
+            'template_id': template_id,
+            'template_name': template.name if template else None,
+            'prefix_stable': template.prefix_stable if template else False,
+            'calls': calls,
+            'prompt_tokens': prompt_tokens,
+            'cached_tokens': cached_tokens,
+            'cache_hit_ratio': round(cached_tokens / prompt_tokens, 4) if prompt_tokens else None,
+            'avg_ttft_ms': round(float(avg_ttft), 1) if avg_ttft is not None else None
+        })
+    result.sort(key=lambda item: item['calls'], reverse=True)
+    return jsonify({'templates': result})
+
+# --- 新增：管理员查看 AI 服务池成员统计 ---
+@api_bp.route('/admin/ai-service-pools', methods=['GET'])
+@login_required
+def admin_get_ai_service_pools():
+    """(仅管理员) 按服务池列出系统服务及其 EWMA 延迟/吞吐量统计 (当前 worker 进程内的值)，成员按路由顺序排列。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    pooled_services = AIService.query.filter(AIService.is_system_service == True, AIService.pool_name.isnot(None))\
+        .order_by(AIService.pool_name, AIService.id).all()
+    pools = {}
+    for service in pooled_services:
+        pools.setdefault(service.pool_name, []).append(service)
+    result = []
+    for pool_name, members in pools.items():
+        result.append({
+            'pool_name': pool_name,
+            'members': [{
+                'id': member.id,
+                'name': member.name,
+                'service_type': member.service_type,
+                'model_name': member.model_name,
+                'base_url': member.base_url,
+                'stats': get_member_stats(member.id),
+                'circuit': get_health(member.id)
+            } for member in pool_members(members[0])]
+        })
+    return jsonify({'pools': result})
+
+# --- 新增：管理员查看 AI 调用准入控制状态 ---
+@api_bp.route('/admin/ai-admission', methods=['GET'])
+@login_required
+def admin_get_ai_admission_stats():
+    """(仅管理员) 查看各服务的并发占用、排队人数与拒绝次数 (当前 worker 进程内的值)。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    return jsonify(ai_admission.stats())
+
+# --- 新增：管理员查看/清空 AI 结果缓存 ---
+@api_bp.route('/admin/ai-result-cache', methods=['GET'])
+@login_required
+def admin_get_ai_result_cache_stats():
+    """(仅管理员) 查看非流式结果缓存的命中统计 (计数为当前 worker 进程内的值)。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    result_cache = get_result_cache()
+    if result_cache is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **result_cache.stats()})
+
+@api_bp.route('/admin/ai-result-cache', methods=['DELETE'])
+@login_required
+def admin_clear_ai_result_cache():
+    """(仅管理员) 清空非流式结果缓存。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    result_cache = get_result_cache()
+    if result_cache is None:
+        return jsonify({'enabled': False})
+    try:
+        result_cache.clear()
+        return jsonify({'success': True, 'message': 'AI 结果缓存已清空'}), 200
+    except Exception as e:
+        print(f"Error clearing AI result cache: {e}")
+        return jsonify({'error': '清空缓存失败'}), 500
+
+# --- 新增：管理员查看/清空 AIService 与模板的配置缓存 ---
+@api_bp.route('/admin/config-cache', methods=['GET'])
+@login_required
+def admin_get_config_cache_stats():
+    """(仅管理员) 查看配置缓存的命中统计与版本号 (计数为当前 worker 进程内的值)。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    return jsonify(get_config_cache().stats())
+
+@api_bp.route('/admin/config-cache', methods=['DELETE'])
+@login_required
+def admin_clear_config_cache():
+    """(仅管理员) 使所有 worker 的配置缓存失效 (例如直接修改过数据库之后)。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    try:
+        bump_config_version()
+        db.session.commit()
+        return jsonify({'success': True, 'message': '配置缓存已失效'}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error invalidating config cache: {e}")
+        return jsonify({'error': '清空缓存失败'}), 500
+
+# --- 管理员查看服务端组装上下文用的书籍内容缓存 ---
+@api_bp.route('/admin/book-context-cache', methods=['GET'])
+@login_required
+def admin_get_book_context_cache_stats():
+    """(仅管理员) 查看书籍纯文本/设定缓存的大小与命中统计 (当前 worker 进程内的值)。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    return jsonify(get_book_context_cache().stats())
+
+@api_bp.route('/admin/billing-writer', methods=['GET'])
+@login_required
+def admin_get_billing_writer_stats():
+    """(仅管理员) 查看计费后台写入的队列长度、批大小、提交耗时与 flush 延迟 (当前 worker 进程内的值)。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    return jsonify(billing_stats())
+
+@api_bp.route('/admin/generation-jobs', methods=['GET'])
+@login_required
+def admin_get_generation_job_stats():
+    """(仅管理员) 各状态的作业数 (全部进程) 与本进程生成 worker 的统计。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    counts = dict(db.session.query(GenerationJob.status, func.count(GenerationJob.id)).group_by(GenerationJob.status).all())
+    runner = get_runner()
+    return jsonify({'jobs': counts, 'runner': runner.stats() if runner is not None else None})
+
+@api_bp.route('/admin/db-pool', methods=['GET'])
+@login_required
+def admin_get_db_pool_stats():
+    """(仅管理员) 查看数据库连接池状态与连接占用时长 (按 endpoint 分组，当前 worker 进程内的值)。"""
+    if not current_user.is_admin:
+        return jsonify({'error': '需要管理员权限'}), 403
+    return jsonify(pool_status())
+
 # --- 新增：获取当前用户状态（包括点数） ---
 @api_bp.route('/user/status', methods=['GET'])
 @login_required
@@ -1176,7 +2044,7 @@ def get_user_status():
     user_data = {
         'id': current_user.id,
         'username': current_user.username,
-        'points': current_user.points if hasattr(current_user, 'points') else 0, # 确保返回数字
+        'points': current_user.balance, # 快照 + 之后的流水
         'is_admin': current_user.is_admin,
         'active_ai_service_id': current_user.active_ai_service_id
         # 可以根据需要添加更多字段
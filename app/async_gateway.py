@@ -0,0 +1,393 @@
+"""
+异步流式生成网关 (ASGI sidecar)。
+
+同步路由 /api/generate-with-template 在整个流式生成期间 (最长 180 秒) 占用一个
+Flask worker，几个并发写作用户就能耗尽 worker。启用网关后 (配置
+AI_ASYNC_GATEWAY_URL)，Flask 路由只负责鉴权、选服务、点数预检查和组装提示词，
+然后签发一个短时有效、只能使用一次的 ticket 交给前端；前端拿 ticket 向网关发起流式请求，
+由网关在单个事件循环里用 httpx.AsyncClient 复用连接、并发转发数百个上游流。
+
+计费与 ApiCallLog 写入与同步路径完全一致 (app/billing.py)，在线程池中执行，
+不阻塞事件循环。准入控制 (app/admission.py) 使用 ticket 中的服务键和用户权重，
+在网关进程内计数，排队超时同样返回 429。
+
+运行方式:
+    flask ai-gateway --port 5001
+    或 uvicorn app.async_gateway:create_gateway_app --factory --port 5001
+网关应与主站通过反向代理挂在同一域名下 (例如 /agw/)，AI_ASYNC_GATEWAY_URL
+配置为该前缀。
+"""
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+from .admission import ai_admission, AdmissionRejected
+from .ai_service import build_chat_request
+from .length_control import LengthGovernor, max_tokens_for
+from .billing import bill_stream_usage, start_billing_writer
+from .points_ledger import release_reservation, reservation_active
+from .service_router import pool_candidates, record_success, record_failure, is_retryable_status
+from .circuit_breaker import CircuitOpenError
+from .stream_flush import ChunkCoalescer, flush_policy
+from .stream_parsers import get_stream_adapter
+from .token_estimator import estimate_usage
+
+TICKET_SALT = 'ai-async-gateway'
+
+
+def issue_stream_ticket(flask_app, ticket_data):
+    """(Flask 路由调用) 为一次已通过校验的生成签发 ticket (带一次性的 nonce，见 AsyncStreamGateway._claim_nonce)。"""
+    serializer = URLSafeTimedSerializer(flask_app.config['SECRET_KEY'], salt=TICKET_SALT)
+    return serializer.dumps({**ticket_data, 'nonce': uuid.uuid4().hex})
+
+
+def load_stream_ticket(flask_app, ticket):
+    """校验并解析 ticket，过期或签名错误时返回 None。"""
+    serializer = URLSafeTimedSerializer(flask_app.config['SECRET_KEY'], salt=TICKET_SALT)
+    try:
+        return serializer.loads(ticket, max_age=flask_app.config.get('AI_ASYNC_GATEWAY_TICKET_TTL', 60))
+    except (BadSignature, SignatureExpired):
+        return None
+
+
+def _reservation_active(flask_app, reservation_id):
+    """(线程池中执行) ticket 中的点数预留是否仍然有效。"""
+    with flask_app.app_context():
+        return reservation_active(reservation_id)
+
+
+def _load_services(flask_app, service_id):
+    """
+    (线程池中执行) 读取 AI 服务配置 (ticket 中不携带 API Key)；服务池会展开成按路由顺序排列的成员列表。
+
+    服务 (或服务池的全部成员) 熔断时抛出 CircuitOpenError.
+    """
+    from .config_cache import get_service
+    with flask_app.app_context():
+        service = get_service(service_id)
+        if not service:
+            return []
+        return [{
+            'api_key': member.api_key,
+            'base_url': member.base_url,
+            'model_name': member.model_name,
+            'service_type': member.service_type,
+            'name': member.name,
+            'id': member.id,
+            'is_system_service': member.is_system_service,
+        } for member in pool_candidates(service)]
+
+
+class AsyncStreamGateway:
+    """最小的 ASGI 应用：POST <prefix>/stream 转发生成流，GET <prefix>/health 健康检查。"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.client = None
+        self.active_streams = 0
+        self._used_nonces = {}  # nonce -> 过期时刻 (ticket 过期后不必再记)
+
+    def _get_client(self):
+        if self.client is None:
+            config = self.flask_app.config
+            max_connections = config.get('AI_ASYNC_GATEWAY_MAX_CONNECTIONS', 500)
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_connections),
+                timeout=httpx.Timeout(180, connect=10),
+            )
+        return self.client
+
+    def _claim_nonce(self, ticket):
+        """
+        ticket 只能使用一次：第一次使用时记下 nonce，有效期内重放同一个 ticket 返回 False。
+
+        重放的 ticket 会以同一个 (可能已结算的) 点数预留、跳过幂等键和准入控制再发起一次上游调用。
+        这里只记在本进程内；多个网关进程时由预留检查兜底 (预留结算或释放后 ticket 即失效)。
+        """
+        nonce = ticket.get('nonce')
+        if not nonce:
+            return False
+        now = time.monotonic()
+        for used, expires_at in list(self._used_nonces.items()):
+            if expires_at <= now:
+                del self._used_nonces[used]
+        if nonce in self._used_nonces:
+            return False
+        self._used_nonces[nonce] = now + self.flask_app.config.get('AI_ASYNC_GATEWAY_TICKET_TTL', 60)
+        return True
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path'].rstrip('/')
+        if scope['method'] == 'POST' and path.endswith('/stream'):
+            await self._handle_stream(receive, send)
+        elif scope['method'] == 'GET' and path.endswith('/health'):
+            await self._send_json(send, 200, {'status': 'ok', 'active_streams': self.active_streams})
+        else:
+            await self._send_json(send, 404, {'error': 'Not found'})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._get_client()
+                # 网关不经过 Flask 的请求处理，计费写入线程在这里启动 (见 app/billing.py init_app)
+                start_billing_writer(self.flask_app)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                return body
+
+    @staticmethod
+    async def _send_json(send, status, data, headers=()):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode()), *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _handle_stream(self, receive, send):
+        try:
+            request_data = json.loads(await self._read_body(receive) or b'{}')
+        except ValueError:
+            await self._send_json(send, 400, {'error': 'Invalid JSON'})
+            return
+        ticket = load_stream_ticket(self.flask_app, request_data.get('ticket', ''))
+        if not ticket:
+            await self._send_json(send, 403, {'error': 'ticket 无效或已过期'})
+            return
+        # 拒绝重放必须在下面的 try 之前：被拒绝的请求不能释放原请求正在使用的预留
+        if not self._claim_nonce(ticket):
+            await self._send_json(send, 403, {'error': 'ticket 已使用'})
+            return
+        if ticket.get('reservation_id'):
+            active = await asyncio.get_running_loop().run_in_executor(
+                None, _reservation_active, self.flask_app, ticket['reservation_id'])
+            if not active:
+                await self._send_json(send, 403, {'error': 'ticket 对应的点数预留已结算或已过期'})
+                return
+
+        billed = False
+        try:
+            admission_ticket = await self._admit(ticket, send)
+            if admission_ticket is None:
+                return
+            try:
+                billed = await self._stream_ticket(ticket, receive, send)
+            finally:
+                admission_ticket.release()
+        finally:
+            if not billed and ticket.get('reservation_id'):
+                # 没有交给计费 (上游失败、未产生内容等)：释放生成前预留的点数，不等待结果
+                asyncio.get_running_loop().run_in_executor(None, release_reservation,
+                                                           ticket['reservation_id'], self.flask_app)
+
+    async def _admit(self, ticket, send):
+        """按 ticket 中的服务键和用户权重申请上游调用名额 (线程池中排队)；被拒绝时返回 429 并返回 None。"""
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, ai_admission.acquire, ticket.get('admission_key', ticket['service_id']), ticket['user_id'],
+                ticket.get('admission_weight', 1.0), ticket.get('admission_members', 1))
+        except AdmissionRejected as e:
+            print(f"[Async Gateway] User {ticket['user_id']}: Rejected by admission control: {e}")
+            await self._send_json(send, 429, e.to_dict(),
+                                  [(b'retry-after', str(max(e.estimated_wait, 1)).encode())])
+            return None
+
+    async def _stream_ticket(self, ticket, receive, send):
+        """转发一次生成流，返回是否已交给计费 (计费时结算 ticket 中的点数预留)。"""
+        loop = asyncio.get_running_loop()
+        try:
+            services = await loop.run_in_executor(None, _load_services, self.flask_app, ticket['service_id'])
+        except CircuitOpenError as e:
+            # 签发 ticket 之后服务才熔断：同样立即失败，不等待连接超时
+            await self._send_json(send, 503, e.to_dict())
+            return False
+        if not services:
+            await self._send_json(send, 404, {'error': 'AI 服务配置未找到'})
+            return False
+
+        final_prompt = ticket['prompt']
+        gen_user_id = ticket['user_id']
+
+        # 客户端断开时 receive() 会返回 http.disconnect
+        disconnected = asyncio.Event()
+        # 正在读取上游流时断开，直接取消本任务：不必等上游下一块数据到达才发现，async with 退出时关闭上游连接
+        handler_task = asyncio.current_task()
+        reading_upstream = False
+
+        async def _watch_disconnect():
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    disconnected.set()
+                    if reading_upstream:
+                        handler_task.cancel()
+                    return False
+
+        watcher = asyncio.create_task(_watch_disconnect())
+        self.active_streams += 1
+        started = False
+        completed = False
+        cancelled = False
+        truncated = False
+        try:
+            # 依次尝试服务池成员 (未加入服务池时只有一个)；开始向客户端输出之前的连接错误 / 429 / 5xx 换下一个
+            for index, service in enumerate(services):
+                has_next = index + 1 < len(services)
+                config_name = f"'{service['name']}'"
+                api_endpoint, payload = build_chat_request(service['service_type'], service['base_url'],
+                                                           service['model_name'], final_prompt, True,
+                                                           ticket.get('messages'),
+                                                           max_tokens_for(ticket.get('target_chars'), self.flask_app.config))
+                if api_endpoint is None:
+                    await self._send_json(send, 400, {'error': f"不支持的服务类型: {service['service_type']}"})
+                    return False
+                headers = {"Content-Type": "application/json"}
+                if service['api_key']: headers["Authorization"] = f"Bearer {service['api_key']}"
+
+                request_started = loop.time()
+                try:
+                    print(f"[Async Gateway] User {gen_user_id}: Calling AI service {config_name}, Endpoint='{api_endpoint}'")
+                    async with self._get_client().stream('POST', api_endpoint, headers=headers, json=payload) as response:
+                        if response.status_code >= 400:
+                            error_text = (await response.aread()).decode('utf-8', errors='replace')
+                            print(f"[Async Gateway] AI service {config_name} returned {response.status_code}: {error_text[:500]}")
+                            record_failure(service['id'], f'HTTP {response.status_code}')
+                            if has_next and is_retryable_status(response.status_code):
+                                print(f"[Async Gateway] User {gen_user_id}: Failing over to next pool member.")
+                                continue
+                            await self._send_json(send, 502, {'error': f'调用 AI 服务时出错 (状态码 {response.status_code})'})
+                            return False
+
+                        await send({'type': 'http.response.start', 'status': 200,
+                                    'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+                        started = True
+                        adapter = get_stream_adapter(service['service_type'], api_endpoint)
+                        governor = LengthGovernor.from_config(ticket.get('target_chars'), self.flask_app.config)
+                        # 合并细碎的增量后再写出；没有定时器，按时间的刷新在每次上游读之后检查
+                        coalescer = ChunkCoalescer(*flush_policy(self.flask_app.config))
+                        first_chunk_at = None
+                        chunks = 0
+                        produced_chunks = []
+                        reading_upstream = True
+                        async for data in response.aiter_bytes():
+                            if disconnected.is_set():
+                                print(f"[Async Gateway] User {gen_user_id}: Client disconnected, aborting upstream stream.")
+                                cancelled = True
+                                break
+                            chunks_in = adapter.feed(data)
+                            for content_chunk in (governor.govern(chunks_in) if governor else chunks_in):
+                                if first_chunk_at is None:
+                                    first_chunk_at = loop.time()
+                                chunks += 1
+                                produced_chunks.append(content_chunk)
+                                text = coalescer.add(content_chunk)
+                                if text:
+                                    await send({'type': 'http.response.body',
+                                                'body': text.encode('utf-8'), 'more_body': True})
+                            if coalescer.due():
+                                await send({'type': 'http.response.body',
+                                            'body': coalescer.flush().encode('utf-8'), 'more_body': True})
+                            if governor is not None and governor.stopped:
+                                # 超出目标字数并到了句子边界：退出 async with 时关闭上游连接
+                                truncated = True
+                                print(f"[Async Gateway] User {gen_user_id}: Output reached the length limit, closing upstream stream.")
+                                break
+                        reading_upstream = False
+                        if cancelled:
+                            break
+                        for content_chunk in ([] if truncated else adapter.close()):
+                            chunks += 1
+                            produced_chunks.append(content_chunk)
+                            coalescer.add(content_chunk)
+                        text = coalescer.flush()
+                        if text:
+                            await send({'type': 'http.response.body',
+                                        'body': text.encode('utf-8'), 'more_body': True})
+                        completed = True
+                        await send({'type': 'http.response.body', 'body': b''})
+                        if first_chunk_at is not None:
+                            elapsed = loop.time() - first_chunk_at
+                            record_success(service['id'], first_chunk_at - request_started,
+                                           (chunks - 1) / elapsed if chunks > 1 and elapsed > 0 else None)
+                        break
+                except asyncio.CancelledError:
+                    if not disconnected.is_set():
+                        raise
+                    # 由 _watch_disconnect 取消：上游连接已随 async with 关闭
+                    if hasattr(handler_task, 'uncancel'):
+                        handler_task.uncancel()
+                    print(f"[Async Gateway] User {gen_user_id}: Client disconnected, aborted upstream stream.")
+                    cancelled = True
+                    break
+                except httpx.HTTPError as e:
+                    print(f"!!! [Async Gateway] User {gen_user_id}: Error streaming from AI service {config_name}: {e}")
+                    record_failure(service['id'], e)
+                    if not started:
+                        if has_next and isinstance(e, httpx.TransportError):
+                            print(f"[Async Gateway] User {gen_user_id}: Failing over to next pool member.")
+                            continue
+                        await self._send_json(send, 502, {'error': f'调用 AI 服务时出错: {e}'})
+                    else:
+                        await send({'type': 'http.response.body', 'body': b''})
+                    return False
+        finally:
+            watcher.cancel()
+            self.active_streams -= 1
+
+        if completed or (cancelled and produced_chunks):
+            # 与同步路径一致：流正常结束，或客户端中途断开时按已生成部分计费 (按实际使用的池成员计费)
+            usage = adapter.usage
+            if (not usage['total'] or truncated) and produced_chunks:
+                # 服务商没有返回 usage (中途断开时通常如此)：用本地估算兜底
+                usage = estimate_usage(final_prompt, ''.join(produced_chunks))
+                print(f"[Async Gateway] User {gen_user_id}: No usage reported by AI service, using local estimate.")
+            total_tokens = usage['total']
+            call_stats = {
+                'prompt_template_id': ticket.get('template_id'),
+                'prompt_tokens': usage['prompt'],
+                'cached_tokens': usage['cached'],
+                'ttft_ms': int((first_chunk_at - request_started) * 1000) if first_chunk_at is not None else None,
+                'status': 'cancelled' if not completed else ('truncated' if truncated else 'completed'),
+            }
+            print(f"[Async Gateway] User {gen_user_id}: Tokens consumed: {total_tokens}. Attempting billing and logging.")
+            await loop.run_in_executor(
+                None, lambda: bill_stream_usage(self.flask_app, gen_user_id, ticket['username'],
+                                                ticket['is_admin'], service, total_tokens, len(final_prompt),
+                                                call_stats=call_stats,
+                                                reservation_id=ticket.get('reservation_id')))
+            return True
+        return False
+
+
+def create_gateway_app():
+    """uvicorn --factory 入口：网关进程不运行定时任务，避免重复发放点数。"""
+    from config import Config
+    from . import create_app
+
+    class GatewayConfig(Config):
+        SCHEDULER_ENABLED = False
+
+    return AsyncStreamGateway(create_app(GatewayConfig))
@@ -0,0 +1,387 @@
+"""
+生成链路端到端基准测试。
+
+在进程内启动模拟 AI 服务 (app/mock_provider.py) 和一个使用临时 SQLite 数据库的
+主站实例 (多线程 WSGI 服务器)，用真实的 HTTP 客户端按给定并发和提示词长度反复调用
+/api/generate-with-template，覆盖 流式 / 非流式 × 模板 / 直接提示词 四种组合。
+
+每个场景统计:
+- ttft_ms                客户端看到的首字延迟
+- server_added_ttft_ms   首字延迟减去模拟服务的首字延迟，即本站自身增加的部分
+- inter_chunk_ms         客户端相邻两次收到数据的间隔
+- total_ms               整个请求的耗时
+- chunks_per_second      每个请求的数据块速率
+- billing                生成路径上的计费耗时，以及后台写入线程的批量提交耗时与 flush 延迟
+                         (app/billing.py 的进程内统计)
+- worker_occupancy       同时占用的 WSGI worker 数 (平均 / 峰值)
+- db_pool                数据库连接的占用时长 (按 endpoint) 与同时占用的连接数峰值 (app/db_pool.py)
+结果写成 JSON (附带当前 git commit)，便于在不同提交之间对比。
+
+运行方式:
+    flask benchmark-generation --concurrency 1,8 --prompt-chars 500,8000 --requests 40 --output bench.json
+
+每个并发客户端使用各自的用户登录，避免被单用户并发上限 (AI_USER_MAX_CONCURRENCY)
+限流；每个请求的提示词带有序号，避免被相同请求合并 (single_flight) 掩盖真实负载。
+"""
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+from .mock_provider import MockProviderSettings, create_mock_provider_app
+
+MODES = ('stream', 'non-stream')
+INPUTS = ('template', 'raw')
+BENCH_PASSWORD = 'benchmark'
+
+BENCH_TEMPLATE = (
+    "你是一位小说写作助手。\n"
+    "【设定】\n@[设定]\n"
+    "【前文】\n@[前文]\n"
+    "【后文】\n@[后文]\n"
+    "请根据以上内容续写，要求：@[提示词]\n"
+    "续写字数：@[字数]"
+)
+
+FILLER_TEXT = (
+    "雨停之后，街道上只剩下积水映着路灯的光。他把外套搭在肩上，沿着河岸慢慢往回走，"
+    "心里反复想着白天那封没有署名的信。"
+)
+
+
+def _filler(chars):
+    repeats = chars // len(FILLER_TEXT) + 1
+    return (FILLER_TEXT * repeats)[:chars]
+
+
+def _summary(values):
+    """p50 / p95 / max / mean (毫秒或速率)，样本为空时返回 None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'p50': round(percentile(50), 3),
+        'p95': round(percentile(95), 3),
+        'max': round(ordered[-1], 3),
+        'mean': round(statistics.fmean(ordered), 3),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class OccupancyMiddleware:
+    """WSGI 中间件：统计同时处理中的请求数 (含流式响应的整个输出过程)。"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.active = 0
+            self.peak = 0
+            self.busy_seconds = 0.0
+
+    def _enter(self):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def _leave(self, started):
+        with self.lock:
+            self.active -= 1
+            self.busy_seconds += time.perf_counter() - started
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        self._enter()
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+        except Exception:
+            self._leave(started)
+            raise
+        # 响应体输出完毕 (或客户端断开) 时 WSGI 服务器会调用 close()
+        return ClosingIterator(iterable, lambda: self._leave(started))
+
+    def snapshot(self, wall_seconds):
+        with self.lock:
+            return {
+                'mean_busy_workers': round(self.busy_seconds / wall_seconds, 3) if wall_seconds > 0 else None,
+                'peak_busy_workers': self.peak,
+            }
+
+
+class _ServerThread:
+    """在后台线程中运行的多线程 WSGI 服务器，端口由系统分配。"""
+
+    def __init__(self, wsgi_app, host='127.0.0.1'):
+        self.server = make_server(host, 0, wsgi_app, threaded=True)
+        self.base_url = f"http://{host}:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def create_benchmark_app(database_uri, **config_overrides):
+    """创建使用独立数据库、不运行定时任务的主站实例 (表结构直接按模型创建)。"""
+    import sqlalchemy
+    from config import Config
+    from . import create_app, db
+    from . import models  # noqa: F401  注册所有模型
+
+    spool_dir = config_overrides.pop('AI_BILLING_SPOOL_DIR', None) or tempfile.mkdtemp(prefix='ainoval-bench-spool-')
+
+    # create_app 启动时会查询 user 表，必须先建表
+    engine = sqlalchemy.create_engine(database_uri)
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_uri
+        SCHEDULER_ENABLED = False
+        AI_ASYNC_GATEWAY_URL = None  # 测量同步流式路径
+        AI_RESULT_CACHE_ENABLED = False
+        AI_HTTP_PREWARM = False
+        AI_BILLING_SPOOL_DIR = spool_dir
+        AI_GENERATION_JOB_WORKERS = 0  # 不测量后台作业，也不与其他进程争抢作业
+
+    for key, value in config_overrides.items():
+        setattr(BenchmarkConfig, key, value)
+    return create_app(BenchmarkConfig)
+
+
+def _create_fixtures(bench_app, mock_base_url, service_type, user_count):
+    """创建测试用户 (非管理员，点数充足，会走计费)、流式/非流式两个 AI 服务和一个模板。"""
+    from . import db
+    from .models import AIService, PromptTemplate, User
+
+    with bench_app.app_context():
+        services = {}
+        for mode, streaming in (('stream', True), ('non-stream', False)):
+            service = AIService(name=f'benchmark-{mode}', service_type=service_type, base_url=mock_base_url,
+                                model_name='mock-model', api_key='mock', is_system_service=True,
+                                enable_streaming=streaming)
+            db.session.add(service)
+            services[mode] = service
+        template = PromptTemplate(name='benchmark-template', template_string=BENCH_TEMPLATE)
+        db.session.add(template)
+        usernames = []
+        for index in range(user_count):
+            user = User(username=f'benchmark{index}', points=10 ** 9)
+            user.password = BENCH_PASSWORD
+            db.session.add(user)
+            usernames.append(user.username)
+        db.session.commit()
+        return {mode: service.id for mode, service in services.items()}, template.id, usernames
+
+
+def _request_body(scenario, index, service_id, template_id):
+    context = _filler(scenario['prompt_chars'])
+    # 提示词带上序号，避免相同请求被合并
+    instruction = f"（第 {index} 次请求）继续写下去，保持原有的语气。"
+    if scenario['input'] == 'template':
+        input_data = {'前文': context, '后文': '', '设定': '', '提示词': instruction, '字数': ''}
+        return {'ai_service_config_id': service_id, 'template_id': template_id, 'input_data': input_data}
+    return {'ai_service_config_id': service_id, 'input_data': {'提示词': f"{context}\n\n{instruction}"}}
+
+
+def _login(base_url, username):
+    session = requests.Session()
+    response = session.post(f"{base_url}/login", data={'username': username, 'password': BENCH_PASSWORD},
+                            allow_redirects=False, timeout=30)
+    if response.status_code != 302:
+        raise RuntimeError(f"benchmark user '{username}' failed to log in (status {response.status_code})")
+    return session
+
+
+def _timed_request(session, url, body, streaming):
+    """发起一次生成请求，返回 (ok, started, chunk_times, finished)。"""
+    started = time.perf_counter()
+    chunk_times = []
+    with session.post(url, json=body, stream=streaming, timeout=300) as response:
+        if streaming:
+            for data in response.iter_content(chunk_size=None):
+                if data:
+                    chunk_times.append(time.perf_counter())
+        else:
+            response.content
+            chunk_times.append(time.perf_counter())
+        ok = response.status_code == 200
+    return ok, started, chunk_times, time.perf_counter()
+
+
+def run_scenario(base_url, sessions, scenario, service_id, template_id, requests_per_scenario,
+                 provider_ttft_ms, occupancy, counter, pool_metrics=None):
+    from .billing import billing_stats, flush_billing, reset_billing_stats
+
+    url = f"{base_url}/api/generate-with-template"
+    streaming = scenario['mode'] == 'stream'
+    samples = {'ttft_ms': [], 'server_added_ttft_ms': [], 'inter_chunk_ms': [],
+               'total_ms': [], 'chunks_per_second': []}
+    errors = []
+    lock = threading.Lock()
+
+    def worker(slot):
+        session = sessions[slot]
+        while True:
+            with lock:
+                if counter['issued'] >= counter['limit']:
+                    return
+                counter['issued'] += 1
+                index = counter['next_index']
+                counter['next_index'] += 1
+            try:
+                ok, started, chunk_times, finished = _timed_request(
+                    session, url, _request_body(scenario, index, service_id, template_id), streaming)
+            except requests.exceptions.RequestException as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                if not ok or not chunk_times:
+                    errors.append('HTTP error or empty response')
+                    continue
+                samples['total_ms'].append((finished - started) * 1000)
+                if streaming:
+                    ttft = (chunk_times[0] - started) * 1000
+                    samples['ttft_ms'].append(ttft)
+                    samples['server_added_ttft_ms'].append(ttft - provider_ttft_ms)
+                    samples['inter_chunk_ms'].extend(
+                        (b - a) * 1000 for a, b in zip(chunk_times, chunk_times[1:]))
+                    duration = chunk_times[-1] - chunk_times[0]
+                    if len(chunk_times) > 1 and duration > 0:
+                        samples['chunks_per_second'].append((len(chunk_times) - 1) / duration)
+
+    counter.update(issued=0, limit=requests_per_scenario)
+    reset_billing_stats()
+    occupancy.reset()
+    if pool_metrics is not None:
+        pool_metrics.reset()
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=scenario['concurrency']) as executor:
+        list(executor.map(worker, range(scenario['concurrency'])))
+    wall_seconds = time.perf_counter() - wall_started
+    # 等后台计费写入提交完，写入耗时与 flush 延迟才完整
+    flush_billing(timeout=60)
+
+    completed = len(samples['total_ms'])
+    return {
+        **scenario,
+        'requests': requests_per_scenario,
+        'completed': completed,
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(completed / wall_seconds, 3) if wall_seconds > 0 else None,
+        **{name: _summary(values) for name, values in samples.items()},
+        'billing': billing_stats(),
+        'worker_occupancy': occupancy.snapshot(wall_seconds),
+        'db_pool': pool_metrics.stats() if pool_metrics is not None else None,
+    }
+
+
+def run_benchmark(concurrency_levels=(1, 8), prompt_sizes=(500, 8000), requests_per_scenario=20,
+                  modes=MODES, inputs=INPUTS, service_type='openai', provider_settings=None,
+                  database_uri=None, output_path=None, config_overrides=None):
+    """
+    运行完整的场景矩阵并返回结果字典；给定 output_path 时同时写成 JSON 文件。
+
+    Args:
+        concurrency_levels: 并发客户端数列表.
+        prompt_sizes: 前文字数列表 (会经过上下文裁剪，超出服务 token 预算的部分被丢弃).
+        requests_per_scenario: 每个场景发出的请求数.
+        modes / inputs: MODES、INPUTS 的子集.
+        service_type: 模拟服务的接入方式 ('openai' 走 /v1/chat/completions，'ollama' 走 /api/chat).
+        provider_settings: MockProviderSettings，默认参数见该类.
+        database_uri: 默认在临时目录创建 SQLite 数据库.
+        config_overrides: 覆盖主站配置 (例如 AI_STREAM_FLUSH_MS)，便于对比参数.
+    """
+    provider_settings = provider_settings or MockProviderSettings()
+    max_concurrency = max(concurrency_levels)
+    config_overrides = dict(config_overrides or {})
+    # 并发上限不应成为瓶颈 (除非显式覆盖)
+    config_overrides.setdefault('AI_SERVICE_MAX_CONCURRENCY', max_concurrency * 2)
+    config_overrides.setdefault('AI_HTTP_POOL_MAXSIZE', max_concurrency * 2)
+
+    temp_dir = None
+    if database_uri is None:
+        temp_dir = tempfile.mkdtemp(prefix='ainoval-bench-')
+        database_uri = f"sqlite:///{os.path.join(temp_dir, 'benchmark.db')}"
+
+    provider = _ServerThread(create_mock_provider_app(provider_settings)).start()
+    bench_app = create_benchmark_app(database_uri, **config_overrides)
+    pool_metrics = bench_app.extensions['db_pool_metrics']
+    occupancy = OccupancyMiddleware(bench_app.wsgi_app)
+    bench_app.wsgi_app = occupancy
+    server = _ServerThread(bench_app).start()
+    print(f"[Benchmark] Mock provider at {provider.base_url}, app at {server.base_url}, database {database_uri}")
+
+    try:
+        service_ids, template_id, usernames = _create_fixtures(bench_app, provider.base_url, service_type,
+                                                               max_concurrency)
+        sessions = [_login(server.base_url, username) for username in usernames]
+        counter = {'next_index': 0}
+
+        # 预热：建立连接池、加载模板，不计入结果
+        warmup = {'mode': 'stream', 'input': 'raw', 'prompt_chars': min(prompt_sizes), 'concurrency': 1}
+        run_scenario(server.base_url, sessions, warmup, service_ids['stream'], template_id, 1,
+                     provider_settings.ttft_ms, occupancy, counter, pool_metrics)
+
+        results = []
+        for mode in modes:
+            for input_kind in inputs:
+                for prompt_chars in prompt_sizes:
+                    for concurrency in concurrency_levels:
+                        scenario = {'mode': mode, 'input': input_kind, 'prompt_chars': prompt_chars,
+                                    'concurrency': concurrency}
+                        print(f"[Benchmark] Running {scenario} ...")
+                        result = run_scenario(server.base_url, sessions, scenario, service_ids[mode], template_id,
+                                              requests_per_scenario, provider_settings.ttft_ms, occupancy, counter,
+                                              pool_metrics)
+                        print(f"[Benchmark]   total p50={(result['total_ms'] or {}).get('p50')} ms, "
+                              f"ttft p50={(result['ttft_ms'] or {}).get('p50')} ms, errors={result['errors']}")
+                        results.append(result)
+    finally:
+        server.stop()
+        provider.stop()
+
+    report = {
+        'generated_at': datetime.utcnow().isoformat() + 'Z',
+        'git_commit': _git_commit(),
+        'service_type': service_type,
+        'requests_per_scenario': requests_per_scenario,
+        'mock_provider': provider_settings.to_dict(),
+        'config_overrides': config_overrides,
+        'scenarios': results,
+    }
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[Benchmark] Results written to {output_path}")
+    return report
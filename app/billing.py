@@ -0,0 +1,247 @@
+"""
+AI 生成计费与调用日志。
+
+流式生成结束后按 token 用量扣除用户点数并写入 ApiCallLog。
+同步路由 (app/api.py 中的 stream_generator) 与异步网关 (app/async_gateway.py)
+共用这里的逻辑，保证两条路径的计费语义一致。
+
+默认 (AI_BILLING_WRITE_BEHIND) 由后台写入线程批量提交 (见 app/billing_writer.py)，
+生成路径只负责把用量事件落盘入队；关闭时、或本进程的写入线程还没启动时 (见 init_app)
+在调用线程中同步提交。
+
+扣点不再修改 User.points，而是追加 usage 流水并结算生成前的预留 (见 app/points_ledger.py)。
+"""
+import atexit
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from . import db
+from .billing_writer import BillingSpool, BillingWriter, TransientBillingError
+from .models import User, ApiCallLog
+from .points_ledger import append_entries, ledger_entry, release_reservation, settle_reservations
+
+TOKENS_PER_POINT = 100
+
+_writer = None  # 未启用 write-behind 或写入线程尚未启动时为 None
+
+# 生成路径上计费调用的耗时统计 (进程内，供基准测试和管理接口查看)
+_stats = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+_stats_lock = threading.Lock()
+
+
+def billing_stats():
+    """生成路径上的计费耗时；启用 write-behind 时附带后台写入线程的统计 ('writer')。"""
+    with _stats_lock:
+        calls = _stats['calls']
+        data = {
+            'calls': calls,
+            'total_ms': round(_stats['seconds'] * 1000, 3),
+            'mean_ms': round(_stats['seconds'] * 1000 / calls, 3) if calls else None,
+            'max_ms': round(_stats['max_seconds'] * 1000, 3),
+        }
+    data['writer'] = _writer.stats() if _writer is not None else None
+    return data
+
+
+def reset_billing_stats():
+    with _stats_lock:
+        _stats.update(calls=0, seconds=0.0, max_seconds=0.0)
+    if _writer is not None:
+        _writer.reset_stats()
+
+
+def flush_billing(timeout=None):
+    """等待后台写入线程把已入队的事件全部提交，未启用 write-behind 时直接返回 True。"""
+    return _writer.flush(timeout) if _writer is not None else True
+
+
+def bill_stream_usage(flask_app, gen_user_id, gen_username, gen_is_admin, service_info,
+                      total_tokens_consumed_stream, prompt_length, call_stats=None, reservation_id=None,
+                      event_id=None):
+    """
+    为一次流式生成扣点并记录日志 (启用 write-behind 时只落盘入队，由后台线程提交)。
+
+    Args:
+        flask_app: Flask 应用实例 (流式响应期间已没有请求上下文).
+        gen_user_id / gen_username / gen_is_admin: 发起生成的用户信息.
+        service_info: {'id', 'name', 'is_system_service'}，所用 AI 服务的信息.
+        total_tokens_consumed_stream: 服务商返回的总 token 数.
+        prompt_length: 最终提示词长度 (字符数).
+        call_stats: 可选，{'prompt_template_id', 'prompt_tokens', 'cached_tokens', 'ttft_ms'}，
+                    写入 ApiCallLog 用于按模板统计提示词缓存命中率与首字延迟.
+        reservation_id: 可选，生成前的点数预留，在写入 usage 流水的同一事务中结算；没有用量时直接释放.
+        event_id: 可选，预先生成的计费事件 ID (SSE 流据此查询扣点后的余额，见 points_ledger.get_balance_after).
+
+    Returns:
+        int: 应扣除的点数 (write-behind 模式下尚未提交).
+    """
+    started = time.perf_counter()
+    try:
+        if total_tokens_consumed_stream <= 0:
+            print(f"User {gen_user_id}: Token usage was 0 or not found. No billing or logging.")
+            release_reservation(reservation_id, flask_app)
+            return 0
+        event = make_usage_event(gen_user_id, gen_username, gen_is_admin, service_info,
+                                 total_tokens_consumed_stream, prompt_length, call_stats, reservation_id, event_id)
+        if _writer is not None:
+            try:
+                _writer.submit(event)
+                print(f"User {gen_user_id}: Queued billing of {event['points']} points for {total_tokens_consumed_stream} tokens. AI: {service_info['name']}")
+                return event['points']
+            except OSError as e:
+                # spool 写不进去 (磁盘满等)：退回同步提交，不丢计费
+                print(f"!!! [Billing] Could not spool billing event for User {gen_user_id}, committing synchronously: {e}")
+        with flask_app.app_context():
+            try:
+                apply_usage_events([event])
+            except Exception as e:
+                print(f"CRITICAL ERROR: Failed to commit billing/logging for User {gen_user_id}: {e}")
+                return 0
+        return event['points']
+    finally:
+        elapsed = time.perf_counter() - started
+        with _stats_lock:
+            _stats['calls'] += 1
+            _stats['seconds'] += elapsed
+            _stats['max_seconds'] = max(_stats['max_seconds'], elapsed)
+
+
+def usage_points(total_tokens, is_admin=False):
+    """一次调用应扣的点数 (管理员不扣点)。"""
+    return 0 if is_admin else total_tokens // TOKENS_PER_POINT
+
+
+def make_usage_event(gen_user_id, gen_username, gen_is_admin, service_info, total_tokens, prompt_length,
+                     call_stats=None, reservation_id=None, event_id=None):
+    """一次调用的用量事件 (可 JSON 序列化，写入 spool)。管理员不扣点，但照常记录日志。"""
+    points = usage_points(total_tokens, gen_is_admin)
+    return {
+        'event_id': event_id or uuid.uuid4().hex,
+        'created_at': time.time(),
+        'user_id': gen_user_id,
+        'username': gen_username,
+        'service_id': service_info['id'],
+        'service_name': service_info['name'],
+        'is_system_service': service_info['is_system_service'],
+        'tokens': total_tokens,
+        'points': points,
+        'prompt_length': prompt_length,
+        'call_stats': call_stats or {},
+        'reservation_id': reservation_id,
+    }
+
+
+_CALL_STAT_COLUMNS = {'prompt_template_id': None, 'prompt_tokens': None, 'cached_tokens': None,
+                      'ttft_ms': None, 'status': 'completed'}
+
+
+def apply_usage_events(events):
+    """
+    (需要 app context) 在一个事务里写入一批用量事件：批量追加 usage 流水、结算对应的预留、
+    批量插入日志行 (不更新 User 行)。已提交过的 event_id 被跳过。
+
+    Raises:
+        TransientBillingError: 数据库暂时不可用 (锁超时、连接断开)，整批应稍后重试.
+    """
+    try:
+        event_ids = [event['event_id'] for event in events]
+        existing = {row[0] for row in db.session.query(ApiCallLog.billing_event_id)
+                    .filter(ApiCallLog.billing_event_id.in_(event_ids))}
+        events = [event for event in events if event['event_id'] not in existing]
+        if not events:
+            return
+
+        deductions = defaultdict(int)
+        for event in events:
+            if event['points'] > 0:
+                deductions[event['user_id']] += event['points']
+        existing_users = {row[0] for row in db.session.query(User.id).filter(User.id.in_(list(deductions)))}
+        missing_users = set(deductions) - existing_users
+        for user_id in missing_users:
+            print(f"CRITICAL ERROR: User {user_id} not found in DB for billing.")
+            del deductions[user_id]
+        append_entries([ledger_entry(event['user_id'], -event['points'], 'usage', event['event_id'])
+                        for event in events if event['points'] > 0 and event['user_id'] in existing_users])
+        settle_reservations([event.get('reservation_id') for event in events])
+
+        rows = []
+        for event in events:
+            call_stats = {key: event['call_stats'].get(key, default) for key, default in _CALL_STAT_COLUMNS.items()}
+            rows.append({
+                'billing_event_id': event['event_id'],
+                'timestamp': datetime.utcfromtimestamp(event['created_at']),
+                'user_id': event['user_id'],
+                'username': event['username'],
+                'ai_service_id': event['service_id'],
+                'ai_service_name': event['service_name'],
+                'is_system_service': event['is_system_service'],
+                'tokens_consumed': event['tokens'],
+                'points_deducted': 0 if event['user_id'] in missing_users else event['points'],
+                'prompt_length': event['prompt_length'],
+                'response_length': None,
+                **call_stats,
+            })
+        db.session.execute(ApiCallLog.__table__.insert(), rows)
+        db.session.commit()
+    except (OperationalError, DBAPIError) as e:
+        db.session.rollback()
+        if isinstance(e, OperationalError) or e.connection_invalidated:
+            raise TransientBillingError(e) from e
+        raise
+    except Exception:
+        db.session.rollback()
+        raise
+    print(f"[Billing] Committed {len(rows)} billing event(s), {sum(deductions.values())} points "
+          f"deducted from {len(deductions)} user(s).")
+
+
+def start_billing_writer(app):
+    """启用 write-behind 时创建 spool 与后台写入线程，并重放上次崩溃遗留的事件；返回写入线程 (未启用时为 None)。"""
+    global _writer
+    if not app.config.get('AI_BILLING_WRITE_BEHIND', True):
+        return None
+
+    def apply_batch(events):
+        with app.app_context():
+            apply_usage_events(events)
+
+    spool_dir = app.config.get('AI_BILLING_SPOOL_DIR') or os.path.join(app.instance_path, 'billing_spool')
+    spool = BillingSpool(spool_dir, fsync=app.config.get('AI_BILLING_SPOOL_FSYNC', True))
+    _writer = BillingWriter(apply_batch, spool,
+                            batch_size=app.config.get('AI_BILLING_BATCH_SIZE', 100),
+                            flush_interval=app.config.get('AI_BILLING_FLUSH_MS', 200) / 1000.0,
+                            stale_seconds=app.config.get('AI_BILLING_SPOOL_STALE_SECONDS', 300))
+    _writer.start()
+    app.extensions['billing_writer'] = _writer
+    # 正常退出时尽量提交完队列 (崩溃时由 spool 兜底)
+    atexit.register(_writer.flush, 5)
+    print(f"[Billing] Write-behind billing enabled (spool: {spool_dir}).")
+    return _writer
+
+
+def init_app(app):
+    """
+    启用 write-behind 时，本进程处理第一个 HTTP 请求时启动后台写入线程 (同 app/generation_jobs.py)。
+
+    flask db upgrade 等 CLI 命令同样会执行 create_app()：这些进程里数据库结构可能还没升级，
+    不能写计费数据，也不能认领其他进程遗留的 spool 段。异步网关和 flask generation-worker
+    不经过 Flask 的请求处理，由它们自己调用 start_billing_writer()。
+    """
+    app.extensions['billing_writer'] = None
+    if not app.config.get('AI_BILLING_WRITE_BEHIND', True):
+        return
+    start_lock = threading.Lock()
+
+    @app.before_request
+    def start_billing_writer_once():
+        if app.extensions['billing_writer'] is not None:
+            return
+        with start_lock:
+            if app.extensions['billing_writer'] is None:
+                start_billing_writer(app)
@@ -0,0 +1,326 @@
+"""
+计费与 ApiCallLog 的后台批量写入 (write-behind)。
+
+原来每个流结束时都在响应生成器里打开 app context、读出用户、改 points、插入一行
+日志再提交；SQLite 下这些提交互相排队，拉长了每个响应的收尾时间。现在生成路径只把
+一条用量事件写进本地 spool 文件 (追加一行 JSON 并 fsync) 后放入队列，立即返回；
+后台线程把队列里的事件攒成批，在一个事务里批量追加扣点流水 (见 app/points_ledger.py)
+并批量插入日志行。
+
+持久性:
+- 事件在入队之前已经写入 spool (instance/billing_spool/billing-<pid>-<token>-<seq>.jsonl)，
+  进程崩溃后遗留的段由任意一个仍在运行 (或下一次启动) 的进程认领并重放
+  (见 BillingSpool.recover，超过 AI_BILLING_SPOOL_STALE_SECONDS 未修改的段视为遗留；
+  数据库长时间不可用时，写入线程每次重试前都会更新本进程段的修改时间，不会被其他进程认领)
+- 每个事件带有唯一的 event_id，写入 ApiCallLog.billing_event_id (唯一索引)，
+  重放时已经提交过的事件会被跳过，不会重复扣点
+- 一个 spool 段里的事件全部提交后该段被删除 (正在写的段被截断)
+- 单独提交也失败的事件 (例如数据约束错误) 写入 billing-failed.jsonl 留待人工处理；
+  数据库暂时不可用时整批留在队列里退避重试
+
+flush 延迟 (事件从入队到提交的耗时)、批大小、提交耗时等统计通过 stats() 暴露
+(管理员接口 /api/admin/billing-writer)。
+"""
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+SEGMENT_PREFIX = 'billing-'
+FAILED_FILE = 'billing-failed.jsonl'
+
+
+class TransientBillingError(Exception):
+    """数据库暂时不可用 (锁超时、连接断开等)，整批稍后重试。"""
+
+
+class BillingSpool:
+    """追加写的 JSON Lines spool，按段记录尚未提交的事件数。"""
+
+    def __init__(self, directory, fsync=True, rotate_bytes=1024 * 1024):
+        self.directory = directory
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self._lock = threading.Lock()
+        self._pending = {}  # 段路径 -> 未提交事件数
+        self._active_path = None
+        self._active_file = None
+        self._seq = 0
+        self._token = uuid.uuid4().hex[:8]  # 同一进程内可能有多个 spool (例如基准测试)
+        os.makedirs(directory, exist_ok=True)
+
+    def _segment_path(self):
+        self._seq += 1
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{os.getpid()}-{self._token}-{self._seq:06d}.jsonl")
+
+    def _open_active(self):
+        self._active_path = self._segment_path()
+        self._active_file = open(self._active_path, 'a', encoding='utf-8')
+        self._pending[self._active_path] = 0
+
+    def append(self, event):
+        """写入一条事件 (fsync 后返回)，返回所在段路径，提交后用它调用 ack。"""
+        line = json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._active_file is None:
+                self._open_active()
+            self._active_file.write(line)
+            self._active_file.flush()
+            if self.fsync:
+                os.fsync(self._active_file.fileno())
+            path = self._active_path
+            self._pending[path] += 1
+            if self._active_file.tell() >= self.rotate_bytes:
+                # 换新段，旧段在最后一个事件提交后删除
+                self._active_file.close()
+                self._active_file = None
+            return path
+
+    def ack(self, paths):
+        """若干事件已提交 (或已转入失败文件)；全部提交的段删除，正在写的段截断。"""
+        with self._lock:
+            for path in paths:
+                if path is None or path not in self._pending:
+                    continue
+                self._pending[path] -= 1
+                if self._pending[path] > 0:
+                    continue
+                if path == self._active_path and self._active_file is not None:
+                    self._active_file.seek(0)
+                    self._active_file.truncate()
+                else:
+                    del self._pending[path]
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"[Billing Writer] Could not remove spool segment {path}: {e}")
+
+    def recover(self, stale_seconds):
+        """
+        认领崩溃遗留的段并返回 [(段路径, 事件), ...]。
+
+        只认领超过 stale_seconds 未修改的非空段 (正在使用的段每次写入都会更新修改时间，
+        空闲时已被截断为空，重试写入期间由 touch() 保持更新)；认领通过 rename 完成，
+        多个进程同时扫描时只有一个能拿到。
+        即使同一事件被重放两次，也会因 event_id 去重而只生效一次。
+        """
+        recovered = []
+        now = time.time()
+        with self._lock:
+            owned = set(self._pending)
+        for name in sorted(os.listdir(self.directory)):
+            if not name.startswith(SEGMENT_PREFIX) or not name.endswith('.jsonl') or name == FAILED_FILE:
+                continue
+            path = os.path.join(self.directory, name)
+            if path in owned:
+                continue
+            try:
+                if os.path.getsize(path) == 0 or now - os.path.getmtime(path) < stale_seconds:
+                    continue
+                with self._lock:
+                    claimed = self._segment_path()
+                os.rename(path, claimed)
+            except OSError:
+                continue  # 已被其他进程认领或仍在使用
+            events = []
+            with open(claimed, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        pass  # 崩溃时写了一半的最后一行
+            if not events:
+                os.remove(claimed)
+                continue
+            with self._lock:
+                self._pending[claimed] = len(events)
+            recovered.extend((claimed, event) for event in events)
+            print(f"[Billing Writer] Recovered {len(events)} unflushed billing event(s) from {name}.")
+        return recovered
+
+    def touch(self):
+        """更新本进程仍有未提交事件的段的修改时间，表示这些段的所有者还活着。"""
+        with self._lock:
+            paths = [path for path, count in self._pending.items() if count > 0]
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError as e:
+                print(f"[Billing Writer] Could not touch spool segment {path}: {e}")
+
+    def write_failed(self, event, error):
+        with self._lock, open(os.path.join(self.directory, FAILED_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'error': str(error), 'event': event}, ensure_ascii=False) + '\n')
+
+    def pending_segments(self):
+        with self._lock:
+            return sum(1 for count in self._pending.values() if count > 0)
+
+
+class BillingWriter:
+    """
+    后台写入线程。
+
+    Args:
+        apply_batch: apply_batch(events) 在一个事务里写入一批事件；数据库暂时不可用时抛出
+                     TransientBillingError，其他异常视为这批数据有问题 (会逐条重试定位).
+        spool: BillingSpool，为 None 时不落盘 (崩溃会丢失队列中的事件).
+        batch_size / flush_interval: 攒到 batch_size 条或第一条事件等待 flush_interval 秒后提交.
+        stale_seconds: 启动时及之后每隔这么久 (空闲时) 扫描一次 spool 目录，重放遗留的段.
+    """
+
+    def __init__(self, apply_batch, spool=None, batch_size=100, flush_interval=0.2, retry_backoff=1.0,
+                 stale_seconds=300):
+        self.apply_batch = apply_batch
+        self.spool = spool
+        self.stale_seconds = stale_seconds
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.retry_backoff = retry_backoff
+        self._queue = queue.Queue()
+        self._idle = threading.Condition()
+        self._unfinished = 0
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {'submitted': 0, 'written': 0, 'failed': 0, 'batches': 0, 'retries': 0,
+                           'latency_seconds': 0.0, 'max_latency_seconds': 0.0,
+                           'commit_seconds': 0.0, 'max_commit_seconds': 0.0, 'max_batch': 0}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='billing-writer', daemon=True)
+        self._thread.start()
+
+    def _put(self, path, event):
+        with self._idle:
+            self._unfinished += 1
+        self._queue.put((path, event, time.monotonic()))
+
+    def submit(self, event):
+        """落盘并入队，立即返回。"""
+        path = self.spool.append(event) if self.spool is not None else None
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+        self._put(path, event)
+
+    def flush(self, timeout=None):
+        """等待队列中的事件全部处理完 (基准测试、进程退出时使用)，超时返回 False。"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._unfinished:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _recover(self):
+        if self.spool is None:
+            return
+        try:
+            for path, event in self.spool.recover(self.stale_seconds):
+                self._put(path, event)
+        except OSError as e:
+            print(f"[Billing Writer] Error scanning spool directory: {e}")
+
+    def _next_batch(self):
+        """攒一批事件；空闲 stale_seconds 秒没有事件时返回 None。"""
+        try:
+            batch = [self._queue.get(timeout=self.stale_seconds)]
+        except queue.Empty:
+            return None
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        self._recover()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                self._recover()
+                continue
+            while not self._write(batch):
+                # 数据库暂时不可用：这批事件留在手里，退避后重试
+                with self._stats_lock:
+                    self._stats['retries'] += 1
+                if self.spool is not None:
+                    # 故障可能持续超过 stale_seconds：保持段的修改时间，别让其他进程当作崩溃遗留认领
+                    self.spool.touch()
+                time.sleep(self.retry_backoff)
+
+    def _write(self, batch):
+        """写入一批事件，返回 False 表示需要整批重试。"""
+        events = [event for _path, event, _queued in batch]
+        started = time.monotonic()
+        try:
+            self.apply_batch(events)
+            failed = []
+        except TransientBillingError as e:
+            print(f"[Billing Writer] Database unavailable, will retry {len(events)} event(s): {e}")
+            return False
+        except Exception as e:
+            print(f"[Billing Writer] Batch of {len(events)} failed ({e}), retrying events one by one.")
+            failed = []
+            for event in events:
+                try:
+                    self.apply_batch([event])
+                except TransientBillingError as retry_error:
+                    print(f"[Billing Writer] Database unavailable, will retry batch: {retry_error}")
+                    return False  # 已成功的事件会因 event_id 去重而被跳过
+                except Exception as event_error:
+                    print(f"CRITICAL ERROR: Billing event {event.get('event_id')} for User {event.get('user_id')} "
+                          f"could not be written: {event_error}")
+                    failed.append(event)
+                    if self.spool is not None:
+                        self.spool.write_failed(event, event_error)
+        finished = time.monotonic()
+
+        if self.spool is not None:
+            self.spool.ack([path for path, _event, _queued in batch])
+        latency = max(finished - queued for _path, _event, queued in batch)
+        with self._stats_lock:
+            stats = self._stats
+            stats['batches'] += 1
+            stats['written'] += len(events) - len(failed)
+            stats['failed'] += len(failed)
+            stats['latency_seconds'] += sum(finished - queued for _path, _event, queued in batch)
+            stats['max_latency_seconds'] = max(stats['max_latency_seconds'], latency)
+            stats['commit_seconds'] += finished - started
+            stats['max_commit_seconds'] = max(stats['max_commit_seconds'], finished - started)
+            stats['max_batch'] = max(stats['max_batch'], len(batch))
+        with self._idle:
+            self._unfinished -= len(batch)
+            if not self._unfinished:
+                self._idle.notify_all()
+        return True
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        processed = stats['written'] + stats['failed']
+        return {
+            'submitted': stats['submitted'],
+            'written': stats['written'],
+            'failed': stats['failed'],
+            'queued': self._queue.qsize(),
+            'batches': stats['batches'],
+            'retries': stats['retries'],
+            'mean_batch': round(processed / stats['batches'], 2) if stats['batches'] else None,
+            'max_batch': stats['max_batch'],
+            'mean_flush_latency_ms': round(stats['latency_seconds'] * 1000 / processed, 3) if processed else None,
+            'max_flush_latency_ms': round(stats['max_latency_seconds'] * 1000, 3),
+            'mean_commit_ms': round(stats['commit_seconds'] * 1000 / stats['batches'], 3) if stats['batches'] else None,
+            'max_commit_ms': round(stats['max_commit_seconds'] * 1000, 3),
+            'spool_pending_segments': self.spool.pending_segments() if self.spool is not None else None,
+        }
@@ -0,0 +1,308 @@
+"""
+从服务端保存的书籍内容组装 前文/后文/设定，代替客户端每次上传整本书。
+
+编辑器原来每次生成都把 Quill 的全部正文按光标切成 前文/后文，再加上全部设定一起放进
+请求体，长篇小说每点一次生成就要上传几 MB。请求改为只带书籍 ID、光标位置和内容版本号:
+
+    {"book_id": 12, "cursor": 35120, "selection_length": 0, "content_version": 7,
+     "text_length": 80211, "anchor": "光标前最多 32 个字",
+     "setting_book_id": 3, "setting_version": 2, "input_data": {"提示词": ..., "字数": 500}}
+
+- FileSystemItem.content_version 在每次保存 content / settings_data 时加一，服务端据此判断
+  客户端的编辑器内容是否已经保存；版本号不一致、text_length 与服务端纯文本长度不一致、
+  或光标前的文字与 anchor 对不上时返回 409 (code: BOOK_CONTEXT_STALE)，客户端改为上传全文
+- 书籍内容保存的是 Quill 的 HTML，这里按 quill.getText() 的规则转成纯文本 (每个块级元素
+  末尾一个换行，图片等嵌入内容不计入)，光标偏移与编辑器一致
+- cursor、selection_length、text_length 与 anchor 都按字符 (code point) 计算，与 Python 的
+  len() 和切片一致；quill 的偏移是 UTF-16 单位，客户端用 Array.from() 换算 (否则含 emoji 等
+  非 BMP 字符的书每次都会 409)
+- 纯文本和设定条目按 (条目 ID, 版本号) 缓存在进程内 (LRU，总字数不超过
+  AI_BOOK_CONTEXT_CACHE_MAX_CHARS)，每次请求只按主键查一次版本号，命中时不读取正文
+- input_data 中已有的 前文/后文/设定 优先 (例如设定还没保存时客户端直接发送设定)；
+  没有 setting_book_id 时使用书籍关联的设定书，只取启用且非空的条目
+
+缓存按 app 保存在 app.extensions['book_context_cache'] 中，统计通过管理员接口
+/api/admin/book-context-cache 查看。
+"""
+import re
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+
+from flask import current_app
+from sqlalchemy import select
+
+from . import db
+from .models import FileSystemItem
+
+# 客户端发送的光标前校验文字的最大长度
+MAX_ANCHOR_CHARS = 64
+
+# Quill 输出的块级元素 (每个块在 getText() 中以一个换行结尾)
+_BLOCK_TAGS = {'p', 'div', 'li', 'blockquote', 'pre', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+_COLLAPSE_RE = re.compile(r'\s\s+')
+_EDGE_RE = re.compile(r'^\s+|\s+$')
+
+
+def _keep_nbsp(match, collapse=True):
+    # 与 Quill 粘贴 HTML 时相同：连续空白压缩成一个空格，但保留其中的 &nbsp;
+    kept = ''.join(char for char in match.group() if char == '\xa0')
+    return kept or (' ' if collapse else '')
+
+
+class BookContextError(Exception):
+    """请求中的书籍上下文参数无效，或客户端内容与服务端不一致。"""
+
+    def __init__(self, message, status=400, code='INVALID_BOOK_CONTEXT', **details):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.details = details
+
+    def to_dict(self):
+        return {'error': str(self), 'code': self.code, **self.details}
+
+
+class _QuillTextParser(HTMLParser):
+    """按 quill.getText() 的规则把编辑器保存的 HTML 转成纯文本。"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self._buffer = []
+        self._line_open = False
+        self._pre_depth = 0
+        self._skip_depth = 0
+
+    def _flush(self):
+        text = ''.join(self._buffer)
+        if not self._pre_depth:
+            text = _EDGE_RE.sub(lambda match: _keep_nbsp(match, collapse=False), text)
+        # 代码块的每一行本身以换行结尾
+        self.lines.append(text if self._pre_depth and text.endswith('\n') else text + '\n')
+        self._buffer = []
+        self._line_open = False
+
+    def handle_starttag(self, tag, attrs):
+        if self._skip_depth:
+            if tag == 'span':
+                self._skip_depth += 1
+            return
+        if tag == 'span' and any(name == 'class' and value and ('ql-cursor' in value or 'ql-ui' in value)
+                                 for name, value in attrs):
+            # 光标占位与列表序号等界面元素，不是正文
+            self._skip_depth = 1
+            return
+        if tag in _BLOCK_TAGS:
+            if self._buffer:
+                self._flush()
+            self._line_open = True
+            if tag == 'pre':
+                self._pre_depth += 1
+
+    def handle_endtag(self, tag):
+        if self._skip_depth:
+            if tag == 'span':
+                self._skip_depth -= 1
+            return
+        if tag in _BLOCK_TAGS:
+            if self._line_open or self._buffer:
+                self._flush()
+            if tag == 'pre':
+                self._pre_depth = max(self._pre_depth - 1, 0)
+
+    def handle_data(self, data):
+        if self._skip_depth:
+            return
+        data = data.replace('\ufeff', '')
+        if not self._pre_depth:
+            data = _COLLAPSE_RE.sub(_keep_nbsp, data.replace('\r\n', ' ').replace('\n', ' '))
+        if data:
+            self._buffer.append(data)
+            self._line_open = True
+
+    def text(self):
+        self.close()
+        if self._buffer or self._line_open:
+            self._flush()
+        text = ''.join(self.lines)
+        # 与 Quill 一致：文档总以换行结尾 (空文档为一个换行)
+        return text if text.endswith('\n') else text + '\n'
+
+
+def html_to_text(content):
+    """把书籍内容 (Quill HTML，旧数据可能是纯文本) 转成与编辑器 getText() 一致的纯文本。"""
+    parser = _QuillTextParser()
+    parser.feed(content or '')
+    return parser.text()
+
+
+def enabled_settings(settings_data):
+    """设定书中启用且非空的条目，格式与编辑器发送的 设定 相同。"""
+    settings = []
+    for entry in settings_data or []:
+        if not isinstance(entry, dict) or not entry.get('enabled', True):
+            continue
+        text = str(entry.get('text') or '').strip()
+        if text:
+            settings.append({'text': text, 'enabled': True})
+    return settings
+
+
+class BookContextCache:
+    """(条目 ID, 版本号) -> 纯文本或设定条目的 LRU 缓存，按总字数限制大小。"""
+
+    def __init__(self, max_chars=50_000_000):
+        self.max_chars = max_chars
+        self._data = OrderedDict()  # item_id -> (version, value, chars)
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, item_id, version, loader):
+        """版本号一致时返回缓存值，否则调用 loader() 加载并替换旧版本。"""
+        with self._lock:
+            entry = self._data.get(item_id)
+            if entry is not None and entry[0] == version:
+                self._data.move_to_end(item_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = loader()
+        chars = len(value) if isinstance(value, str) else sum(len(item['text']) for item in value)
+        if chars > self.max_chars:
+            return value
+        with self._lock:
+            old = self._data.pop(item_id, None)
+            if old is not None:
+                self._chars -= old[2]
+            self._data[item_id] = (version, value, chars)
+            self._chars += chars
+            while self._chars > self.max_chars:
+                _, (_, _, evicted_chars) = self._data.popitem(last=False)
+                self._chars -= evicted_chars
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'chars': self._chars,
+                'max_chars': self.max_chars,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+def get_book_context_cache():
+    return current_app.extensions['book_context_cache']
+
+
+def _parse_int(data, name, required=False, minimum=0):
+    value = data.get(name)
+    if value is None:
+        if required:
+            raise BookContextError(f'缺少 {name}')
+        return None
+    if isinstance(value, bool):
+        raise BookContextError(f'{name} 必须是整数')
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BookContextError(f'{name} 必须是整数')
+    if value < minimum:
+        raise BookContextError(f'{name} 不能小于 {minimum}')
+    return value
+
+
+def _item_header(item_id, user_id, item_type):
+    """按主键只查版本号和关联设定书 (不读取正文)；不存在或不属于该用户时抛出 404。"""
+    row = db.session.execute(
+        select(FileSystemItem.user_id, FileSystemItem.item_type, FileSystemItem.content_version,
+               FileSystemItem.setting_book_id).where(FileSystemItem.id == item_id)
+    ).first()
+    if row is None or row.user_id != user_id or row.item_type != item_type:
+        name = '书籍' if item_type == 'book' else '设定书'
+        raise BookContextError(f'{name} {item_id} 不存在或无权访问', status=404, code='BOOK_NOT_FOUND')
+    return row
+
+
+def _stale(message, **details):
+    return BookContextError(f'{message}，请保存后重试或上传完整内容', status=409, code='BOOK_CONTEXT_STALE', **details)
+
+
+def _load_column(item_id, column):
+    return db.session.execute(select(column).where(FileSystemItem.id == item_id)).scalar()
+
+
+def _book_text(book_id, version):
+    return get_book_context_cache().get(
+        book_id, version, lambda: html_to_text(_load_column(book_id, FileSystemItem.content)))
+
+
+def _setting_entries(setting_book_id, version):
+    return get_book_context_cache().get(
+        setting_book_id, version, lambda: enabled_settings(_load_column(setting_book_id, FileSystemItem.settings_data)))
+
+
+def expand_input_data(data, user_id):
+    """
+    请求带 book_id 时，用服务端保存的内容补全 input_data 中缺少的 前文/后文/设定。
+
+    Args:
+        data: 生成请求体 (见模块说明).
+        user_id: 当前用户 ID，只能读取自己的书籍和设定书.
+
+    Returns:
+        新的 input_data 字典 (请求没有 book_id 时原样复制).
+
+    Raises:
+        BookContextError: 参数无效 (400)、书籍不存在 (404) 或客户端内容不是最新 (409).
+    """
+    input_data = dict(data.get('input_data') or {})
+    if data.get('book_id') is None:
+        return input_data
+
+    book_id = _parse_int(data, 'book_id', required=True, minimum=1)
+    cursor = _parse_int(data, 'cursor', required=True)
+    selection_length = _parse_int(data, 'selection_length') or 0
+    content_version = _parse_int(data, 'content_version', required=True)
+    text_length = _parse_int(data, 'text_length')
+    anchor = data.get('anchor')
+    if anchor is not None and (not isinstance(anchor, str) or len(anchor) > MAX_ANCHOR_CHARS):
+        raise BookContextError(f'anchor 必须是不超过 {MAX_ANCHOR_CHARS} 字的字符串')
+
+    book = _item_header(book_id, user_id, 'book')
+    if book.content_version != content_version:
+        raise _stale('书籍内容已在别处修改或尚未保存', content_version=book.content_version)
+
+    if '前文' not in input_data or '后文' not in input_data:
+        text = _book_text(book_id, book.content_version)
+        if text_length is not None and text_length != len(text):
+            raise _stale('编辑器内容与已保存的内容不一致', content_version=book.content_version)
+        if cursor + selection_length > len(text):
+            raise _stale('光标位置超出已保存的内容', content_version=book.content_version)
+        if anchor and not text[:cursor].endswith(anchor):
+            raise _stale('光标位置与已保存的内容对不上', content_version=book.content_version)
+        input_data.setdefault('前文', text[:cursor])
+        input_data.setdefault('后文', text[cursor + selection_length:])
+
+    if '设定' not in input_data:
+        setting_book_id = (_parse_int(data, 'setting_book_id', minimum=1) if 'setting_book_id' in data
+                           else book.setting_book_id)
+        settings = []
+        if setting_book_id is not None:
+            setting_book = _item_header(setting_book_id, user_id, 'setting')
+            setting_version = _parse_int(data, 'setting_version')
+            if setting_version is not None and setting_version != setting_book.content_version:
+                raise _stale('设定已在别处修改或尚未保存', setting_version=setting_book.content_version)
+            settings = _setting_entries(setting_book_id, setting_book.content_version)
+        input_data['设定'] = [dict(entry) for entry in settings]
+    return input_data
+
+
+def init_app(app):
+    app.extensions['book_context_cache'] = BookContextCache(app.config.get('AI_BOOK_CONTEXT_CACHE_MAX_CHARS', 50_000_000))
@@ -0,0 +1,89 @@
+"""
+多候选生成：一次请求并发生成 N 个版本，供作者直接挑选。
+
+原来的“重试”流程是生成、不满意、带着 @[原回复] 再生成，每一轮都要等完整的
+首字延迟和生成时间。请求体带 "candidates": N (2 ~ AI_MAX_CANDIDATES) 时，
+/api/generate-with-template 并发发起 N 个上游生成 (每个候选各自在服务池内故障
+转移)，用量合并后只计费一次。
+
+不使用 OpenAI 的 n 参数：Ollama 等服务不支持，且 n 个 choice 共用一个流时某个
+choice 出错会拖累全部候选；N 个独立请求对所有服务类型都一样。
+
+流式响应为 NDJSON (application/x-ndjson)，每行一个 JSON 对象:
+
+    {"candidate": 0, "delta": "..."}     候选 0 的一段文本
+    {"candidate": 1, "done": true}       候选 1 生成结束
+    {"candidate": 2, "error": "..."}     候选 2 失败 (不影响其他候选)
+
+非流式响应返回 {"generated_texts": [...]}，失败的候选为 null。
+"""
+import json
+import queue
+import threading
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def parse_candidate_count(value, max_candidates):
+    """把请求中的 candidates 规范为 1 ~ max_candidates 的整数，无效值返回 None。"""
+    if value is None:
+        return 1
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        return None
+    if count < 1:
+        return None
+    return min(count, max(max_candidates, 1))
+
+
+def candidate_line(index, **fields):
+    """一行 NDJSON 帧。"""
+    return json.dumps({'candidate': index, **fields}, ensure_ascii=False) + '\n'
+
+
+def merge_candidate_streams(openers, should_stop=None):
+    """
+    在后台线程中并发消费多个文本流，按到达顺序产出 NDJSON 行。
+
+    Args:
+        openers: 可调用对象列表，在各自的线程中调用，返回该候选的文本迭代器
+                 (打开上游连接、服务池故障转移都在线程里并发进行).
+        should_stop: 可选，返回 True 时各线程停止读取并关闭自己的迭代器.
+
+    Yields:
+        str: candidate_line(...) 格式的行，每个候选最后一行是 done 或 error.
+    """
+    events = queue.Queue()
+
+    def consume(index, opener):
+        iterator = None
+        try:
+            iterator = opener()
+            for chunk in iterator:
+                events.put((index, 'delta', chunk))
+                if should_stop is not None and should_stop():
+                    break
+            events.put((index, 'done', None))
+        except Exception as e:
+            print(f"!!! [Candidates] Candidate {index} failed: {e}")
+            events.put((index, 'error', str(e)))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    for index, opener in enumerate(openers):
+        threading.Thread(target=consume, args=(index, opener), daemon=True).start()
+
+    remaining = len(openers)
+    while remaining:
+        index, kind, value = events.get()
+        if kind == 'delta':
+            yield candidate_line(index, delta=value)
+        elif kind == 'done':
+            remaining -= 1
+            yield candidate_line(index, done=True)
+        else:
+            remaining -= 1
+            yield candidate_line(index, error=value)
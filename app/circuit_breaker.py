@@ -0,0 +1,251 @@
+"""
+按 AIService 的熔断器与后台健康探测。
+
+服务商宕机时，每个生成请求都要在 call_ai_service 里等满连接超时才失败 (流式最长
+180 秒)。现在每个 AIService 有一个熔断器:
+
+- closed    正常；连续失败 AI_CIRCUIT_FAILURE_THRESHOLD 次后转为 open
+- open      不再向它发请求 (服务池里跳过该成员，没有可用成员时路由立即返回 503)；
+            AI_CIRCUIT_OPEN_SECONDS 之后由后台线程做一次轻量探测 (GET base_url，
+            能拿到非 5xx/429 响应即视为可达)，失败则继续 open 并加倍等待时间
+- half_open 探测成功；允许真实请求通过 (服务池里排在 closed 成员之后)，
+            第一次成功转为 closed，失败立即回到 open
+
+失败/成功由 service_router.record_failure / record_success 上报，状态保存在进程内
+(每个 worker 各自判断)，即“缓存的健康状态”；/api/ai-services/available 用它给每个
+服务标注状态，前端据此提示用户换一个服务，而不是等满超时。
+"""
+import threading
+import time
+
+import requests
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+MAX_OPEN_SECONDS = 300  # 探测持续失败时等待时间的上限
+
+# 默认配置，init_app 时会被 app.config 覆盖
+_settings = {
+    'failure_threshold': 3,
+    'open_seconds': 30,
+    'probe_interval': 5,
+    'probe_timeout': 3,
+}
+
+_breakers = {}  # service_id -> Breaker
+_lock = threading.Lock()
+_probe_thread = None
+
+
+class CircuitOpenError(Exception):
+    """服务 (或服务池的全部成员) 处于熔断状态。"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def to_dict(self):
+        return {
+            'error': str(self),
+            'code': 'AI_SERVICE_UNAVAILABLE',
+            'retry_after_seconds': self.retry_after,
+        }
+
+
+class Breaker:
+    def __init__(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_seconds = _settings['open_seconds']
+        self.opened_at = None
+        self.next_probe_at = None
+        self.last_error = None
+        self.last_probe_at = None
+        self.last_probe_result = None
+
+    def open(self, now, backoff=False):
+        if backoff:
+            self.open_seconds = min(self.open_seconds * 2, MAX_OPEN_SECONDS)
+        else:
+            self.open_seconds = _settings['open_seconds']
+        if self.state != OPEN:
+            self.opened_at = now
+        self.state = OPEN
+        self.next_probe_at = now + self.open_seconds
+
+    def retry_after(self, now=None):
+        if self.state != OPEN or self.next_probe_at is None:
+            return 0
+        return max(int(self.next_probe_at - (now or time.time())) + 1, 0)
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'opened_at': self.opened_at,
+            'retry_after_seconds': self.retry_after(),
+            'last_error': self.last_error,
+            'last_probe_at': self.last_probe_at,
+            'last_probe_result': self.last_probe_result,
+        }
+
+
+def _breaker(service_id):
+    breaker = _breakers.get(service_id)
+    if breaker is None:
+        breaker = _breakers[service_id] = Breaker()
+    return breaker
+
+
+def on_success(service_id):
+    with _lock:
+        breaker = _breakers.get(service_id)
+        if breaker is None:
+            return
+        if breaker.state != CLOSED:
+            print(f"[Circuit Breaker] AI service {service_id} recovered, circuit closed.")
+        breaker.state = CLOSED
+        breaker.consecutive_failures = 0
+        breaker.opened_at = None
+        breaker.next_probe_at = None
+
+
+def on_failure(service_id, error):
+    now = time.time()
+    with _lock:
+        breaker = _breaker(service_id)
+        breaker.consecutive_failures += 1
+        breaker.last_error = str(error)[:300]
+        if breaker.state == HALF_OPEN or (
+                breaker.state == CLOSED and breaker.consecutive_failures >= _settings['failure_threshold']):
+            breaker.open(now)
+            print(f"[Circuit Breaker] AI service {service_id} circuit opened after "
+                  f"{breaker.consecutive_failures} consecutive failure(s): {breaker.last_error}")
+
+
+def get_state(service_id):
+    with _lock:
+        breaker = _breakers.get(service_id)
+        return breaker.state if breaker else CLOSED
+
+
+def get_health(service_id):
+    with _lock:
+        breaker = _breakers.get(service_id)
+        return breaker.to_dict() if breaker else Breaker().to_dict()
+
+
+def summarize(service_ids):
+    """
+    一组服务 (单个服务或服务池的全部成员) 的整体状态，用于服务列表标注。
+
+    只要有一个成员不在熔断中就算可用；state 取最好的成员状态 (closed > half_open > open)。
+    """
+    now = time.time()
+    with _lock:
+        breakers = [_breakers.get(service_id) for service_id in service_ids]
+        states = [breaker.state if breaker else CLOSED for breaker in breakers]
+        retry_after = min((breaker.retry_after(now) for breaker in breakers if breaker), default=0)
+    for state in (CLOSED, HALF_OPEN):
+        if state in states:
+            return {'circuit': state, 'available': True, 'retry_after_seconds': 0}
+    return {'circuit': OPEN, 'available': False, 'retry_after_seconds': max(retry_after, 1)}
+
+
+def filter_available(services):
+    """
+    去掉熔断中的服务，half_open 的排到 closed 之后 (排序稳定)。
+
+    Raises:
+        CircuitOpenError: 全部处于熔断状态，附带最早的重新探测时间.
+    """
+    now = time.time()
+    with _lock:
+        states = {service.id: (_breakers[service.id].state if service.id in _breakers else CLOSED)
+                  for service in services}
+        available = [service for service in services if states[service.id] != OPEN]
+        if not available and services:
+            retry_after = min(_breakers[service.id].retry_after(now) for service in services)
+    if not available and services:
+        names = '、'.join(service.name for service in services)
+        raise CircuitOpenError(f"AI 服务 {names} 暂时不可用 (连续调用失败)，请稍后再试或换一个服务。",
+                               max(retry_after, 1))
+    return sorted(available, key=lambda service: states[service.id] == HALF_OPEN)
+
+
+def probe(base_url, api_key=None, timeout=None):
+    """轻量探测：GET base_url，拿到非 5xx / 429 的响应即视为可达。返回 (ok, detail)。"""
+    from .http_pool import get_session
+
+    if not base_url:
+        return False, 'no base_url'
+    headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+    try:
+        response = get_session(base_url).get(base_url, headers=headers, stream=True,
+                                             timeout=timeout or _settings['probe_timeout'])
+        response.close()
+    except requests.exceptions.RequestException as e:
+        return False, str(e)[:300]
+    ok = response.status_code < 500 and response.status_code != 429
+    return ok, f'HTTP {response.status_code}'
+
+
+def probe_due_services(app):
+    """探测所有已到重新探测时间的熔断服务，返回探测数量。"""
+    from .models.ai_service import AIService
+
+    now = time.time()
+    with _lock:
+        due = [service_id for service_id, breaker in _breakers.items()
+               if breaker.state == OPEN and breaker.next_probe_at is not None and now >= breaker.next_probe_at]
+    if not due:
+        return 0
+    with app.app_context():
+        targets = {service.id: (service.base_url, service.api_key)
+                   for service in AIService.query.filter(AIService.id.in_(due)).all()}
+    for service_id in due:
+        base_url, api_key = targets.get(service_id, (None, None))
+        ok, detail = probe(base_url, api_key)
+        now = time.time()
+        with _lock:
+            breaker = _breaker(service_id)
+            if breaker.state != OPEN:
+                continue  # 探测期间已被真实请求的结果改变
+            breaker.last_probe_at = now
+            breaker.last_probe_result = detail
+            if ok:
+                breaker.state = HALF_OPEN
+                print(f"[Circuit Breaker] Probe of AI service {service_id} succeeded ({detail}), circuit half-open.")
+            else:
+                breaker.open(now, backoff=True)
+                print(f"[Circuit Breaker] Probe of AI service {service_id} failed ({detail}), "
+                      f"next probe in {breaker.open_seconds}s.")
+    return len(due)
+
+
+def _probe_loop(app):
+    while True:
+        time.sleep(_settings['probe_interval'])
+        try:
+            probe_due_services(app)
+        except Exception as e:
+            print(f"!!! [Circuit Breaker] Error probing AI services: {e}")
+
+
+def reset():
+    with _lock:
+        _breakers.clear()
+
+
+def init_app(app):
+    """从 app.config 读取熔断配置并启动后台探测线程 (每个进程一个，AI_CIRCUIT_PROBE_INTERVAL 为 0 时不启动)。"""
+    global _probe_thread
+    _settings['failure_threshold'] = max(app.config.get('AI_CIRCUIT_FAILURE_THRESHOLD', _settings['failure_threshold']), 1)
+    _settings['open_seconds'] = app.config.get('AI_CIRCUIT_OPEN_SECONDS', _settings['open_seconds'])
+    _settings['probe_interval'] = app.config.get('AI_CIRCUIT_PROBE_INTERVAL', _settings['probe_interval'])
+    _settings['probe_timeout'] = app.config.get('AI_CIRCUIT_PROBE_TIMEOUT', _settings['probe_timeout'])
+    if _probe_thread is None and _settings['probe_interval'] > 0:
+        _probe_thread = threading.Thread(target=_probe_loop, args=(app,), name='ai-circuit-probe', daemon=True)
+        _probe_thread.start()
@@ -0,0 +1,195 @@
+"""
+AIService / 提示词模板的进程内读穿透缓存，跨 worker 按数据库版本号失效。
+
+每次生成在输出第一个字之前都要查好几次配置：系统默认服务、AIService、服务池成员、
+PromptTemplate；/api/ai-services/available 还要再查两次。这些行只有管理员 (或用户
+管理自己的服务/模板) 时才会变，于是缓存在进程内:
+
+- 缓存的是只读快照 (CachedRow，复制了全部列)，不是 ORM 实例，可以跨请求、跨线程共享，
+  也不会在 session 关闭后触发延迟加载
+- 修改这些表的路由在提交前调用 bump_config_version()，把 AppSettings 中的
+  config_cache_version 加一 (与修改在同一个事务里)，并清空本进程的缓存
+- 其他 worker 最多每 AI_CONFIG_CACHE_CHECK_SECONDS 秒读一次版本号 (一条按主键的查询)，
+  版本变化时整体清空，所以其他进程最多读到这么久的旧配置；设为 0 时每次读缓存前都检查
+- 条目数超过 AI_CONFIG_CACHE_MAX_ENTRIES 时按 LRU 淘汰 (用户自己的模板可能很多)
+
+缓存按 app 保存在 app.extensions['config_cache'] 中 (基准测试会在同一进程里创建另一个 app)。
+命中/未命中计数通过管理员接口 /api/admin/config-cache 查看。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import Integer, String, cast, inspect as sa_inspect, select, update
+
+from . import db
+
+VERSION_KEY = 'config_cache_version'
+_MISSING = object()
+
+
+class CachedRow:
+    """一行数据的只读快照，属性名与模型的列名一致。"""
+
+    def __init__(self, row):
+        for attr in sa_inspect(row).mapper.column_attrs:
+            object.__setattr__(self, attr.key, getattr(row, attr.key))
+        object.__setattr__(self, '_model', type(row).__name__)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{self._model} 快照是只读的')
+
+    def __repr__(self):
+        return f'<Cached {self._model} {getattr(self, "id", None)}>'
+
+
+class ConfigCache:
+    def __init__(self, check_interval=1.0, max_entries=2000):
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._generation = 0  # 每次清空加一，加载期间被清空过的结果不写回
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _read_version(self):
+        from .models import AppSettings
+        # 用独立的连接读完即归还，不让请求 session 因为一次版本检查而一直占着连接 (见 app/db_pool.py)
+        with db.engine.connect() as connection:
+            value = connection.execute(select(AppSettings.value).where(AppSettings.key == VERSION_KEY)).scalar()
+        return value or '0'
+
+    def _check_version(self):
+        now = time.monotonic()
+        if self.check_interval > 0 and now - self._checked_at < self.check_interval:
+            return
+        version = self._read_version()
+        with self._lock:
+            self._checked_at = now
+            if version != self._version:
+                if self._version is not None:
+                    self._clear_locked()
+                self._version = version
+
+    def _clear_locked(self):
+        self._data.clear()
+        self._generation += 1
+        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._clear_locked()
+            self._checked_at = 0.0  # 下次读取时重新检查版本号
+
+    def get(self, key, loader):
+        """读穿透：命中时返回缓存值，否则调用 loader() 加载并缓存 (None 不缓存)。需要在 app context 中调用。"""
+        self._check_version()
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is not _MISSING:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+            generation = self._generation
+        value = loader()
+        if value is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._data[key] = value
+                    while len(self._data) > self.max_entries:
+                        self._data.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'version': self._version,
+                'check_interval_seconds': self.check_interval,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+            }
+
+
+def get_config_cache():
+    return current_app.extensions['config_cache']
+
+
+def _snapshot(row):
+    return CachedRow(row) if row is not None else None
+
+
+def get_service(service_id):
+    """AIService 快照，不存在时返回 None。"""
+    from .models import AIService
+    return get_config_cache().get(('service', service_id), lambda: _snapshot(AIService.query.get(service_id)))
+
+
+def get_default_service():
+    """系统默认 AIService 快照，未配置时返回 None。"""
+    from .models import AIService
+
+    def load():
+        return _snapshot(AIService.query.filter_by(is_default=True, is_system_service=True).first())
+    return get_config_cache().get(('default_service',), load)
+
+
+def get_pool_members(pool_name):
+    """服务池的全部成员快照 (按 ID 排序)。"""
+    from .models import AIService
+
+    def load():
+        return tuple(CachedRow(row) for row in AIService.query.filter_by(is_system_service=True, pool_name=pool_name)
+                     .order_by(AIService.id).all())
+    return list(get_config_cache().get(('pool', pool_name), load))
+
+
+def get_system_services():
+    from .models import AIService
+    return list(get_config_cache().get(('system_services',), lambda: tuple(
+        CachedRow(row) for row in AIService.query.filter_by(is_system_service=True).all())))
+
+
+def get_user_services(owner_id):
+    from .models import AIService
+    return list(get_config_cache().get(('user_services', owner_id), lambda: tuple(
+        CachedRow(row) for row in AIService.query.filter_by(owner_id=owner_id, is_system_service=False).all())))
+
+
+def get_template(template_id):
+    """PromptTemplate 快照，不存在时返回 None。"""
+    from .models import PromptTemplate
+    return get_config_cache().get(('template', template_id), lambda: _snapshot(PromptTemplate.query.get(template_id)))
+
+
+def bump_config_version():
+    """
+    (不提交) AIService / PromptTemplate 被修改：数据库中的版本号加一并清空本进程缓存。
+
+    在修改这些表的路由里、db.session.commit() 之前调用，版本号与修改一起提交；
+    其他 worker 在下一次检查版本号时清空各自的缓存。
+    """
+    from .models import AppSettings
+
+    result = db.session.execute(
+        update(AppSettings).where(AppSettings.key == VERSION_KEY)
+        .values(value=cast(cast(AppSettings.value, Integer) + 1, String)))
+    if result.rowcount == 0:
+        db.session.add(AppSettings(key=VERSION_KEY, value='1'))
+    get_config_cache().clear()
+
+
+def init_app(app):
+    app.extensions['config_cache'] = ConfigCache(
+        check_interval=app.config.get('AI_CONFIG_CACHE_CHECK_SECONDS', 1.0),
+        max_entries=app.config.get('AI_CONFIG_CACHE_MAX_ENTRIES', 2000))
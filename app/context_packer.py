@@ -0,0 +1,216 @@
+"""
+按 token 预算裁剪 前文 / 后文 / 设定。
+
+编辑器会把光标前后的全部正文作为 前文/后文 发送，再加上所有启用的设定条目，
+长篇小说的提示词会无限增长：延迟和费用越来越高，最终超出模型上下文。这里在
+input_data 交给 process_prompt_template 之前做一次裁剪:
+
+- 总预算取 AI 服务的 context_token_budget，未设置时用 AI_CONTEXT_TOKEN_BUDGET (<= 0 表示不裁剪)；
+  两者默认都不裁剪，由管理员按服务或全局开启
+- 预算按 CONTEXT_SHARES 分给三个占位符，用不完的份额再分给仍然超出的占位符
+- 前文保留最靠近光标的末尾部分，后文保留开头部分，都按段落整段保留；
+  最靠近光标的那一段本身就超出预算时，退而按句子裁剪，一句也放不下时按字符截断
+- 设定条目整条保留，按原顺序放入，放不下的整条丢弃
+- 整段/整条保留剩下的预算按 前文、后文、设定 的顺序再分给仍被裁剪的占位符
+
+返回的报告列出每个占位符的原始/保留 token 数和被丢弃的内容量，便于前端提示用户。
+"""
+import re
+
+from .token_estimator import estimate_tokens
+
+# 预算在三个占位符之间的分配比例
+CONTEXT_SHARES = {'前文': 0.6, '后文': 0.15, '设定': 0.25}
+
+_PARAGRAPH_RE = re.compile(r'[^\n]*(?:\n+|$)')
+_SENTENCE_RE = re.compile(r'[^。！？!?…\n]*(?:[。！？!?…]+[”’」』"\']*|\n+|$)')
+
+
+def _split(pattern, text):
+    return [piece for piece in pattern.findall(text) if piece]
+
+
+def _allocate(budget, needs):
+    """按 CONTEXT_SHARES 分配预算；需求小于份额的占位符让出剩余部分。"""
+    allocation = {}
+    pending = {name: need for name, need in needs.items() if need > 0}
+    remaining = budget
+    while pending:
+        total_share = sum(CONTEXT_SHARES[name] for name in pending)
+        satisfied = {name: need for name, need in pending.items()
+                     if need <= remaining * CONTEXT_SHARES[name] / total_share}
+        if not satisfied:
+            for name in pending:
+                allocation[name] = int(remaining * CONTEXT_SHARES[name] / total_share)
+            break
+        for name, need in satisfied.items():
+            allocation[name] = need
+            remaining -= need
+            del pending[name]
+    return allocation
+
+
+def _take_pieces(pieces, budget):
+    """从 pieces 的开头依次放入，直到超出预算。返回 (保留的片段, 已用 token)。"""
+    kept = []
+    used = 0
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if used + tokens > budget:
+            break
+        kept.append(piece)
+        used += tokens
+    return kept, used
+
+
+def _cut_chars(text, budget, keep_end):
+    """按字符裁剪：保留靠近光标的一端，在不超出预算的前提下尽量长 (二分查找截断位置)。"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        piece = text[len(text) - middle:] if keep_end else text[:middle]
+        if estimate_tokens(piece) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[len(text) - low:] if keep_end else text[:low]
+
+
+def trim_text(text, budget, keep_end):
+    """
+    把文本裁剪到 budget 个 token 以内，按段落 (必要时按句子) 整段保留。
+
+    最靠近光标的一段里没有能放进预算的句子时 (例如没有中文句号的英文、没有换行的长段落)，
+    最后按字符保留靠近光标的部分，不会整个丢弃。
+
+    Args:
+        keep_end: True 保留末尾 (前文)，False 保留开头 (后文).
+
+    Returns:
+        (trimmed_text, dropped_paragraphs)
+    """
+    paragraphs = _split(_PARAGRAPH_RE, text)
+    ordered = list(reversed(paragraphs)) if keep_end else paragraphs
+    kept, used = _take_pieces(ordered, budget)
+    if not kept and ordered:
+        # 最靠近光标的一段就超出预算：只保留其中靠近光标的若干句，一句都放不下时按字符截断
+        sentences = _split(_SENTENCE_RE, ordered[0])
+        kept, used = _take_pieces(list(reversed(sentences)) if keep_end else sentences, budget)
+        if kept:
+            kept = [''.join(reversed(kept)) if keep_end else ''.join(kept)]
+        else:
+            cut = _cut_chars(ordered[0], budget, keep_end)
+            kept = [cut] if cut else []
+        dropped = len(paragraphs) - (1 if kept else 0)
+    else:
+        dropped = len(paragraphs) - len(kept)
+    if keep_end:
+        kept.reverse()
+    return ''.join(kept), dropped
+
+
+def _enabled_settings(settings):
+    return [s for s in settings if isinstance(s, dict) and s.get('text') and s.get('enabled', True)]
+
+
+def _pack_settings(settings, budget):
+    """设定条目按原顺序整条放入，返回 (保留的条目, 已用 token, 丢弃条目的文本)。"""
+    kept = []
+    used = 0
+    dropped = []
+    for setting in settings:
+        tokens = estimate_tokens(f"- {setting['text']}\n")
+        if used + tokens <= budget:
+            kept.append(setting)
+            used += tokens
+        else:
+            dropped.append(setting['text'])
+    return kept, used, dropped
+
+
+def pack_context(input_data, budget):
+    """
+    按预算裁剪 input_data 中的 前文/后文/设定。
+
+    Args:
+        input_data: 前端发送的 input_data (不会被修改).
+        budget: 三个占位符合计的 token 预算，None 或 <= 0 表示不裁剪.
+
+    Returns:
+        (packed_input_data, report)；report 为 None 表示没有做任何裁剪.
+    """
+    if not budget or budget <= 0:
+        return input_data, None
+
+    before = input_data.get('前文') or ''
+    after = input_data.get('后文') or ''
+    settings = input_data.get('设定') if isinstance(input_data.get('设定'), list) else []
+    enabled_settings = _enabled_settings(settings)
+
+    needs = {
+        '前文': estimate_tokens(before),
+        '后文': estimate_tokens(after),
+        '设定': sum(estimate_tokens(f"- {s['text']}\n") for s in enabled_settings),
+    }
+    if sum(needs.values()) <= budget:
+        return input_data, None
+
+    allocation = _allocate(budget, needs)
+    texts = {'前文': before, '后文': after}
+    results = {}
+
+    def pack(name, limit):
+        if name == '设定':
+            results[name] = _pack_settings(enabled_settings, limit)
+        elif needs[name] <= limit:
+            results[name] = (texts[name], needs[name], 0)
+        else:
+            trimmed, dropped_paragraphs = trim_text(texts[name], limit, keep_end=(name == '前文'))
+            results[name] = (trimmed, estimate_tokens(trimmed), dropped_paragraphs)
+
+    for name in ('前文', '后文', '设定'):
+        if needs[name] > 0:
+            pack(name, allocation.get(name, 0))
+    # 按段落/句子/条目整段保留会剩下一些预算，按 前文、后文、设定 的顺序再分给仍被裁剪的占位符
+    spare = budget - sum(result[1] for result in results.values())
+    for name in ('前文', '后文', '设定'):
+        if spare <= 0:
+            break
+        if name in results and results[name][1] < needs[name]:
+            used_before = results[name][1]
+            pack(name, used_before + spare)
+            spare -= results[name][1] - used_before
+
+    packed = dict(input_data)
+    report = {'budget': budget, 'placeholders': {}}
+    for name in ('前文', '后文'):
+        if name not in results:
+            continue
+        trimmed, kept_tokens, dropped_paragraphs = results[name]
+        packed[name] = trimmed
+        report['placeholders'][name] = {
+            'original_tokens': needs[name],
+            'kept_tokens': kept_tokens,
+            'dropped_chars': len(texts[name]) - len(trimmed),
+            'dropped_paragraphs': dropped_paragraphs,
+        }
+
+    if '设定' in results:
+        kept_settings, used, dropped_settings = results['设定']
+        packed['设定'] = kept_settings
+        report['placeholders']['设定'] = {
+            'original_tokens': needs['设定'],
+            'kept_tokens': used,
+            'dropped_entries': len(dropped_settings),
+            'dropped_entry_previews': [text[:30] for text in dropped_settings],
+        }
+
+    report['kept_tokens'] = sum(p['kept_tokens'] for p in report['placeholders'].values())
+    return packed, report
+
+
+def resolve_budget(ai_config, app_config):
+    """AI 服务自身的预算优先，其次是全局 AI_CONTEXT_TOKEN_BUDGET。"""
+    if ai_config.context_token_budget is not None:
+        return ai_config.context_token_budget
+    return app_config.get('AI_CONTEXT_TOKEN_BUDGET', 0)
@@ -0,0 +1,132 @@
+"""
+数据库连接池：连接占用 (checkout) 时长统计，以及在长时间调用上游之前归还请求的连接。
+
+请求 session 第一次查询时从连接池取出一个连接，直到 session 提交/关闭才归还。生成路由在
+调用 AI 服务之前做了好几次查询 (可用余额、幂等键……)，如果连接一直跟着请求到生成结束
+(最长 180 秒)，并发生成数就被限制在 pool_size + max_overflow，普通 API 请求也会排队等连接。
+所以:
+
+- 流式响应在返回之前 (第一个 yield 之前)、非流式生成在调用上游之前调用 release_session()，
+  解除 ORM 对象与 session 的关联并把连接还给连接池；之后的计费在自己的 app context 里
+  短暂重新取连接 (app/billing.py)
+- 连接池的 checkout / checkin 事件记录每次占用的时长，按请求的 endpoint 分组 (不在请求中的
+  记为线程名)，管理员通过 /api/admin/db-pool 查看，基准测试结果中的 db_pool 也来自这里
+
+统计按 app 保存在 app.extensions['db_pool_metrics'] 中 (进程内)。
+"""
+import threading
+import time
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+
+from . import db
+
+# 占用时长直方图的上界 (毫秒)，最后一档为超过最大上界的
+HOLD_BUCKETS_MS = (10, 100, 1000, 10000, 60000)
+
+
+class _HoldStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.checkouts += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self):
+        return {
+            'checkouts': self.checkouts,
+            'mean_hold_ms': round(self.seconds * 1000 / self.checkouts, 3) if self.checkouts else None,
+            'max_hold_ms': round(self.max_seconds * 1000, 3),
+        }
+
+
+class PoolMetrics:
+    """连接占用时长统计 (挂在 engine 的连接池事件上)。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.total = _HoldStats()
+            self.by_label = {}
+            self.buckets = [0] * (len(HOLD_BUCKETS_MS) + 1)
+            self.checked_out = 0
+            self.max_checked_out = 0
+
+    def install(self, engine):
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+
+    @staticmethod
+    def _label():
+        if has_request_context():
+            return request.endpoint or 'unmatched'
+        return threading.current_thread().name
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checked_out_at'] = time.perf_counter()
+        connection_record.info['checked_out_by'] = self._label()
+        with self._lock:
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        started = connection_record.info.pop('checked_out_at', None)
+        label = connection_record.info.pop('checked_out_by', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        bucket = next((i for i, bound in enumerate(HOLD_BUCKETS_MS) if seconds * 1000 <= bound), len(HOLD_BUCKETS_MS))
+        with self._lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+            self.total.add(seconds)
+            self.by_label.setdefault(label, _HoldStats()).add(seconds)
+            self.buckets[bucket] += 1
+
+    def stats(self):
+        with self._lock:
+            labels = [f'<={bound}ms' for bound in HOLD_BUCKETS_MS] + [f'>{HOLD_BUCKETS_MS[-1]}ms']
+            return {
+                **self.total.to_dict(),
+                'checked_out': self.checked_out,
+                'max_checked_out': self.max_checked_out,
+                'hold_histogram': dict(zip(labels, self.buckets)),
+                'by_endpoint': {label: stats.to_dict() for label, stats in
+                                sorted(self.by_label.items(), key=lambda item: -item[1].max_seconds)},
+            }
+
+
+def get_pool_metrics(app=None):
+    return (app or current_app).extensions['db_pool_metrics']
+
+
+def pool_status(app=None):
+    """连接池当前状态 (SQLAlchemy Pool.status() 的文本) 与占用时长统计。"""
+    app = app or current_app
+    with app.app_context():
+        status = db.engine.pool.status()
+    return {'pool': status, **get_pool_metrics(app).stats()}
+
+
+def release_session():
+    """
+    (不提交) 结束本请求的 session：回滚未提交的事务并归还连接。
+
+    已加载的 ORM 对象 (包括 current_user) 与 session 脱离，已加载的属性仍可读，
+    但不能再延迟加载，调用前要把需要的值取出来。
+    """
+    db.session.remove()
+
+
+def init_app(app):
+    metrics = PoolMetrics()
+    with app.app_context():
+        metrics.install(db.engine)
+    app.extensions['db_pool_metrics'] = metrics
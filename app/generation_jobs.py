@@ -0,0 +1,487 @@
+"""
+后台生成作业：生成与 HTTP 请求解耦。
+
+流式生成 (/api/generate-with-template) 在整个生成期间占用一个请求和一个 Web worker，
+长篇生成经常被反向代理的超时掐断。作业 API 把两者分开:
+
+- POST /api/generations 只做鉴权、选服务、组装提示词和预留点数，写入一条 queued 的
+  GenerationJob 后立即返回 202 和作业 ID
+- 生成 worker (本模块的线程池，大小 AI_GENERATION_JOB_WORKERS，与 Web worker 分开配置)
+  用条件 UPDATE 认领作业 (queued -> running，多个进程同时认领也只有一个成功)，以流式模式
+  调用 call_ai_service (服务池内故障转移与熔断同同步路由)，计费同 app/billing.py
+- 认领时同样经过准入控制 (app/admission.py)：最早的一批排队作业按用户组权重做加权公平排序
+  (同一用户的第 k 个作业排在 k / 权重)，依次用 try_acquire() 申请名额，服务或用户没有空余名额
+  的作业留在队列里，名额在作业结束时释放
+- 输出写入 replay store (app/single_flight.py)，同一进程内的 GET /api/generations/<id>/stream
+  实时附着；已生成的部分每 AI_GENERATION_JOB_CHECKPOINT_SECONDS 秒写回 GenerationJob.result，
+  其他进程的续传请求从数据库跟读，作业结束后结果保留 AI_GENERATION_JOB_RETENTION_DAYS 天
+- 取消: queued 的作业直接取消；running 的作业设置 cancel_requested，由 worker 在下一次写回时
+  (或同一进程内立即) 中止上游，已生成部分照常计费
+- 进程崩溃遗留的 running 作业超过 AI_GENERATION_JOB_STALE_SECONDS 没有心跳时由定时任务标记
+  为失败并释放预留
+
+可以在 Web 进程里运行 worker (处理第一个 HTTP 请求时启动；flask db upgrade、flask ai-gateway
+等同样会执行 create_app() 的 CLI 命令不会启动)，也可以设 AI_GENERATION_JOB_WORKERS=0 并单独运行:
+    flask generation-worker --workers 8
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import update
+
+from . import db
+from .billing import bill_stream_usage
+from .circuit_breaker import CircuitOpenError
+from .http_pool import abort_response
+from .length_control import LengthGovernor, max_tokens_for
+from .admission import ai_admission, service_slot, user_weight
+from .models import GenerationJob, User
+from .points_ledger import release_reservation
+from .service_router import pool_candidates, pool_members, record_failure, is_retryable_error, timed_stream
+from .single_flight import generation_flights
+
+CLAIM_BATCH = 20  # 每次认领时查看的最早排队作业数 (按权重排序；没有名额或被其他 worker 抢走时尝试下一个)
+
+
+class GenerationJobRunner:
+    """生成 worker 线程池：认领排队的作业并执行。"""
+
+    def __init__(self, app, workers=2, poll_interval=2.0, checkpoint_interval=1.0):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.worker_name = f'{socket.gethostname()}:{os.getpid()}'[:100]
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = {}  # job_id -> 上游响应列表 (同一进程内取消时中止)
+        self._admissions = {}  # job_id -> 认领时拿到的 AdmissionTicket
+        self._cancelled = set()
+        # superseded: 结束时作业已不是 running (已被 recover_stale_jobs 标记为失败)，结果丢弃、不计费
+        self._stats = {'started': 0, 'completed': 0, 'truncated': 0, 'failed': 0, 'cancelled': 0, 'superseded': 0}
+
+    def start(self):
+        self._stopped.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'generation-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"[Generation Jobs] Started {self.workers} generation worker(s) as {self.worker_name}.")
+
+    def stop(self, timeout=None):
+        """停止认领新作业并等待进行中的作业结束。"""
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """有新作业入队，唤醒空闲的 worker (其他进程的 worker 靠轮询发现)。"""
+        self._wakeup.set()
+
+    def cancel(self, job_id):
+        """作业在本进程中运行时立即中止上游，返回是否找到。"""
+        with self._lock:
+            responses = self._running.get(job_id)
+            if responses is None:
+                return False
+            self._cancelled.add(job_id)
+        for response in list(responses):
+            abort_response(response)
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                job_id = self._claim()
+            except Exception as e:
+                print(f"!!! [Generation Jobs] Failed to claim a job: {e}")
+                job_id = None
+            if job_id is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            try:
+                self._execute(job_id)
+            except Exception as e:
+                import traceback
+                print(f"!!! [Generation Jobs] Job {job_id} crashed: {traceback.format_exc()}")
+                self._finish(job_id, 'failed', error=f'生成作业异常: {e}')
+            finally:
+                with self._lock:
+                    admission_ticket = self._admissions.pop(job_id, None)
+                if admission_ticket is not None:
+                    admission_ticket.release()
+
+    def _claim(self):
+        """
+        认领一个排队作业，返回作业 ID；没有可认领 (或都没有准入名额) 的作业时返回 None。
+
+        最早的 CLAIM_BATCH 个作业按加权公平顺序排列：同一用户的第 k 个作业的序号为 k / 权重，
+        序号相同时先到先得，避免一个用户批量提交的作业排在其他用户前面。
+        """
+        from .config_cache import get_service
+        with self.app.app_context():
+            queued = db.session.query(GenerationJob.id, GenerationJob.user_id, GenerationJob.service_id) \
+                .filter_by(status='queued').order_by(GenerationJob.created_at).limit(CLAIM_BATCH).all()
+            if not queued:
+                return None
+            weights = {user.id: user_weight(user)
+                       for user in User.query.filter(User.id.in_({row.user_id for row in queued}))}
+            counts = {}
+            ordered = []
+            for index, row in enumerate(queued):
+                counts[row.user_id] = counts.get(row.user_id, 0) + 1
+                ordered.append((counts[row.user_id] / weights.get(row.user_id, 1.0), index, row))
+            ordered.sort(key=lambda item: item[:2])
+
+            for _, _, row in ordered:
+                service = get_service(row.service_id)
+                admission_ticket = None
+                if service is not None:
+                    # 服务已删除的作业不占名额，认领后由 _execute 标记为失败
+                    admission_key, admission_members = service_slot(service, len(pool_members(service)))
+                    admission_ticket = ai_admission.try_acquire(admission_key, row.user_id,
+                                                                weights.get(row.user_id, 1.0), admission_members)
+                    if admission_ticket is None:
+                        continue
+                now = datetime.utcnow()
+                result = db.session.execute(
+                    update(GenerationJob).where(GenerationJob.id == row.id, GenerationJob.status == 'queued')
+                    .values(status='running', started_at=now, updated_at=now, worker=self.worker_name))
+                db.session.commit()
+                if result.rowcount == 1:
+                    if admission_ticket is not None:
+                        with self._lock:
+                            self._admissions[row.id] = admission_ticket
+                    return row.id
+                if admission_ticket is not None:
+                    admission_ticket.release()
+        return None
+
+    def _load(self, job_id):
+        """读取作业、用户与服务池成员，返回后不再占用数据库连接。"""
+        from .config_cache import get_service
+        with self.app.app_context():
+            job = GenerationJob.query.get(job_id)
+            user = User.query.get(job.user_id) if job else None
+            service = get_service(job.service_id) if job else None
+            if job is None or user is None or service is None:
+                return None, '作业、用户或 AI 服务已不存在'
+            members = [{
+                'config': {
+                    'api_key': member.api_key,
+                    'base_url': member.base_url,
+                    'model_name': member.model_name,
+                    'service_type': member.service_type,
+                    'name': member.name
+                },
+                'billing': {
+                    'id': member.id,
+                    'name': member.name,
+                    'is_system_service': member.is_system_service
+                }
+            } for member in pool_candidates(service)]
+            return {
+                'user_id': user.id,
+                'username': user.username,
+                'is_admin': user.is_admin,
+                'prompt': job.prompt,
+                'messages': job.get_messages(),
+                'template_id': job.template_id,
+                'target_chars': job.target_chars,
+                'reservation_id': job.reservation_id,
+                'members': members,
+            }, None
+
+    def _open_member_stream(self, job_id, spec, token_info, on_response):
+        """依次尝试服务池成员，返回 (记录延迟的流, 所用成员, 发出请求的时刻)。"""
+        from .ai_service import call_ai_service
+
+        members = spec['members']
+        for index, member in enumerate(members):
+            print(f"[Generation Jobs] Job {job_id}: Starting generation with AI service '{member['config']['name']}'.")
+            started_at = time.monotonic()
+            try:
+                raw_iterator = call_ai_service(spec['prompt'], config_details=member['config'], enable_streaming=True,
+                                               token_info=token_info, messages=spec['messages'],
+                                               on_response=on_response,
+                                               max_tokens=max_tokens_for(spec['target_chars'], self.app.config),
+                                               length_governor=LengthGovernor.from_config(spec['target_chars'],
+                                                                                          self.app.config))
+            except Exception as e:
+                record_failure(member['billing']['id'], e)
+                if index + 1 < len(members) and is_retryable_error(e):
+                    print(f"[Generation Jobs] Job {job_id}: AI service '{member['config']['name']}' failed ({e}), failing over to next pool member.")
+                    continue
+                raise
+            return (timed_stream(member['billing']['id'], raw_iterator, started_at, token_info),
+                    member, started_at)
+
+    def _checkpoint(self, job_id, result):
+        """写回已生成的部分并刷新心跳，返回作业是否被请求取消。"""
+        with self.app.app_context():
+            db.session.execute(update(GenerationJob).where(GenerationJob.id == job_id)
+                               .values(result=result, updated_at=datetime.utcnow()))
+            db.session.commit()
+            return bool(db.session.query(GenerationJob.cancel_requested).filter_by(id=job_id).scalar())
+
+    def _finish(self, job_id, status, **values):
+        """
+        把 running 的作业改为结束状态，返回是否成功。
+
+        心跳超时的作业可能已被 recover_stale_jobs 标记为失败并释放了预留，这时返回 False，
+        调用方不能再计费 (预留已释放)，也不能覆盖已有的结束状态。
+        """
+        with self.app.app_context():
+            now = datetime.utcnow()
+            result = db.session.execute(update(GenerationJob)
+                                        .where(GenerationJob.id == job_id, GenerationJob.status == 'running')
+                                        .values(status=status, finished_at=now, updated_at=now, **values))
+            db.session.commit()
+            finished = result.rowcount == 1
+        with self._lock:
+            self._stats[status if finished else 'superseded'] += 1
+        return finished
+
+    def _execute(self, job_id):
+        with self._lock:
+            self._stats['started'] += 1
+        try:
+            spec, error = self._load(job_id)
+        except CircuitOpenError as e:
+            spec, error = None, str(e)
+        if spec is None:
+            print(f"[Generation Jobs] Job {job_id} cannot run: {error}")
+            self._finish(job_id, 'failed', error=error)
+            with self.app.app_context():
+                job = GenerationJob.query.get(job_id)
+                if job is not None:
+                    release_reservation(job.reservation_id)
+            return
+
+        user_id = spec['user_id']
+        shared = generation_flights.open_stream(job_id, user_id)
+        upstream_responses = []
+        with self._lock:
+            self._running[job_id] = upstream_responses
+        token_info = {'total': 0}
+        parts = []
+        billed = False
+        try:
+            try:
+                started_at = time.monotonic()
+                first_chunk_at = None
+                stream_iterator, member, started_at = self._open_member_stream(
+                    job_id, spec, token_info, upstream_responses.append)
+                last_checkpoint = time.monotonic()
+                cancelled = False
+                for chunk in stream_iterator:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.monotonic()
+                    parts.append(chunk)
+                    shared.publish(chunk)
+                    if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                        last_checkpoint = time.monotonic()
+                        if self._checkpoint(job_id, ''.join(parts)):
+                            cancelled = True
+                            break
+                    if job_id in self._cancelled:
+                        cancelled = True
+                        break
+                if cancelled:
+                    print(f"[Generation Jobs] Job {job_id}: Cancelled by user, stopping upstream stream.")
+                    stream_iterator.close()
+                cancelled = cancelled or job_id in self._cancelled
+                if not cancelled and not token_info.get('completed'):
+                    raise RuntimeError(f"AI 服务 '{member['config']['name']}' 的响应异常中断")
+            except Exception as e:
+                print(f"!!! [Generation Jobs] Job {job_id} failed: {e}")
+                self._finish(job_id, 'failed', result=''.join(parts), error=str(e) or '生成失败')
+                shared.finish(e)
+                return
+
+            # 取消时已生成的部分 (按估算的 usage) 照常计费；超出目标字数被截止的记为 truncated
+            if cancelled and not token_info.get('completed'):
+                status = 'cancelled'
+            else:
+                status = 'truncated' if token_info.get('truncated') else 'completed'
+            total_tokens = token_info.get('total', 0)
+            billing_event_id = uuid.uuid4().hex
+            # 先把作业改为结束状态，成功了才计费：作业已被判定为 worker 中断 (预留已释放) 时丢弃结果
+            if not self._finish(job_id, status, result=''.join(parts), tokens=total_tokens,
+                                billing_event_id=billing_event_id):
+                print(f"[Generation Jobs] Job {job_id} was already marked as failed (stale heartbeat), discarding result without billing.")
+                shared.finish(RuntimeError('生成 worker 中断，作业未完成'))
+                return
+            billed = True
+            points = bill_stream_usage(self.app, user_id, spec['username'], spec['is_admin'], member['billing'],
+                                       total_tokens, len(spec['prompt']),
+                                       call_stats={
+                                           'prompt_template_id': spec['template_id'],
+                                           'prompt_tokens': token_info.get('prompt'),
+                                           'cached_tokens': token_info.get('cached'),
+                                           'ttft_ms': int((first_chunk_at - started_at) * 1000) if first_chunk_at else None,
+                                           'status': status
+                                       },
+                                       reservation_id=spec['reservation_id'], event_id=billing_event_id)
+            shared.usage = {'billing_event_id': billing_event_id, 'total_tokens': total_tokens,
+                            'prompt_tokens': token_info.get('prompt'), 'cached_tokens': token_info.get('cached'),
+                            'points': points, 'status': status}
+            with self.app.app_context():
+                db.session.execute(update(GenerationJob).where(GenerationJob.id == job_id).values(points=points))
+                db.session.commit()
+            shared.finish()
+            print(f"[Generation Jobs] Job {job_id} {status}: {shared.chars} chars, {total_tokens} tokens, {points} points.")
+        finally:
+            with self._lock:
+                self._running.pop(job_id, None)
+                self._cancelled.discard(job_id)
+            if not billed:
+                release_reservation(spec['reservation_id'], self.app)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'worker': self.worker_name,
+                'workers': len(self._threads),
+                'running': len(self._running),
+                **self._stats,
+            }
+
+
+def get_runner(app=None):
+    """本进程的作业 runner (AI_GENERATION_JOB_WORKERS 为 0、或 Web 进程还没处理过请求时为 None)。"""
+    return (app or current_app).extensions.get('generation_jobs')
+
+
+def notify_workers():
+    runner = get_runner()
+    if runner is not None:
+        runner.notify()
+
+
+def cancel_job(job):
+    """
+    取消作业并提交，返回取消后的状态。queued 的作业直接取消并释放预留；running 的作业设置
+    cancel_requested，由运行它的 worker 中止 (本进程内立即中止)。
+    """
+    now = datetime.utcnow()
+    result = db.session.execute(update(GenerationJob)
+                                .where(GenerationJob.id == job.id, GenerationJob.status == 'queued')
+                                .values(status='cancelled', cancel_requested=True, finished_at=now, updated_at=now))
+    if result.rowcount == 1:
+        db.session.commit()
+        release_reservation(job.reservation_id)
+        return 'cancelled'
+    db.session.execute(update(GenerationJob)
+                       .where(GenerationJob.id == job.id, GenerationJob.status == 'running')
+                       .values(cancel_requested=True))
+    db.session.commit()
+    runner = get_runner()
+    if runner is not None:
+        runner.cancel(job.id)
+    db.session.refresh(job)
+    return job.status
+
+
+def tail_job_result(flask_app, job_id, offset=0, poll_interval=1.0, idle_timeout=None):
+    """
+    从数据库跟读作业的输出 (作业在其他进程中运行，或已不在 replay store 中)：产出 offset 之后的文本，
+    作业结束时返回；失败时在结尾抛出异常。idle_timeout 同 SharedStream.subscribe (产出 None 作为心跳)。
+    """
+    idle_deadline = time.monotonic() + idle_timeout if idle_timeout else None
+    while True:
+        with flask_app.app_context():
+            row = db.session.query(GenerationJob.status, GenerationJob.result, GenerationJob.error) \
+                .filter_by(id=job_id).first()
+        if row is None:
+            raise RuntimeError('生成作业已被删除')
+        status, result, error = row
+        text = (result or '')[offset:]
+        if text:
+            offset += len(text)
+            yield text
+            if idle_deadline is not None:
+                idle_deadline = time.monotonic() + idle_timeout
+        if status in GenerationJob.TERMINAL_STATUSES:
+            if status == 'failed':
+                raise RuntimeError(error or '生成失败')
+            return
+        if idle_deadline is not None and time.monotonic() >= idle_deadline:
+            yield None
+            idle_deadline = time.monotonic() + idle_timeout
+        time.sleep(poll_interval)
+
+
+def recover_stale_jobs(app):
+    """
+    (定时任务) 把心跳超时的 running 作业 (所在进程已崩溃) 标记为失败并释放预留，
+    并删除结束超过 AI_GENERATION_JOB_RETENTION_DAYS 天的作业。
+    """
+    with app.app_context():
+        try:
+            now = datetime.utcnow()
+            stale_before = now - timedelta(seconds=app.config.get('AI_GENERATION_JOB_STALE_SECONDS', 600))
+            stale = GenerationJob.query.filter(GenerationJob.status == 'running',
+                                               GenerationJob.updated_at < stale_before).all()
+            recovered = 0
+            for job in stale:
+                result = db.session.execute(
+                    update(GenerationJob)
+                    .where(GenerationJob.id == job.id, GenerationJob.status == 'running',
+                           GenerationJob.updated_at == job.updated_at)
+                    .values(status='failed', error='生成 worker 中断，作业未完成', finished_at=now, updated_at=now))
+                if result.rowcount == 1:
+                    recovered += 1
+                    if job.reservation_id:
+                        release_reservation(job.reservation_id)
+            purge_before = now - timedelta(days=app.config.get('AI_GENERATION_JOB_RETENTION_DAYS', 7))
+            purged = GenerationJob.query.filter(GenerationJob.status.in_(GenerationJob.TERMINAL_STATUSES),
+                                                GenerationJob.finished_at < purge_before) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            if recovered or purged:
+                print(f"[Generation Jobs] Marked {recovered} stale job(s) as failed, purged {purged} old job(s).")
+        except Exception as e:
+            db.session.rollback()
+            print(f"!!! [Generation Jobs] Error recovering stale jobs: {e}")
+
+
+def start_runner(app, workers):
+    runner = GenerationJobRunner(app, workers=workers,
+                                 poll_interval=app.config.get('AI_GENERATION_JOB_POLL_SECONDS', 2.0),
+                                 checkpoint_interval=app.config.get('AI_GENERATION_JOB_CHECKPOINT_SECONDS', 1.0))
+    app.extensions['generation_jobs'] = runner
+    runner.start()
+    return runner
+
+
+def init_app(app):
+    """
+    AI_GENERATION_JOB_WORKERS > 0 时，本进程处理第一个 HTTP 请求时启动生成 worker。
+
+    run.py 导入时就会 create_app()，flask db upgrade、flask ai-gateway 等 CLI 命令也会执行到这里；
+    这些进程不处理请求，不能启动认领作业的 worker。单独的 worker 进程由 flask generation-worker 启动。
+    """
+    app.extensions['generation_jobs'] = None
+    workers = app.config.get('AI_GENERATION_JOB_WORKERS', 2)
+    if workers <= 0:
+        return
+    start_lock = threading.Lock()
+
+    @app.before_request
+    def start_generation_workers():
+        if app.extensions['generation_jobs'] is not None:
+            return
+        with start_lock:
+            if app.extensions['generation_jobs'] is None:
+                start_runner(app, workers)
@@ -0,0 +1,173 @@
+"""
+AI 服务 HTTP 连接池注册表。
+
+call_ai_service 之前每次都用模块级 requests.post 发起请求，每次生成都要重新做
+TCP+TLS 握手。这里按 base_url 维护一组长连接的 requests.Session（带可配置大小的
+HTTPAdapter 连接池），流式与非流式调用共用，空闲过久的连接池会被回收。
+
+注意：流式生成器运行时通常已经没有 app context，所以配置在 init_app 时
+拷贝到模块级变量中，运行期不依赖 current_app。
+"""
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 默认配置，init_app 时会被 app.config 覆盖
+_settings = {
+    'pool_connections': 4,   # 每个 Session 缓存的 host 连接池数量
+    'pool_maxsize': 20,      # 每个 host 连接池的最大连接数 (约等于单个服务的最大并发)
+    'idle_seconds': 300,     # 连接池空闲超过该秒数后被回收
+}
+
+_pools = {}  # pool_key -> {'session': Session, 'last_used': float, 'requests': int}
+_lock = threading.Lock()
+_last_eviction = 0.0
+_EVICTION_INTERVAL = 60  # 惰性回收的最小间隔 (秒)
+
+
+def _pool_key(base_url):
+    """连接池按 base_url 区分 (忽略末尾的 '/')。"""
+    return (base_url or '').strip().rstrip('/')
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=_settings['pool_connections'],
+        pool_maxsize=_settings['pool_maxsize'],
+        max_retries=0,  # 不自动重试，避免重复计费
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(base_url):
+    """获取 (或创建) base_url 对应的共享 Session。"""
+    key = _pool_key(base_url)
+    now = time.time()
+    with _lock:
+        entry = _pools.get(key)
+        if entry is None:
+            entry = {'session': _new_session(), 'last_used': now, 'requests': 0}
+            _pools[key] = entry
+            print(f"[HTTP Pool] Created connection pool for '{key}' (maxsize={_settings['pool_maxsize']})")
+        entry['last_used'] = now
+        entry['requests'] += 1
+        session = entry['session']
+
+    # 顺带回收其他空闲连接池 (限频)
+    if now - _last_eviction > _EVICTION_INTERVAL:
+        evict_idle_sessions(now)
+    return session
+
+
+def evict_idle_sessions(now=None):
+    """关闭并移除空闲时间超过 idle_seconds 的连接池，返回回收数量。"""
+    global _last_eviction
+    now = now or time.time()
+    expired = []
+    with _lock:
+        _last_eviction = now
+        for key, entry in list(_pools.items()):
+            if now - entry['last_used'] > _settings['idle_seconds']:
+                expired.append((key, _pools.pop(key)))
+    for key, entry in expired:
+        try:
+            entry['session'].close()
+        except Exception as e:
+            print(f"[HTTP Pool] Error closing idle pool '{key}': {e}")
+    if expired:
+        print(f"[HTTP Pool] Evicted {len(expired)} idle connection pool(s).")
+    return len(expired)
+
+
+def close_all_sessions():
+    """关闭所有连接池 (进程退出或测试时使用)。"""
+    with _lock:
+        entries = list(_pools.values())
+        _pools.clear()
+    for entry in entries:
+        try:
+            entry['session'].close()
+        except Exception:
+            pass
+
+
+def abort_response(response):
+    """
+    (可在其他线程中调用) 中止一个正在读取的流式响应，用于客户端断开后停止上游生成。
+
+    读线程可能阻塞在 socket 读上，此时只 close() 不一定能唤醒它；这里对底层 socket 做
+    shutdown，读线程随即收到连接错误，由它自己的 finally 关闭响应 (该连接不会再被复用)。
+    """
+    connection = getattr(getattr(response, 'raw', None), '_connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        # 拿不到底层 socket (例如连接已归还)，退回到直接关闭
+        response.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # 连接已经断开
+
+
+def pool_stats():
+    """返回各连接池的使用情况，便于调试/管理页面展示。"""
+    now = time.time()
+    with _lock:
+        return [
+            {
+                'base_url': key,
+                'requests': entry['requests'],
+                'idle_seconds': round(now - entry['last_used'], 1),
+            }
+            for key, entry in _pools.items()
+        ]
+
+
+def prewarm(base_url, timeout=5):
+    """
+    预先建立到 base_url 的连接 (完成 TCP+TLS 握手)，使第一次生成不必等待握手。
+    任何 HTTP 状态码都算成功，只要连接建立即可；失败时仅打印日志。
+    """
+    if not base_url:
+        return False
+    try:
+        response = get_session(base_url).get(base_url, timeout=timeout, stream=True)
+        response.close()
+        print(f"[HTTP Pool] Prewarmed connection to '{_pool_key(base_url)}' (status {response.status_code})")
+        return True
+    except requests.exceptions.RequestException as e:
+        print(f"[HTTP Pool] Prewarm failed for '{_pool_key(base_url)}': {e}")
+        return False
+
+
+def init_app(app):
+    """从 app.config 读取连接池配置，并按需在后台预热默认系统服务的连接。"""
+    _settings['pool_connections'] = app.config.get('AI_HTTP_POOL_CONNECTIONS', _settings['pool_connections'])
+    _settings['pool_maxsize'] = app.config.get('AI_HTTP_POOL_MAXSIZE', _settings['pool_maxsize'])
+    _settings['idle_seconds'] = app.config.get('AI_HTTP_POOL_IDLE_SECONDS', _settings['idle_seconds'])
+
+    if not app.config.get('AI_HTTP_PREWARM', False):
+        return
+
+    base_url = None
+    try:
+        with app.app_context():
+            from .models.ai_service import AIService
+            default_service = AIService.query.filter_by(is_default=True, is_system_service=True).first()
+            if default_service:
+                base_url = default_service.base_url
+    except Exception as e:
+        # 数据库尚未迁移等情况下不影响启动
+        print(f"[HTTP Pool] Skipping prewarm, could not load default AI service: {e}")
+        return
+
+    if base_url:
+        # 在后台线程中预热，避免阻塞应用启动
+        threading.Thread(target=prewarm, args=(base_url,), daemon=True).start()
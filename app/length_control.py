@@ -0,0 +1,104 @@
+"""
+按目标字数控制生成长度。
+
+模板里写着“续写约 @[字数] 字”，但请求里没有 max_tokens，模型经常大幅超出，多出来的部分
+既耗 token 又拖慢生成。模板使用了 @[字数] 占位符时:
+
+- max_tokens 上限: 目标字数 × AI_LENGTH_MAX_TOKENS_FACTOR 按本地估算的每字 token 数
+  (app/token_estimator.py) 换算，不低于 AI_LENGTH_MIN_MAX_TOKENS；点数预留也按它估算输出
+- 长度调节器 (LengthGovernor，默认关闭，AI_LENGTH_GOVERNOR_MULTIPLE > 0 时启用): 流式输出超过
+  目标字数 × 倍数 之后，在下一个句子边界处截止并立即关闭上游连接，只按已生成的部分
+  计费 (ApiCallLog.status 记为 truncated)；超出后 AI_LENGTH_GOVERNOR_GRACE_CHARS 字内
+  仍没有句子边界时直接截止
+
+max_tokens 是服务商侧的硬上限 (可能截在句子中间)，调节器通常在它之前、在句末停下。
+"""
+import re
+
+from .token_estimator import chars_to_tokens
+
+LENGTH_PLACEHOLDER = '@[字数]'
+SENTENCE_TERMINALS = '。！？!?…\n'
+CLOSING_MARKS = '”’」』）)"\''
+_NUMBER_RE = re.compile(r'(\d+(?:\.\d+)?)\s*([千kK万wW])?')
+# 千位分隔符 (半角或全角逗号，后面正好跟三位数字)，例如 "1,000"、"1，000字"
+_THOUSANDS_SEP_RE = re.compile(r'(?<=\d)[,，](?=\d{3}(?!\d))')
+_UNITS = {'千': 1000, 'k': 1000, 'K': 1000, '万': 10000, 'w': 10000, 'W': 10000}
+
+
+def parse_target_chars(value):
+    """把 字数 输入 (500、"约1000字"、"1,000"、"800-1200"、"2千字") 解析为目标字数，范围取上限；无法解析时返回 None。"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value) if value > 0 else None
+    numbers = [float(number) * _UNITS.get(unit, 1) for number, unit in _NUMBER_RE.findall(_THOUSANDS_SEP_RE.sub('', str(value)))]
+    target = int(max(numbers)) if numbers else 0
+    return target if target > 0 else None
+
+
+def requested_length(template, input_data):
+    """模板使用了 @[字数] 时返回请求的目标字数，否则 (或未填写) 返回 None。"""
+    if template is None or LENGTH_PLACEHOLDER not in (template.template_string or ''):
+        return None
+    return parse_target_chars((input_data or {}).get('字数'))
+
+
+def max_tokens_for(target_chars, config):
+    """目标字数对应的 max_tokens 上限；没有目标字数或 AI_LENGTH_MAX_TOKENS_FACTOR <= 0 时返回 None。"""
+    factor = config.get('AI_LENGTH_MAX_TOKENS_FACTOR', 2.0)
+    if not target_chars or factor <= 0:
+        return None
+    return max(config.get('AI_LENGTH_MIN_MAX_TOKENS', 256), chars_to_tokens(target_chars * factor))
+
+
+def find_sentence_end(text, start=0):
+    """text[start:] 中第一个句子边界之后的位置 (包括紧跟的右引号/括号)，没有时返回 None。"""
+    for index in range(start, len(text)):
+        if text[index] in SENTENCE_TERMINALS:
+            end = index + 1
+            while end < len(text) and text[end] in CLOSING_MARKS:
+                end += 1
+            return end
+    return None
+
+
+class LengthGovernor:
+    """流式输出的长度调节器：每次上游调用一个实例 (故障转移、多候选各自新建)。"""
+
+    def __init__(self, limit_chars, grace_chars=200):
+        self.limit_chars = limit_chars
+        self.grace_chars = grace_chars
+        self.chars = 0
+        self.stopped = False
+
+    @classmethod
+    def from_config(cls, target_chars, config):
+        """按配置创建调节器；没有目标字数或 AI_LENGTH_GOVERNOR_MULTIPLE <= 0 时返回 None。"""
+        multiple = config.get('AI_LENGTH_GOVERNOR_MULTIPLE', 0)
+        if not target_chars or multiple <= 0:
+            return None
+        return cls(int(target_chars * multiple), config.get('AI_LENGTH_GOVERNOR_GRACE_CHARS', 200))
+
+    def feed(self, chunk):
+        """返回 chunk 中应输出的部分；截止之后 stopped 为 True，后续内容全部丢弃 (返回空串)。"""
+        if self.stopped:
+            return ''
+        start = self.chars
+        self.chars += len(chunk)
+        if self.chars <= self.limit_chars:
+            return chunk
+        # 只在超过上限的部分里找句子边界
+        search_from = max(self.limit_chars - start, 0)
+        cut = find_sentence_end(chunk, search_from)
+        if cut is None:
+            if self.chars - self.limit_chars < self.grace_chars:
+                return chunk
+            cut = max(self.limit_chars + self.grace_chars - start, search_from)
+        self.stopped = True
+        self.chars = start + cut
+        return chunk[:cut]
+
+    def govern(self, chunks):
+        """对解析器一次产出的多个文本块逐个 feed，去掉被截掉的空块。"""
+        return [text for text in map(self.feed, chunks) if text]
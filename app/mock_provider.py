@@ -0,0 +1,244 @@
+"""
+本地模拟 AI 服务 (OpenAI 兼容 + Ollama 原生)，用于压测和延迟测试，不消耗真实服务商额度。
+
+支持的接口:
+- POST /v1/chat/completions  OpenAI 兼容；stream=true 时返回 SSE，stream_options.include_usage
+                             为 true 时在 [DONE] 之前发送只含 usage 的帧
+- POST /api/chat             Ollama 原生；默认流式 NDJSON，最后一帧 done=true 带 prompt_eval_count / eval_count
+- GET  /health, GET /stats   健康检查与请求计数
+
+可调参数 (见 MockProviderSettings): 首字延迟、每秒 token 数、每块字数、输出长度、
+错误率与错误状态码、流中途断开的概率、是否报告 usage、是否模拟提示词前缀缓存
+(同一 system 消息第二次出现时在 usage.prompt_tokens_details.cached_tokens 中报告)。
+
+运行方式:
+    flask mock-ai-provider --port 5002 --ttft-ms 400 --tokens-per-second 40
+然后把 AIService.base_url 设为 http://127.0.0.1:5002 (service_type 选 openai / custom_openai_compatible；
+选 ollama 且 base_url 不含 /v1 时走 /api/chat)。基准测试 (app/benchmark.py) 会在进程内启动它。
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Flask, Response, jsonify, request
+
+from .token_estimator import estimate_tokens
+
+SAMPLE_TEXT = (
+    "夜色渐深，城墙上的灯火一盏接一盏地亮了起来。她握紧手中的信，迟迟没有拆开，"
+    "仿佛只要不看，那个消息就不会成真。远处传来马蹄声，由远及近，最终停在了门外。"
+)
+
+
+class MockProviderSettings:
+    """模拟服务的行为参数。"""
+
+    def __init__(self, ttft_ms=300, tokens_per_second=50.0, chunk_chars=2, completion_tokens=200,
+                 error_rate=0.0, error_status=500, disconnect_rate=0.0, report_usage=True,
+                 prefix_cache=True, seed=None):
+        self.ttft_ms = ttft_ms                      # 首字延迟 (毫秒)
+        self.tokens_per_second = tokens_per_second  # 输出速度 (按 1 字 = 1 token)
+        self.chunk_chars = chunk_chars              # 每个流式块的字数
+        self.completion_tokens = completion_tokens  # 请求没有 max_tokens 时的输出长度
+        self.error_rate = error_rate                # 直接返回错误状态码的概率
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate      # 流式输出中途断开连接的概率
+        self.report_usage = report_usage
+        self.prefix_cache = prefix_cache
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class MockDisconnect(Exception):
+    """在流中途抛出，让 WSGI 服务器直接断开连接 (模拟服务商掉线)。"""
+
+
+class _MockState:
+    def __init__(self, settings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.lock = threading.Lock()
+        self.seen_prefixes = OrderedDict()  # system 消息摘要，模拟服务商的前缀缓存
+        self.counters = {'requests': 0, 'streams': 0, 'active_streams': 0,
+                         'errors': 0, 'disconnects': 0, 'completion_tokens': 0}
+
+    def roll(self, probability):
+        with self.lock:
+            return probability > 0 and self.random.random() < probability
+
+    def count(self, name, delta=1):
+        with self.lock:
+            self.counters[name] += delta
+
+    def cached_tokens(self, messages):
+        """同一 system 消息再次出现时视为命中前缀缓存，返回其 token 数。"""
+        if not self.settings.prefix_cache or not messages or messages[0].get('role') != 'system':
+            return 0
+        system_content = messages[0].get('content') or ''
+        digest = hashlib.blake2b(system_content.encode('utf-8'), digest_size=16).digest()
+        with self.lock:
+            hit = digest in self.seen_prefixes
+            self.seen_prefixes[digest] = True
+            self.seen_prefixes.move_to_end(digest)
+            while len(self.seen_prefixes) > 1024:
+                self.seen_prefixes.popitem(last=False)
+        return estimate_tokens(system_content) if hit else 0
+
+
+def _completion_text(length):
+    repeats = length // len(SAMPLE_TEXT) + 1
+    return (SAMPLE_TEXT * repeats)[:length]
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _usage(state, messages, completion_tokens):
+    prompt_tokens = sum(estimate_tokens(message.get('content') or '') for message in messages)
+    usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+             'total_tokens': prompt_tokens + completion_tokens}
+    cached = state.cached_tokens(messages)
+    if state.settings.prefix_cache:
+        usage['prompt_tokens_details'] = {'cached_tokens': cached}
+    return usage
+
+
+def _paced_chunks(state, chunks):
+    """按首字延迟和输出速度产出文本块，按断开概率在中途抛出 MockDisconnect。"""
+    settings = state.settings
+    disconnect_at = None
+    if chunks and state.roll(settings.disconnect_rate):
+        disconnect_at = state.random.randrange(len(chunks))
+    interval = settings.chunk_chars / settings.tokens_per_second if settings.tokens_per_second > 0 else 0
+    time.sleep(settings.ttft_ms / 1000.0)
+    for index, chunk in enumerate(chunks):
+        if index == disconnect_at:
+            state.count('disconnects')
+            raise MockDisconnect(f'mock provider disconnected after {index} chunks')
+        if index and interval:
+            time.sleep(interval)
+        yield chunk
+
+
+def create_mock_provider_app(settings=None):
+    """创建模拟服务的 Flask 应用 (独立于主站，不连接数据库)。"""
+    settings = settings or MockProviderSettings()
+    state = _MockState(settings)
+    app = Flask(__name__)
+    app.config['MOCK_PROVIDER_STATE'] = state
+
+    def _start(payload):
+        """公共前置处理：计数、按错误率返回错误。返回 (messages, completion_tokens, error_response)。"""
+        state.count('requests')
+        if state.roll(settings.error_rate):
+            state.count('errors')
+            return None, 0, (jsonify({'error': {'message': 'mock provider error', 'type': 'mock_error'}}),
+                             settings.error_status)
+        messages = payload.get('messages') or []
+        completion_tokens = payload.get('max_tokens') or payload.get('options', {}).get('num_predict') \
+            or settings.completion_tokens
+        return messages, int(completion_tokens), None
+
+    def _stream_response(generate, mimetype):
+        def body():
+            state.count('streams')
+            state.count('active_streams')
+            try:
+                yield from generate()
+            finally:
+                state.count('active_streams', -1)
+        return Response(body(), mimetype=mimetype)
+
+    @app.route('/v1/chat/completions', methods=['POST'])
+    def openai_chat_completions():
+        payload = request.get_json(silent=True) or {}
+        messages, completion_tokens, error_response = _start(payload)
+        if error_response:
+            return error_response
+        model = payload.get('model', 'mock-model')
+        text = _completion_text(completion_tokens)
+
+        if not payload.get('stream'):
+            time.sleep(settings.ttft_ms / 1000.0 +
+                       (len(text) / settings.tokens_per_second if settings.tokens_per_second > 0 else 0))
+            state.count('completion_tokens', len(text))
+            data = {'id': 'chatcmpl-mock', 'object': 'chat.completion', 'model': model,
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text},
+                                 'finish_reason': 'stop'}]}
+            if settings.report_usage:
+                data['usage'] = _usage(state, messages, len(text))
+            return jsonify(data)
+
+        include_usage = settings.report_usage and (payload.get('stream_options') or {}).get('include_usage')
+
+        def frame(data):
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+        def generate():
+            base = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'model': model}
+            # 响应头和 role 帧立即发出，正文在首字延迟之后
+            yield frame({**base, 'choices': [{'index': 0, 'delta': {'role': 'assistant'}}]})
+            produced = 0
+            for chunk in _paced_chunks(state, _chunks(text, settings.chunk_chars)):
+                produced += len(chunk)
+                yield frame({**base, 'choices': [{'index': 0, 'delta': {'content': chunk}}]})
+            state.count('completion_tokens', produced)
+            yield frame({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+            if include_usage:
+                yield frame({**base, 'choices': [], 'usage': _usage(state, messages, produced)})
+            yield b'data: [DONE]\n\n'
+
+        return _stream_response(generate, 'text/event-stream')
+
+    @app.route('/api/chat', methods=['POST'])
+    def ollama_chat():
+        payload = request.get_json(silent=True) or {}
+        messages, completion_tokens, error_response = _start(payload)
+        if error_response:
+            return error_response
+        model = payload.get('model', 'mock-model')
+        text = _completion_text(completion_tokens)
+
+        def done_fields(produced):
+            if not settings.report_usage:
+                return {}
+            usage = _usage(state, messages, produced)
+            return {'prompt_eval_count': usage['prompt_tokens'], 'eval_count': produced}
+
+        if payload.get('stream') is False:
+            time.sleep(settings.ttft_ms / 1000.0 +
+                       (len(text) / settings.tokens_per_second if settings.tokens_per_second > 0 else 0))
+            state.count('completion_tokens', len(text))
+            return jsonify({'model': model, 'message': {'role': 'assistant', 'content': text},
+                            'done': True, **done_fields(len(text))})
+
+        def generate():
+            produced = 0
+            for chunk in _paced_chunks(state, _chunks(text, settings.chunk_chars)):
+                produced += len(chunk)
+                yield (json.dumps({'model': model, 'message': {'role': 'assistant', 'content': chunk},
+                                   'done': False}, ensure_ascii=False) + '\n').encode('utf-8')
+            state.count('completion_tokens', produced)
+            yield (json.dumps({'model': model, 'message': {'role': 'assistant', 'content': ''},
+                               'done': True, **done_fields(produced)}) + '\n').encode('utf-8')
+
+        return _stream_response(generate, 'application/x-ndjson')
+
+    @app.route('/', methods=['GET'])
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({'status': 'ok'})
+
+    @app.route('/stats', methods=['GET'])
+    def stats():
+        with state.lock:
+            counters = dict(state.counters)
+        return jsonify({'settings': settings.to_dict(), **counters})
+
+    return app
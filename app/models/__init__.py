@@ -25,6 +25,8 @@ from .subscription_config import SubscriptionConfig, subscription_config_group_a
 # from .prompt_template import PromptTemplate # Duplicate, now commented
 # from .ai_service import AIService # Duplicate, now commented
 from .api_call_log import ApiCallLog
+from .points_ledger import PointsLedgerEntry, PointsReservation
+from .generation_job import GenerationJob
 
 __all__ = [
     'User', 'UserRole', 'Role',
@@ -36,7 +38,10 @@ __all__ = [
     'SubscriptionConfig',
     'subscription_config_group_association',
     'FileSystemItem', # Ensure this is correct based on where FileSystemItem is defined
-    'ApiCallLog'
+    'ApiCallLog',
+    'PointsLedgerEntry',
+    'PointsReservation',
+    'GenerationJob'
 ] 
 # 文件: app/models/__init__.py
 # ... (可能存在的其他导入) ...
@@ -24,6 +24,10 @@ class AIService(db.Model):
     is_default = db.Column(db.Boolean, default=False, nullable=False)
     # --- 新增：是否启用流式响应 ---
     enable_streaming = db.Column(db.Boolean, nullable=False, default=True)
+    # --- 新增：服务池名称 (相同 pool_name 的系统服务组成一个池，见 app/service_router.py) ---
+    pool_name = db.Column(db.String(100), nullable=True, index=True)
+    # --- 新增：前文/后文/设定 合计的 token 预算 (None 使用全局 AI_CONTEXT_TOKEN_BUDGET，<= 0 不裁剪，见 app/context_packer.py) ---
+    context_token_budget = db.Column(db.Integer, nullable=True)
     
     # Relationship to User (if it's a user-owned service)
     # Specify foreign_keys explicitly due to multiple FK paths between User and AIService
@@ -44,7 +48,9 @@ class AIService(db.Model):
             'is_system_service': self.is_system_service,
             'owner_id': self.owner_id,
             'is_default': self.is_default,
-            'enable_streaming': self.enable_streaming
+            'enable_streaming': self.enable_streaming,
+            'pool_name': self.pool_name,
+            'context_token_budget': self.context_token_budget
             # IMPORTANT: Never return the api_key by default in to_dict unless explicitly needed and secured.
         }
         # Only include key if specifically requested (e.g., by the owner or admin for management)
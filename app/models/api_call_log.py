@@ -15,6 +15,13 @@ class ApiCallLog(db.Model):
     points_deducted = db.Column(db.Integer, nullable=False, default=0)
     prompt_length = db.Column(db.Integer, nullable=True) # Optional: length of the prompt
     response_length = db.Column(db.Integer, nullable=True) # Optional: length of the response
+    # --- 新增：按模板统计提示词缓存命中与首字延迟 ---
+    prompt_template_id = db.Column(db.Integer, db.ForeignKey('prompt_template.id', ondelete='SET NULL'), nullable=True, index=True)
+    prompt_tokens = db.Column(db.Integer, nullable=True)
+    cached_tokens = db.Column(db.Integer, nullable=True) # 服务商报告的命中提示词缓存的 token 数
+    ttft_ms = db.Column(db.Integer, nullable=True) # 首字延迟 (毫秒)
+    status = db.Column(db.String(20), nullable=False, default='completed', server_default='completed') # completed / cancelled (客户端中途断开，按已生成部分计费) / truncated (超出目标字数被截止，见 app/length_control.py)
+    billing_event_id = db.Column(db.String(32), nullable=True, unique=True, index=True) # 后台计费写入的事件 ID，重放 spool 时去重 (见 app/billing_writer.py)
 
     user = db.relationship('User', backref=db.backref('api_calls', lazy='dynamic'))
     ai_service = db.relationship('AIService') # Optional: if you want to easily navigate to service details
@@ -34,5 +41,10 @@ class ApiCallLog(db.Model):
             'tokens_consumed': self.tokens_consumed,
             'points_deducted': self.points_deducted,
             'prompt_length': self.prompt_length,
-            'response_length': self.response_length
+            'response_length': self.response_length,
+            'prompt_template_id': self.prompt_template_id,
+            'prompt_tokens': self.prompt_tokens,
+            'cached_tokens': self.cached_tokens,
+            'ttft_ms': self.ttft_ms,
+            'status': self.status
         } 
\ No newline at end of file
@@ -18,6 +18,8 @@ class FileSystemItem(db.Model):
     order = db.Column(db.Integer, nullable=False, default=0) # 用于同级排序
     content = db.Column(db.Text, nullable=True) # 书籍内容
     settings_data = db.Column(db.JSON, nullable=True) # 设定书内容 (使用 JSON)
+    # 内容版本号：每次保存 content / settings_data 时加一，服务端组装上下文时据此判断客户端是否为最新 (见 app/book_context.py)
+    content_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     collapsed = db.Column(db.Boolean, default=True) # 文件夹折叠状态
 
     # 新增：关联设定书的 ID (仅用于 book 类型)
@@ -0,0 +1,63 @@
+from app import db
+import json
+
+
+class GenerationJob(db.Model):
+    """后台生成作业 (见 app/generation_jobs.py)：提交后立即返回 ID，由生成 worker 调用 AI 服务，结果保存在这里。"""
+    __tablename__ = 'generation_job'
+    __table_args__ = (db.Index('ix_generation_job_status_created_at', 'status', 'created_at'),
+                      db.Index('ix_generation_job_user_id_created_at', 'user_id', 'created_at'),
+                      db.UniqueConstraint('user_id', 'idempotency_key', name='uq_generation_job_user_idempotency_key'))
+
+    id = db.Column(db.String(32), primary_key=True) # 同时是流式输出的 generation_id
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued / running / completed / truncated / failed / cancelled
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    service_id = db.Column(db.Integer, nullable=False)
+    template_id = db.Column(db.Integer, nullable=True)
+    prompt = db.Column(db.Text, nullable=False)
+    messages = db.Column(db.Text, nullable=True) # 前缀稳定模式的消息列表 (JSON)
+    target_chars = db.Column(db.Integer, nullable=True) # 模板 @[字数] 要求的字数 (见 app/length_control.py)
+    idempotency_key = db.Column(db.String(200), nullable=True) # 客户端的 Idempotency-Key，重复提交返回同一个作业
+    reservation_id = db.Column(db.String(32), nullable=True)
+    billing_event_id = db.Column(db.String(32), nullable=True) # 计费事件 ID (扣点流水的 reference)
+    result = db.Column(db.Text, nullable=True) # 运行中定期写入已生成的部分
+    error = db.Column(db.Text, nullable=True)
+    tokens = db.Column(db.Integer, nullable=True)
+    points = db.Column(db.Integer, nullable=True)
+    worker = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True) # 运行中的心跳 (每次写入部分结果时更新)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    TERMINAL_STATUSES = ('completed', 'truncated', 'failed', 'cancelled')
+
+    @property
+    def finished(self):
+        return self.status in self.TERMINAL_STATUSES
+
+    def get_messages(self):
+        return json.loads(self.messages) if self.messages else None
+
+    def to_dict(self, include_result=True):
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'cancel_requested': self.cancel_requested,
+            'service_id': self.service_id,
+            'template_id': self.template_id,
+            'error': self.error,
+            'tokens': self.tokens,
+            'points': self.points,
+            'result_chars': len(self.result) if self.result else 0,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+        if include_result:
+            data['result'] = self.result or ''
+        return data
+
+    def __repr__(self):
+        return f'<GenerationJob {self.id} user={self.user_id} {self.status}>'
@@ -0,0 +1,31 @@
+from app import db
+from sqlalchemy.sql import func
+
+class PointsLedgerEntry(db.Model):
+    """点数流水 (只追加)。用户余额 = User.points (快照) + 快照之后的流水之和，见 app/points_ledger.py。"""
+    __tablename__ = 'points_ledger_entry'
+    __table_args__ = (db.Index('ix_points_ledger_entry_user_id_id', 'user_id', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    delta = db.Column(db.Integer, nullable=False) # 正数为发放，负数为扣除
+    kind = db.Column(db.String(20), nullable=False) # grant (管理员发放) / subscription (订阅发放) / usage (AI 调用扣点)
+    reference = db.Column(db.String(64), nullable=True) # 关联的计费事件 ID / 订阅配置等
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+
+    def __repr__(self):
+        return f'<PointsLedgerEntry {self.id} user={self.user_id} {self.delta:+d} ({self.kind})>'
+
+
+class PointsReservation(db.Model):
+    """流式生成开始前按预估费用预留的点数，结算 (写入 usage 流水) 时删除；过期的预留不再占用余额。"""
+    __tablename__ = 'points_reservation'
+
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    points = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<PointsReservation {self.id} user={self.user_id} points={self.points}>'
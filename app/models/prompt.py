@@ -7,6 +7,8 @@ class PromptTemplate(db.Model):
     name = db.Column(db.String(100), nullable=False) # 模板名称，不再要求 unique
     template_string = db.Column(db.Text, nullable=False) # 模板内容
     is_default = db.Column(db.Boolean, default=False, nullable=False) # 是否为默认模板 (可能主要用于系统模板)
+    # 前缀稳定模式：模板作为固定的 system 消息，占位符内容按变化频率排序放进 user 消息 (见 utils.build_prefix_stable_messages)
+    prefix_stable = db.Column(db.Boolean, default=False, nullable=False)
 
     # ---> 新增：关联用户 <--- 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True) # Nullable 表示系统模板
@@ -32,6 +34,7 @@ class PromptTemplate(db.Model):
             'name': self.name,
             'template_string': self.template_string,
             'is_default': self.is_default,
+            'prefix_stable': self.prefix_stable,
             'user_id': self.user_id, # <--- 返回 user_id
             'owner_username': self.owner.username if self.owner else None, # <--- 返回用户名 (如果有关联)
             'created_at': self.created_at.isoformat() if self.created_at else None,
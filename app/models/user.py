@@ -11,7 +11,8 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     password_change_required = db.Column(db.Boolean, default=False, nullable=False)
     auto_save_on_navigate = db.Column(db.Boolean, default=True, nullable=False)
-    points = db.Column(db.Integer, default=0, nullable=False)
+    points = db.Column(db.Integer, default=0, nullable=False) # 余额快照，实际余额还要加上快照之后的流水 (见 balance)
+    points_snapshot_entry_id = db.Column(db.Integer, default=0, nullable=False, server_default='0') # 快照已包含的最后一条流水 ID
     # --- 新增字段：存储用户启用的 AI 服务配置 ID ---
     active_ai_service_id = db.Column(db.Integer, db.ForeignKey('ai_service.id', use_alter=True, name='fk_user_active_ai_service'), nullable=True)
     # --- 可选：添加关系以方便访问活动配置对象 (如果需要) ---
@@ -46,5 +47,11 @@ class User(UserMixin, db.Model):
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @property
+    def balance(self):
+        """当前点数余额 (快照 + 之后的流水)。"""
+        from ..points_ledger import get_balance
+        return get_balance(self.id)
+
     def __repr__(self):
         return f'<User {self.username}>' 
\ No newline at end of file
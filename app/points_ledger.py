@@ -0,0 +1,199 @@
+"""
+点数流水账与预留。
+
+原来 User.points 在管理员发放、订阅发放、流式计费三处被原地读改写，并发生成都在抢
+同一行；生成前只检查“至少 1 点”，同一个用户可以同时开任意多个流把余额透支。现在:
+
+- 所有点数变动都追加一条 PointsLedgerEntry (只插入，不更新)，不再写 User 行
+- User.points 是余额快照，User.points_snapshot_entry_id 记录快照已包含到哪条流水；
+  余额 = 快照 + 该用户 id 更大的流水之和 (按 (user_id, id) 索引只扫描最近的尾部)
+- 定时任务 snapshot_balances 把尾部折叠进快照 (每个有新流水的用户一条条件 UPDATE)，
+  并清理过期的预留
+- 流式生成开始前按预估费用 (提示词 + 预计输出，多候选乘以 N) 预留点数；
+  可用余额 = 余额 - 未过期的预留之和，不够时直接拒绝。预留在计费写入 usage 流水的
+  同一个事务里删除 (app/billing.py)，生成失败时释放，进程崩溃时按 TTL 过期
+"""
+import math
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, insert, literal, select, update
+
+from . import db
+from .models import User, PointsLedgerEntry, PointsReservation
+
+DEFAULT_RESERVATION_TTL = 600
+DEFAULT_RESERVATION_COMPLETION_TOKENS = 1000
+SNAPSHOT_LAG_SECONDS = 60  # 只折叠这么久之前的流水，避免自增 ID 乱序提交时水位跳过尚未提交的流水
+
+
+def _tail_sum(user_id_column):
+    """快照之后的流水之和 (标量子查询)。"""
+    return select(func.coalesce(func.sum(PointsLedgerEntry.delta), 0)).where(
+        PointsLedgerEntry.user_id == user_id_column,
+        PointsLedgerEntry.id > User.points_snapshot_entry_id,
+    ).scalar_subquery()
+
+
+def _held_sum(user_id, now):
+    """未过期的预留之和 (标量子查询)。"""
+    return select(func.coalesce(func.sum(PointsReservation.points), 0)).where(
+        PointsReservation.user_id == user_id,
+        PointsReservation.expires_at > now,
+    ).scalar_subquery()
+
+
+def _balance_query(user_id):
+    return select(User.points + _tail_sum(User.id)).where(User.id == user_id)
+
+
+def get_balance(user_id):
+    """当前余额 (快照 + 尾部流水)，用户不存在时返回 0。"""
+    return db.session.execute(_balance_query(user_id)).scalar() or 0
+
+
+def get_balances(user_ids):
+    """批量查询余额 {user_id: balance}，用于用户列表。"""
+    if not user_ids:
+        return {}
+    rows = db.session.execute(select(User.id, User.points + _tail_sum(User.id)).where(User.id.in_(user_ids)))
+    return {user_id: balance or 0 for user_id, balance in rows}
+
+
+def get_available_balance(user_id):
+    """可用余额 = 余额 - 进行中的生成预留的点数。返回 (available, held)。"""
+    now = datetime.utcnow()
+    balance, held = db.session.execute(
+        select(User.points + _tail_sum(User.id), _held_sum(user_id, now)).where(User.id == user_id)).one()
+    return (balance or 0) - (held or 0), held or 0
+
+
+def get_balance_after(user_id, reference, delta):
+    """
+    包含一笔可能还在 write-behind 队列里的流水 (reference 为计费事件 ID) 的余额。
+
+    流水已经提交时余额里已包含它；否则在当前余额上加上 delta。只在快照之后的尾部里查找
+    (刚结束的生成的流水不会已经被折叠进快照，见 SNAPSHOT_LAG_SECONDS)。
+    """
+    snapshot_entry_id = select(User.points_snapshot_entry_id).where(User.id == user_id).scalar_subquery()
+    committed = db.session.execute(select(PointsLedgerEntry.id).where(
+        PointsLedgerEntry.user_id == user_id, PointsLedgerEntry.id > snapshot_entry_id,
+        PointsLedgerEntry.reference == reference).limit(1)).first()
+    balance = get_balance(user_id)
+    return balance if committed or not delta else balance + delta
+
+
+def ledger_entry(user_id, delta, kind, reference=None):
+    """一条流水的插入参数 (用于批量插入)。"""
+    return {'user_id': user_id, 'delta': delta, 'kind': kind, 'reference': reference,
+            'created_at': datetime.utcnow()}
+
+
+def append_entries(entries):
+    """(不提交) 批量追加流水，由调用方在自己的事务里提交。"""
+    if entries:
+        db.session.execute(insert(PointsLedgerEntry), entries)
+
+
+def grant_points(user_id, points, kind='grant', reference=None):
+    """(不提交) 给用户发放点数。"""
+    append_entries([ledger_entry(user_id, points, kind, reference)])
+
+
+class InsufficientPoints(Exception):
+    """可用余额不足以预留点数 (流式响应已经返回、只能以错误结束流时抛出)。"""
+    code = 'INSUFFICIENT_POINTS'
+
+
+def reservation_points(prompt_tokens, candidate_count=1, completion_tokens=DEFAULT_RESERVATION_COMPLETION_TOKENS):
+    """按提示词 token 数和预计输出长度估算一次生成最多需要的点数 (至少 1 点)。"""
+    from .billing import TOKENS_PER_POINT
+    return max(1, math.ceil((prompt_tokens + completion_tokens) * candidate_count / TOKENS_PER_POINT))
+
+
+def reserve_points(user_id, points, ttl=DEFAULT_RESERVATION_TTL):
+    """
+    可用余额足够时预留 points 点并提交，返回预留 ID；不够时返回 None。
+
+    检查与插入是同一条 INSERT ... SELECT ... WHERE 可用余额 >= points 语句，
+    同一用户的并发请求不会一起通过检查。
+    """
+    now = datetime.utcnow()
+    reservation_id = uuid.uuid4().hex
+    # 行锁 (PostgreSQL / MySQL) 让同一用户的预留串行；SQLite 的写事务本身是串行的
+    db.session.execute(select(User.id).where(User.id == user_id).with_for_update())
+    available = User.points + _tail_sum(User.id) - _held_sum(user_id, now)
+    result = db.session.execute(
+        insert(PointsReservation).from_select(
+            ['id', 'user_id', 'points', 'created_at', 'expires_at'],
+            select(literal(reservation_id), literal(user_id), literal(points), literal(now),
+                   literal(now + timedelta(seconds=ttl)))
+            .where(and_(User.id == user_id, available >= points))))
+    db.session.commit()
+    return reservation_id if result.rowcount == 1 else None
+
+
+def release_reservation(reservation_id, flask_app=None):
+    """释放未结算的预留 (生成失败、未产生用量)。流式生成器中调用时传入 flask_app。"""
+    if not reservation_id:
+        return
+    if flask_app is not None:
+        with flask_app.app_context():
+            release_reservation(reservation_id)
+        return
+    try:
+        PointsReservation.query.filter_by(id=reservation_id).delete()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        # 释放失败不影响结果，预留会按 TTL 过期
+        print(f"[Points Ledger] Failed to release reservation {reservation_id}: {e}")
+
+
+def reservation_active(reservation_id):
+    """预留是否仍然有效 (没有结算、释放或过期)。"""
+    reservation = PointsReservation.query.get(reservation_id)
+    return reservation is not None and reservation.expires_at > datetime.utcnow()
+
+
+def settle_reservations(reservation_ids):
+    """(不提交) 删除已结算的预留，与写入 usage 流水在同一个事务中执行。"""
+    reservation_ids = [rid for rid in reservation_ids if rid]
+    if reservation_ids:
+        PointsReservation.query.filter(PointsReservation.id.in_(reservation_ids)).delete(synchronize_session=False)
+
+
+def snapshot_balances(app):
+    """
+    (定时任务) 把各用户快照之后的流水折叠进 User.points，并删除过期的预留。
+
+    每个用户一条 UPDATE，条件是快照水位没有被别人推进过，重复执行或与其他进程并发都是安全的。
+    只折叠 SNAPSHOT_LAG_SECONDS 之前写入的流水 (水位 cutoff_id)，更新的流水留在尾部。
+    """
+    with app.app_context():
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=SNAPSHOT_LAG_SECONDS)
+            cutoff_id = db.session.execute(
+                select(func.max(PointsLedgerEntry.id)).where(PointsLedgerEntry.created_at < cutoff)).scalar()
+            updated = 0
+            rows = []
+            if cutoff_id:
+                rows = db.session.execute(
+                    select(PointsLedgerEntry.user_id, func.sum(PointsLedgerEntry.delta), User.points_snapshot_entry_id)
+                    .join(User, User.id == PointsLedgerEntry.user_id)
+                    .where(PointsLedgerEntry.id > User.points_snapshot_entry_id, PointsLedgerEntry.id <= cutoff_id)
+                    .group_by(PointsLedgerEntry.user_id, User.points_snapshot_entry_id)).all()
+            for user_id, tail, snapshot_entry_id in rows:
+                result = db.session.execute(
+                    update(User)
+                    .where(User.id == user_id, User.points_snapshot_entry_id == snapshot_entry_id)
+                    .values(points=func.coalesce(User.points, 0) + tail, points_snapshot_entry_id=cutoff_id))
+                updated += result.rowcount
+            expired = PointsReservation.query.filter(PointsReservation.expires_at <= datetime.utcnow()) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            if updated or expired:
+                print(f"[Points Ledger] Snapshotted balances of {updated} user(s), removed {expired} expired reservation(s).")
+        except Exception as e:
+            db.session.rollback()
+            print(f"!!! [Points Ledger] Error snapshotting balances: {e}")
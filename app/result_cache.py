@@ -0,0 +1,213 @@
+"""
+非流式 AI 生成结果的精确匹配缓存 (默认关闭，需配置 AI_RESULT_CACHE_ENABLED)。
+
+同一个模板加同一段前文反复请求时，直接返回上次的结果，省掉完整的调用延迟和费用。
+缓存键是 (服务 ID, 模型名, 最终提示词, 请求参数) 的 SHA-256。
+
+后端可插拔:
+- 'memory': 进程内 LRU (条目数 + 总字节数上限)
+- 'sqlite': 磁盘上的 SQLite 文件，同一台机器上的多个 gunicorn worker 共享
+
+命中/未命中计数通过 stats() 暴露 (管理员接口 /api/admin/ai-result-cache)，
+单次请求可以通过 use_cache=False 绕过缓存。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(service_id, model_name, prompt, params=None):
+    """根据服务 ID、模型、最终提示词和其他请求参数计算缓存键。"""
+    raw = json.dumps([service_id, model_name, prompt, params or {}],
+                     ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class MemoryCacheBackend:
+    """进程内 LRU 缓存。"""
+
+    def __init__(self, max_entries=1000, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at < time.time():
+                del self._data[key]
+                self._bytes -= size
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size, time.time() + ttl)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _key, (_value, old_size, _expires) = self._data.popitem(last=False)
+                self._bytes -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return {'entries': len(self._data), 'bytes': self._bytes}
+
+
+class SQLiteCacheBackend:
+    """基于 SQLite 文件的缓存，多进程共享；按最近访问时间淘汰。"""
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS ai_result_cache ('
+            ' cache_key TEXT PRIMARY KEY, value TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL, last_access REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_ai_result_cache_last_access ON ai_result_cache (last_access)')
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute('SELECT value, expires_at FROM ai_result_cache WHERE cache_key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at < now:
+            conn.execute('DELETE FROM ai_result_cache WHERE cache_key = ?', (key,))
+            return None
+        conn.execute('UPDATE ai_result_cache SET last_access = ? WHERE cache_key = ?', (now, key))
+        return value
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('INSERT OR REPLACE INTO ai_result_cache (cache_key, value, expires_at, last_access) '
+                     'VALUES (?, ?, ?, ?)', (key, value, now + ttl, now))
+        conn.execute('DELETE FROM ai_result_cache WHERE expires_at < ?', (now,))
+        count = conn.execute('SELECT COUNT(*) FROM ai_result_cache').fetchone()[0]
+        if count > self.max_entries:
+            conn.execute('DELETE FROM ai_result_cache WHERE cache_key IN ('
+                         ' SELECT cache_key FROM ai_result_cache ORDER BY last_access LIMIT ?)',
+                         (count - self.max_entries,))
+
+    def clear(self):
+        self._conn().execute('DELETE FROM ai_result_cache')
+
+    def info(self):
+        row = self._conn().execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(value AS BLOB))), 0) FROM ai_result_cache').fetchone()
+        return {'entries': row[0], 'bytes': row[1], 'path': self.path}
+
+
+class ResultCache:
+    """带 TTL 与命中统计的缓存门面，后端异常不影响正常生成。"""
+
+    def __init__(self, backend, ttl=3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    def get(self, key):
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            print(f"[Result Cache] Error reading cache: {e}")
+            return None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, value, self.ttl)
+            self.stores += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"[Result Cache] Error writing cache: {e}")
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        data = {
+            'backend': type(self.backend).__name__,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'errors': self.errors,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+        try:
+            data.update(self.backend.info())
+        except Exception as e:
+            data['info_error'] = str(e)
+        return data
+
+
+_cache = None  # 未启用时为 None
+
+
+def get_result_cache():
+    """返回当前进程的结果缓存，未启用时返回 None。"""
+    return _cache
+
+
+def init_app(app):
+    """根据 app.config 创建结果缓存 (AI_RESULT_CACHE_ENABLED 为 False 时不启用)。"""
+    global _cache
+    if not app.config.get('AI_RESULT_CACHE_ENABLED', False):
+        _cache = None
+        return
+    backend_name = app.config.get('AI_RESULT_CACHE_BACKEND', 'memory')
+    max_entries = app.config.get('AI_RESULT_CACHE_MAX_ENTRIES', 1000)
+    if backend_name == 'sqlite':
+        path = app.config.get('AI_RESULT_CACHE_PATH') or os.path.join(app.instance_path, 'ai_result_cache.db')
+        backend = SQLiteCacheBackend(path, max_entries=max_entries)
+    else:
+        backend = MemoryCacheBackend(max_entries=max_entries,
+                                     max_bytes=app.config.get('AI_RESULT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+    _cache = ResultCache(backend, ttl=app.config.get('AI_RESULT_CACHE_TTL', 3600))
+    print(f"[Result Cache] Enabled with {type(backend).__name__} (ttl={_cache.ttl}s, max_entries={max_entries}).")
@@ -0,0 +1,218 @@
+"""
+AI 服务池：按实测延迟选择成员，并在出错时故障转移。
+
+生成路由原来只会使用一个 AIService (用户启用的或系统默认的)，服务商一慢或一挂，
+所有写作用户都会卡住。管理员可以给多个系统服务设置相同的 pool_name，把它们组成
+一个服务池；用户选中池中任意一个服务时，生成请求在池内挑选成员:
+
+- 每个成员记录首字延迟 (TTFT) 和流式吞吐量 (chunks/s) 的指数加权移动平均 (EWMA)
+- 按预计耗时 TTFT + REFERENCE_CHUNKS / 吞吐量 从低到高排序，还没有样本的成员排在
+  最前面 (先探测一次)
+- 最近连续失败的成员在冷却期内排到最后
+- 连接错误、超时、429 和 5xx 发生在向客户端输出任何内容之前时，换下一个成员重试
+- 熔断中的成员 (见 app/circuit_breaker.py) 直接跳过，全部熔断时立即失败而不是等待超时
+
+统计数据保存在进程内 (每个 worker 各自统计)，管理员通过 /api/admin/ai-service-pools 查看。
+"""
+import threading
+import time
+
+import requests
+
+from . import circuit_breaker
+
+EWMA_ALPHA = 0.3               # 新样本的权重
+REFERENCE_CHUNKS = 200         # 估算预计耗时时假设的输出块数
+FAILURE_COOLDOWN_SECONDS = 30  # 连续失败的成员在此时间内排到最后
+
+
+class MemberStats:
+    """单个池成员的 EWMA 延迟、吞吐量与成功/失败计数。"""
+
+    def __init__(self):
+        self.ttft_ewma = None
+        self.throughput_ewma = None
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_failure_at = None
+        self.last_success_at = None
+
+    def cooling_down(self, now=None):
+        if not self.consecutive_failures or self.last_failure_at is None:
+            return False
+        return (now or time.time()) - self.last_failure_at < FAILURE_COOLDOWN_SECONDS
+
+    def expected_seconds(self):
+        """预计完成一次生成的耗时；没有样本时返回 None。"""
+        if self.ttft_ewma is None:
+            return None
+        if self.throughput_ewma:
+            return self.ttft_ewma + REFERENCE_CHUNKS / self.throughput_ewma
+        return self.ttft_ewma
+
+    def to_dict(self):
+        expected = self.expected_seconds()
+        return {
+            'ttft_ewma_ms': round(self.ttft_ewma * 1000, 1) if self.ttft_ewma is not None else None,
+            'throughput_ewma': round(self.throughput_ewma, 2) if self.throughput_ewma is not None else None,
+            'expected_seconds': round(expected, 3) if expected is not None else None,
+            'requests': self.requests,
+            'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'cooling_down': self.cooling_down(),
+            'last_error': self.last_error,
+            'last_failure_at': self.last_failure_at,
+            'last_success_at': self.last_success_at,
+        }
+
+
+_stats = {}  # service_id -> MemberStats
+_lock = threading.Lock()
+
+
+def _ewma(old, sample):
+    return sample if old is None else old + EWMA_ALPHA * (sample - old)
+
+
+def _member(service_id):
+    stats = _stats.get(service_id)
+    if stats is None:
+        stats = _stats[service_id] = MemberStats()
+    return stats
+
+
+def record_success(service_id, ttft, throughput=None):
+    """
+    记录一次成功的调用。
+
+    Args:
+        service_id: AIService ID.
+        ttft: 从发出请求到收到第一块内容的秒数 (非流式调用为整体响应时间).
+        throughput: 流式调用首块之后的 chunks/s，没有时不更新吞吐量.
+    """
+    with _lock:
+        stats = _member(service_id)
+        stats.requests += 1
+        stats.successes += 1
+        stats.consecutive_failures = 0
+        stats.last_success_at = time.time()
+        stats.ttft_ewma = _ewma(stats.ttft_ewma, ttft)
+        if throughput:
+            stats.throughput_ewma = _ewma(stats.throughput_ewma, throughput)
+    circuit_breaker.on_success(service_id)
+
+
+def record_failure(service_id, error):
+    with _lock:
+        stats = _member(service_id)
+        stats.requests += 1
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        stats.last_failure_at = time.time()
+        stats.last_error = str(error)[:300]
+    # 只有服务不可达类的错误 (连接错误、超时、429、5xx) 计入熔断，请求本身的错误 (4xx) 不算
+    if not isinstance(error, Exception) or is_retryable_error(error):
+        circuit_breaker.on_failure(service_id, error)
+
+
+def get_member_stats(service_id):
+    with _lock:
+        stats = _stats.get(service_id)
+        return stats.to_dict() if stats else MemberStats().to_dict()
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+
+
+def _rank_key(service_id, now):
+    stats = _stats.get(service_id)
+    if stats is None:
+        return (0, 0, 0.0)
+    expected = stats.expected_seconds()
+    return (1 if stats.cooling_down(now) else 0,
+            0 if expected is None else 1,
+            expected or 0.0)
+
+
+def rank_members(services):
+    """按 (是否冷却中, 是否已有样本, 预计耗时) 排序；sorted 是稳定的，同分时保持原顺序。"""
+    now = time.time()
+    with _lock:
+        return sorted(services, key=lambda service: _rank_key(service.id, now))
+
+
+def pool_candidates(ai_config):
+    """
+    返回本次生成应依次尝试的 AIService 列表。
+
+    只有设置了 pool_name 的系统服务才会展开成服务池；其他服务原样返回 [ai_config]。
+    熔断中的成员被去掉，半开 (正在恢复) 的成员排在正常成员之后。
+    需要在 app context 中调用。
+
+    Raises:
+        CircuitOpenError: 服务 (或服务池的全部成员) 处于熔断状态.
+    """
+    return circuit_breaker.filter_available(pool_members(ai_config))
+
+
+def pool_members(ai_config):
+    """服务池的全部成员 (按路由顺序，不考虑熔断)；未加入服务池时返回 [ai_config]。"""
+    from .config_cache import get_pool_members
+
+    if not ai_config.is_system_service or not ai_config.pool_name:
+        return [ai_config]
+    return rank_members(get_pool_members(ai_config.pool_name)) or [ai_config]
+
+
+def is_retryable_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+
+def is_retryable_error(exc):
+    """
+    call_ai_service 在流式模式下抛出的异常是否值得换成员重试。
+
+    它把 requests 的异常包装成 ConnectionError / TimeoutError 再抛出，原始异常在 __cause__ 里。
+    """
+    cause = exc.__cause__ if exc.__cause__ is not None else exc
+    if isinstance(cause, requests.exceptions.HTTPError):
+        return cause.response is not None and is_retryable_status(cause.response.status_code)
+    return isinstance(cause, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def timed_stream(service_id, iterator, started_at, token_info=None):
+    """
+    包装 call_ai_service 返回的流，记录 TTFT 与吞吐量。
+
+    started_at 为发出请求时的 time.monotonic()。关闭包装器时同时关闭底层迭代器。
+    call_ai_service 在流中途出错时不抛异常而是提前结束，并在 token_info 中留下
+    'completed': False；传入 token_info 时这种情况记为失败，而不是输出过内容就算成功。
+    """
+    first_at = None
+    chunks = 0
+    completed = False
+    try:
+        for chunk in iterator:
+            if first_at is None:
+                first_at = time.monotonic()
+            chunks += 1
+            yield chunk
+        completed = True
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+        if completed and token_info is not None and not token_info.get('completed'):
+            record_failure(service_id, '上游响应异常中断' if first_at is not None else '上游未返回任何内容')
+        elif first_at is not None:
+            elapsed = time.monotonic() - first_at
+            throughput = (chunks - 1) / elapsed if completed and chunks > 1 and elapsed > 0 else None
+            record_success(service_id, first_at - started_at, throughput)
+        elif completed:
+            record_failure(service_id, '上游未返回任何内容')
@@ -0,0 +1,384 @@
+"""
+相同生成请求的合并 (single-flight)。
+
+用户双击“生成”或编辑器自动重试时，会同时发出两个完全相同的请求，各自打开
+一个上游流并各自计费。这里按 (用户, 服务, 提示词哈希) 合并仍在进行中的相同请求：
+
+- 流式: 第一个请求 (leader) 在后台线程中消费上游流并写入共享缓冲区，所有请求
+  (包括 leader 自己) 都作为订阅者从缓冲区读取，后加入的订阅者会先回放已有内容。
+  计费只在后台线程里做一次。所有订阅者都断开后中止上游连接 (见 on_abandon，
+  可续传时会先等待 resume_grace 秒)，已生成部分照常计费。
+- 非流式: 后到的请求等待 leader 的结果并直接复用。
+
+请求结束后即从合并注册表移除，之后的相同请求会重新调用上游 (结果复用见 result_cache)。
+
+可续传的流式生成 (replay store):
+- 每个流式生成请求有一个 generation_id (响应头 X-Generation-Id)，共享同一个上游流的
+  请求各自的 ID 都指向这个流；流结束后缓冲区继续保留 replay_ttl 秒，总字数超过
+  replay_max_chars 时先淘汰最早结束的流
+- 连接中途断开的客户端用 generation_id 和已收到的字数 (offset，按字符计) 重新订阅，
+  从断点继续读取，不会再调用上游
+- 所有订阅者断开后等待 resume_grace 秒才中止上游 (cancelled)，给客户端留出重连时间；
+  resume_grace 为 0 时立即中止
+- 客户端提交的幂等键 (Idempotency-Key) 映射到 generation_id，同一个键的重复提交
+  直接附着到已有的生成上 (即使提示词已经变化)
+- 注册表在进程内，多 worker 部署时续传请求需要落到同一个 worker，否则返回 404
+  (后台生成作业除外，其他进程从数据库跟读，见 app/generation_jobs.py)
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def make_flight_key(user_id, service_id, prompt, candidates=1):
+    """合并键: (用户, 服务, 提示词哈希, 候选数)。"""
+    return (user_id, service_id, hashlib.sha256((prompt or '').encode('utf-8')).hexdigest(), candidates)
+
+
+class SharedStream:
+    """一个上游流的共享缓冲区，支持多个订阅者各自从头读取。"""
+
+    def __init__(self, key, generation_id=None, resume_grace=0):
+        self.key = key
+        self.user_id = key[0] if isinstance(key, tuple) and key else None
+        self.generation_id = generation_id or uuid.uuid4().hex
+        self.resume_grace = resume_grace
+        self.chunks = []
+        self.chars = 0
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        self.finished_at = None
+        self.usage = None  # 计费结果，生产者在 finish 之前设置 (SSE 流的 usage 事件，见 app/sse.py)
+        self.active_subscribers = 0
+        self.total_subscribers = 0
+        self._on_abandon = None
+        self._cond = threading.Condition()
+
+    @property
+    def abandoned(self):
+        """曾经有订阅者、但现在全部断开了 (resume_grace 内重连会恢复)。"""
+        return self.total_subscribers > 0 and self.active_subscribers == 0
+
+    def on_abandon(self, callback):
+        """
+        注册确认放弃 (全部订阅者断开且 resume_grace 内没有重连) 时要调用的函数，例如中止上游响应。
+        注册时已经确认放弃则立即调用。
+        """
+        with self._cond:
+            self._on_abandon = callback
+            cancelled = self.cancelled and not self.done
+        if cancelled:
+            callback()
+
+    def _cancel_if_abandoned(self):
+        with self._cond:
+            if not self.abandoned or self.done or self.cancelled:
+                return
+            self.cancelled = True
+            callback = self._on_abandon
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                print(f"!!! [Single Flight] on_abandon callback failed: {e}")
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self.chars += len(chunk)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            if not self.done:
+                self.done = True
+                self.error = error
+                self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def subscribe(self, coalescer=None, offset=0, idle_timeout=None):
+        """
+        返回一个生成器，依次产出缓冲区中的内容直到流结束。
+
+        传入 ChunkCoalescer (app/stream_flush.py) 时按其策略合并后输出，等待上游期间
+        到了刷新时间也会醒来输出已累计的内容。offset 为跳过的字符数 (断线续传时客户端已收到的部分)。
+        传入 idle_timeout 时，超过这么多秒没有输出就产出一个 None (SSE 心跳)。
+        """
+        with self._cond:
+            self.active_subscribers += 1
+            self.total_subscribers += 1
+        try:
+            index = 0
+            skip = max(offset, 0)
+            idle_deadline = time.monotonic() + idle_timeout if idle_timeout else None
+            while True:
+                idle = False
+                with self._cond:
+                    while index >= len(self.chunks) and not self.done:
+                        timeout = coalescer.time_until_flush() if coalescer is not None else None
+                        if timeout is not None and timeout <= 0:
+                            break
+                        if idle_deadline is not None:
+                            idle_left = idle_deadline - time.monotonic()
+                            if idle_left <= 0:
+                                idle = True
+                                break
+                            timeout = idle_left if timeout is None else min(timeout, idle_left)
+                        self._cond.wait(timeout)
+                    new_chunks = self.chunks[index:]
+                    index += len(new_chunks)
+                    finished = self.done and index >= len(self.chunks)
+                    error = self.error
+                if skip:
+                    skipped = []
+                    for chunk in new_chunks:
+                        if skip >= len(chunk):
+                            skip -= len(chunk)
+                            continue
+                        skipped.append(chunk[skip:])
+                        skip = 0
+                    new_chunks = skipped
+                if coalescer is None:
+                    outputs = new_chunks
+                else:
+                    outputs = [text for text in map(coalescer.add, new_chunks) if text]
+                    if finished or coalescer.due():
+                        text = coalescer.flush()
+                        if text:
+                            outputs.append(text)
+                for text in outputs:
+                    yield text
+                if idle_deadline is not None and (outputs or idle):
+                    if idle and not outputs:
+                        yield None
+                    idle_deadline = time.monotonic() + idle_timeout
+                if finished:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            with self._cond:
+                self.active_subscribers -= 1
+                self._cond.notify_all()
+                abandoned = self.abandoned and not self.done
+            # resume_grace 为 None 的流 (后台生成作业) 不因订阅者断开而中止
+            if abandoned and self.resume_grace is not None:
+                if self.resume_grace > 0:
+                    # 给断线的客户端留出重连时间，到时仍没有订阅者才中止
+                    timer = threading.Timer(self.resume_grace, self._cancel_if_abandoned)
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self._cancel_if_abandoned()
+
+
+class _PendingCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """进行中的相同请求注册表 (进程内)。"""
+
+    def __init__(self, replay_ttl=120, replay_max_chars=20_000_000, resume_grace=0):
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._calls = {}
+        self._replay = OrderedDict()  # generation_id -> SharedStream (同一个流可以有多个 ID)
+        self._idempotency = {}  # (user_id, 幂等键) -> (generation_id, 登记时刻)
+        self.replay_ttl = replay_ttl
+        self.replay_max_chars = replay_max_chars
+        self.resume_grace = resume_grace
+        self.leaders = 0
+        self.coalesced = 0
+        self.resumed = 0
+        self.idempotent_hits = 0
+
+    def configure(self, replay_ttl=None, replay_max_chars=None, resume_grace=None):
+        with self._lock:
+            if replay_ttl is not None:
+                self.replay_ttl = replay_ttl
+            if replay_max_chars is not None:
+                self.replay_max_chars = replay_max_chars
+            if resume_grace is not None:
+                self.resume_grace = resume_grace
+
+    def stream(self, key, produce, coalescer=None, generation_id=None, idle_timeout=None):
+        """
+        订阅 key 对应的流；如果还没有进行中的流，则在后台线程中运行 produce(shared)。
+
+        Args:
+            key: 合并键 (见 make_flight_key).
+            produce: 以 SharedStream 为参数的函数，负责调用上游、publish 内容并计费.
+            coalescer: 可选的 ChunkCoalescer，本订阅者的输出合并策略.
+            generation_id: 本次请求的生成 ID (见 new_generation_id)，附着到已有的流时也指向该流，
+                           之后可以用它续传.
+            idle_timeout: 见 SharedStream.subscribe (SSE 心跳).
+
+        Returns:
+            (subscription, is_leader)
+        """
+        with self._lock:
+            shared = self._streams.get(key)
+            is_leader = shared is None
+            if is_leader:
+                shared = SharedStream(key, generation_id, self.resume_grace)
+                self._streams[key] = shared
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+            self._replay[shared.generation_id] = shared
+            if generation_id:
+                self._replay[generation_id] = shared
+            self._prune_locked()
+        if is_leader:
+            threading.Thread(target=self._run_stream, args=(key, shared, produce), daemon=True).start()
+        return shared.subscribe(coalescer, idle_timeout=idle_timeout), is_leader
+
+    def open_stream(self, generation_id, user_id):
+        """
+        由调用方自己生产内容的流 (后台生成作业，见 app/generation_jobs.py)：登记到 replay store 后返回
+        SharedStream，调用方 publish / finish；订阅者可以用 resume 随时附着，全部断开也不会中止生成。
+        """
+        shared = SharedStream((user_id, 'job', generation_id, 1), generation_id, resume_grace=None)
+        with self._lock:
+            self._replay[generation_id] = shared
+            self._prune_locked()
+        return shared
+
+    @staticmethod
+    def new_generation_id():
+        return uuid.uuid4().hex
+
+    def get_generation(self, generation_id, user_id):
+        """进行中或仍在保留期内的生成，不存在、已过期或不属于该用户时返回 None。"""
+        with self._lock:
+            self._prune_locked()
+            shared = self._replay.get(generation_id)
+        if shared is None or shared.user_id != user_id:
+            return None
+        return shared
+
+    def resume(self, generation_id, user_id, offset=0, coalescer=None, idle_timeout=None):
+        """从 offset (字符数) 处重新订阅一个生成，找不到时返回 (None, None)，否则返回 (subscription, shared)。"""
+        shared = self.get_generation(generation_id, user_id)
+        if shared is None:
+            return None, None
+        with self._lock:
+            self.resumed += 1
+        return shared.subscribe(coalescer, offset, idle_timeout), shared
+
+    def claim_idempotency_key(self, user_id, idempotency_key, generation_id):
+        """
+        把幂等键登记到 generation_id 上；键已被占用时返回之前登记的 generation_id (不覆盖)，否则返回 None。
+        """
+        with self._lock:
+            self._prune_locked()
+            existing = self._idempotency.get((user_id, idempotency_key))
+            if existing is not None:
+                self.idempotent_hits += 1
+                return existing[0]
+            self._idempotency[(user_id, idempotency_key)] = (generation_id, time.monotonic())
+            return None
+
+    def release_idempotency_key(self, user_id, idempotency_key, generation_id):
+        """生成没有开始 (请求在输出前失败或断开) 时释放幂等键，之后的重复提交可以重新生成。"""
+        with self._lock:
+            entry = self._idempotency.get((user_id, idempotency_key))
+            if entry is not None and entry[0] == generation_id:
+                del self._idempotency[(user_id, idempotency_key)]
+
+    def _prune_locked(self):
+        """淘汰保留期已过的流，再按总字数淘汰最早结束的流；进行中的流不淘汰。"""
+        now = time.monotonic()
+        expired = [gid for gid, shared in self._replay.items()
+                   if shared.done and now - shared.finished_at > self.replay_ttl]
+        for gid in expired:
+            del self._replay[gid]
+        retained = {id(shared): shared for shared in self._replay.values()}
+        total_chars = sum(shared.chars for shared in retained.values())
+        if total_chars > self.replay_max_chars:
+            for shared in sorted((s for s in retained.values() if s.done), key=lambda s: s.finished_at):
+                if total_chars <= self.replay_max_chars:
+                    break
+                total_chars -= shared.chars
+                for gid in [gid for gid, s in self._replay.items() if s is shared]:
+                    del self._replay[gid]
+        # 生成已被淘汰的幂等键随之删除；登记后还没开始的生成暂时不在 _replay 中，给它 replay_ttl 的时间
+        for idem_key, (gid, claimed_at) in list(self._idempotency.items()):
+            if gid not in self._replay and now - claimed_at > self.replay_ttl:
+                del self._idempotency[idem_key]
+
+    def has_stream(self, key):
+        """key 对应的流是否正在进行 (调用方据此判断本次请求会不会真正发起上游调用)。"""
+        with self._lock:
+            return key in self._streams
+
+    def _run_stream(self, key, shared, produce):
+        try:
+            produce(shared)
+            shared.finish()
+        except Exception as e:
+            print(f"!!! [Single Flight] Upstream stream failed: {e}")
+            shared.finish(e)
+        finally:
+            with self._lock:
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+
+    def do(self, key, fn):
+        """非流式: 相同 key 的并发调用只执行一次 fn()，其余调用等待并共享结果。"""
+        with self._lock:
+            pending = self._calls.get(key)
+            is_leader = pending is None
+            if is_leader:
+                pending = _PendingCall()
+                self._calls[key] = pending
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not is_leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+        try:
+            pending.result = fn()
+            return pending.result
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            pending.event.set()
+
+    def stats(self):
+        with self._lock:
+            retained = {id(shared): shared for shared in self._replay.values()}
+            return {
+                'in_flight_streams': len(self._streams),
+                'in_flight_calls': len(self._calls),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'retained_generations': len(retained),
+                'retained_chars': sum(shared.chars for shared in retained.values()),
+                'resumed': self.resumed,
+                'idempotent_hits': self.idempotent_hits,
+            }
+
+
+# 生成请求共用的注册表
+generation_flights = SingleFlight()
+
+
+def init_app(app):
+    """从 app.config 读取续传相关配置。"""
+    generation_flights.configure(replay_ttl=app.config.get('AI_STREAM_REPLAY_TTL', 120),
+                                 replay_max_chars=app.config.get('AI_STREAM_REPLAY_MAX_CHARS', 20_000_000),
+                                 resume_grace=app.config.get('AI_STREAM_RESUME_GRACE_SECONDS', 15))
@@ -0,0 +1,85 @@
+"""
+流式生成的 SSE (text/event-stream) 协议，按需启用。
+
+默认的流式响应是纯文本，出错时只在服务端打印，客户端也拿不到最终用量和扣点后的余额，
+每次生成完都要再请求一次 /api/user/status。请求头 Accept: text/event-stream (或请求体
+"stream_format": "sse") 时改为带类型的事件:
+
+- delta      {"offset": 本段起始字符数, "text": 内容}
+- heartbeat  {"offset": 当前字符数}，超过 AI_SSE_HEARTBEAT_SECONDS 秒没有输出时发送
+- usage      {"offset", "total_tokens", "prompt_tokens", "cached_tokens", "points", "status"}，流结束后的计费结果
+- balance    {"offset", "balance"}，扣点后的余额 (计费仍在 write-behind 队列中时也已扣除)
+- error      {"offset", "error", "code"}，生成失败
+- done       {"offset", "status"}，最后一个事件
+
+每个事件的 id 都是当前的字符偏移 (单调不减)，断线后用 Last-Event-ID (或 ?offset=) 请求
+/api/generations/<id>/stream 即可从断点继续 (见 app/single_flight.py)。
+"""
+import json
+
+SSE_MIMETYPE = 'text/event-stream'
+
+
+def wants_sse(request, data=None):
+    """请求是否选择了 SSE 协议 (Accept 头或请求体/查询参数中的 stream_format)。"""
+    stream_format = (data or {}).get('stream_format') or request.args.get('stream_format')
+    if stream_format:
+        return stream_format == 'sse'
+    return SSE_MIMETYPE in (request.headers.get('Accept') or '')
+
+
+def resume_offset(request):
+    """续传的起始偏移：?offset= 优先，其次 SSE 自动重连带上的 Last-Event-ID。"""
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        offset = int(last_event_id) if last_event_id.isdigit() else 0
+    return offset
+
+
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+def sse_events(subscription, offset=0, trailer=None):
+    """
+    把订阅 (SharedStream.subscribe，带 idle_timeout 时 None 表示心跳) 转换成 SSE 事件文本。
+
+    Args:
+        subscription: 产出文本块的生成器，出错时在结束处抛出异常.
+        offset: 第一块内容在整个生成中的字符偏移 (续传时为客户端已收到的字数).
+        trailer: 可选，流正常结束后调用，返回 [(事件名, 数据), ...] (usage / balance)，
+                 各事件自动加上 offset.
+    """
+    status = 'completed'
+    try:
+        for text in subscription:
+            if text is None:
+                yield format_event('heartbeat', {'offset': offset}, offset)
+                continue
+            yield format_event('delta', {'offset': offset, 'text': text}, offset + len(text))
+            offset += len(text)
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        print(f"[SSE] Generation ended with an error at offset {offset}: {e}")
+        code = getattr(e, 'code', None)
+        yield format_event('error', {'offset': offset, 'error': str(e) or '生成失败',
+                                     'code': code if isinstance(code, str) else 'GENERATION_FAILED'}, offset)
+        status = 'error'
+    if status == 'completed' and trailer is not None:
+        try:
+            events = trailer()
+        except Exception as e:
+            print(f"!!! [SSE] Failed to build usage/balance events: {e}")
+            events = []
+        for event, data in events:
+            if event == 'usage' and data.get('status'):
+                status = data['status']
+            yield format_event(event, {'offset': offset, **data}, offset)
+    yield format_event('done', {'offset': offset, 'status': status}, offset)
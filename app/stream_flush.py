@@ -0,0 +1,74 @@
+"""
+流式输出的合并与刷新策略。
+
+服务商每个 delta 往往只有一两个字，原来每个 delta 都作为一次单独的写出：
+服务器端每块一次 chunked-transfer 帧和系统调用，浏览器端每块一次
+quill.insertText + 两次 formatText。ChunkCoalescer 把 delta 合并后再输出:
+
+- 第一块内容立即输出 (不影响首字延迟)
+- 之后累计到 flush_bytes 字节 (UTF-8)，或距上次输出已过 flush_interval 秒时输出一次
+- 流结束时输出剩余内容
+
+flush_bytes <= 0 时关闭合并，每个 delta 原样输出。同步路径 (single_flight 订阅者)
+可以在等待上游时按 time_until_flush() 超时醒来，异步网关在每次上游读之后检查。
+"""
+import time
+
+
+def flush_policy(config):
+    """从 app.config 读取 (flush_bytes, flush_interval 秒)。"""
+    return (config.get('AI_STREAM_FLUSH_BYTES', 0),
+            config.get('AI_STREAM_FLUSH_MS', 0) / 1000.0)
+
+
+class ChunkCoalescer:
+    """按字节数/时间合并文本增量。"""
+
+    def __init__(self, flush_bytes=0, flush_interval=0.0, clock=time.monotonic):
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._clock = clock
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = None  # 尚未输出过任何内容时为 None
+        self.chunks_in = 0
+        self.chunks_out = 0
+
+    @property
+    def enabled(self):
+        return self.flush_bytes > 0
+
+    def add(self, chunk):
+        """加入一个增量，需要立即输出时返回合并后的文本，否则返回 None。"""
+        self.chunks_in += 1
+        if not self.enabled:
+            self.chunks_out += 1
+            return chunk
+        self._pending.append(chunk)
+        self._pending_bytes += len(chunk.encode('utf-8'))
+        if (self._last_flush is None or self._pending_bytes >= self.flush_bytes
+                or self._clock() - self._last_flush >= self.flush_interval):
+            return self.flush()
+        return None
+
+    def flush(self):
+        """输出所有待发送内容；没有内容时返回 None。"""
+        if not self._pending:
+            return None
+        text = ''.join(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = self._clock()
+        self.chunks_out += 1
+        return text
+
+    def time_until_flush(self):
+        """距离按时间刷新还有多少秒；没有待发送内容时返回 None (无需定时醒来)。"""
+        if not self._pending:
+            return None
+        return max(self.flush_interval - (self._clock() - self._last_flush), 0.0)
+
+    def due(self):
+        """待发送内容是否已到按时间刷新的时刻。"""
+        remaining = self.time_until_flush()
+        return remaining is not None and remaining <= 0
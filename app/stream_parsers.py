@@ -0,0 +1,217 @@
+"""
+AI 服务流式响应的增量解析器 (按服务商可插拔)。
+
+原来的实现对每一行先 decode 成 str、匹配 'data: ' 前缀再 json.loads，并且只认
+SSE，Ollama 原生 /api/chat 的 NDJSON 流解析不出任何内容。这里改为直接在字节
+上做分帧：
+
+- SSEStreamAdapter:   OpenAI 兼容服务 (text/event-stream)，'data: {...}' 帧
+- NDJSONStreamAdapter: Ollama 原生 /api/chat，每行一个 JSON 对象
+
+注释帧 (': keep-alive')、空行和不含正文/用量字段的帧 (例如只有 role 的首帧)
+不做 JSON 解码。用法:
+
+    adapter = get_stream_adapter(service_type, api_endpoint)
+    for data in response.iter_content(chunk_size=None):
+        for content_chunk in adapter.feed(data):
+            ...
+    adapter.usage  # {'prompt', 'completion', 'total'}
+"""
+import json
+import time
+
+_loads = json.loads
+
+
+class StreamAdapter:
+    """按字节增量分帧的基类，子类实现 _handle_frame。"""
+
+    name = 'base'
+
+    def __init__(self):
+        self._buffer = b''
+        self.usage = {'prompt': 0, 'completion': 0, 'total': 0, 'cached': 0}
+        self.finished = False
+        self.frames = 0          # 收到的帧数 (含跳过的)
+        self.decoded_frames = 0  # 实际做了 JSON 解码的帧数
+
+    def feed(self, data):
+        """喂入一段原始字节 (可以在任意位置被切开)，返回其中完整帧产生的文本增量列表。"""
+        if self._buffer:
+            data = self._buffer + data
+        deltas = []
+        start = 0
+        find = data.find
+        while True:
+            end = find(b'\n', start)
+            if end < 0:
+                break
+            # 去掉 \r\n 中的 \r
+            line_end = end - 1 if end > start and data[end - 1] == 13 else end
+            if line_end > start:
+                content = self._handle_frame(data, start, line_end)
+                if content:
+                    deltas.append(content)
+            start = end + 1
+        self._buffer = data[start:] if start < len(data) else b''
+        return deltas
+
+    def close(self):
+        """流结束时处理缓冲区中没有换行结尾的最后一帧。"""
+        deltas = []
+        if self._buffer:
+            data, self._buffer = self._buffer, b''
+            content = self._handle_frame(data, 0, len(data))
+            if content:
+                deltas.append(content)
+        return deltas
+
+    def _handle_frame(self, data, start, end):
+        raise NotImplementedError
+
+    def _set_usage(self, prompt, completion, total=None, cached=None):
+        self.usage['prompt'] = prompt
+        self.usage['completion'] = completion
+        self.usage['total'] = total if total is not None else prompt + completion
+        if cached is not None:
+            self.usage['cached'] = cached
+
+
+def cached_prompt_tokens(usage):
+    """
+    服务商报告的命中提示词缓存的 token 数，没有报告时返回 None。
+
+    OpenAI 放在 usage.prompt_tokens_details.cached_tokens，DeepSeek 是 usage.prompt_cache_hit_tokens。
+    """
+    details = usage.get('prompt_tokens_details')
+    if isinstance(details, dict) and details.get('cached_tokens') is not None:
+        return details['cached_tokens']
+    return usage.get('prompt_cache_hit_tokens')
+
+
+class SSEStreamAdapter(StreamAdapter):
+    """OpenAI 兼容服务的 SSE 流 (openai / deepseek / groq / Ollama 的 /v1 兼容接口等)。"""
+
+    name = 'sse'
+
+    def _handle_frame(self, data, start, end):
+        self.frames += 1
+        # 注释帧 / keep-alive (':' 开头) 以及 event:/id: 等字段直接跳过
+        if not data.startswith(b'data:', start, end):
+            return None
+        start += 5
+        if start < end and data[start] == 32:  # 'data: ' 后的空格
+            start += 1
+        if data.startswith(b'[DONE]', start, end):
+            self.finished = True
+            return None
+        payload = data[start:end]
+        # 既没有正文也没有用量信息的帧 (如首个 role 帧) 不必解码
+        if b'"content"' not in payload and b'"usage"' not in payload:
+            return None
+        try:
+            chunk = _loads(payload)
+        except ValueError:
+            print(f"[Stream Debug] Undecodable SSE frame: {payload[:200]!r}")
+            return None
+        self.decoded_frames += 1
+
+        usage = chunk.get('usage')
+        if usage and isinstance(usage, dict):
+            prompt = usage.get('prompt_tokens', self.usage['prompt'])
+            completion = usage.get('completion_tokens', self.usage['completion'])
+            self._set_usage(prompt, completion, usage.get('total_tokens'), cached_prompt_tokens(usage))
+
+        choices = chunk.get('choices')
+        if choices:
+            delta = choices[0].get('delta')
+            if delta:
+                return delta.get('content') or None
+        return None
+
+
+class NDJSONStreamAdapter(StreamAdapter):
+    """Ollama 原生 /api/chat 的 NDJSON 流 (每行一个 JSON 对象)。"""
+
+    name = 'ndjson'
+
+    def _handle_frame(self, data, start, end):
+        self.frames += 1
+        payload = data[start:end]
+        if b'"content"' not in payload and b'"done"' not in payload:
+            return None
+        try:
+            chunk = _loads(payload)
+        except ValueError:
+            print(f"[Stream Debug] Undecodable NDJSON frame: {payload[:200]!r}")
+            return None
+        self.decoded_frames += 1
+
+        if chunk.get('done'):
+            self.finished = True
+            self._set_usage(chunk.get('prompt_eval_count', self.usage['prompt']),
+                            chunk.get('eval_count', self.usage['completion']))
+        message = chunk.get('message')
+        if message:
+            return message.get('content') or None
+        return None
+
+
+def get_stream_adapter(service_type, api_endpoint):
+    """根据服务类型和实际请求的端点选择解析器。"""
+    if service_type == 'ollama' and api_endpoint.rstrip('/').endswith('/api/chat'):
+        return NDJSONStreamAdapter()
+    return SSEStreamAdapter()
+
+
+# --- 微基准：各解析器每秒可处理的帧数 ---
+def _sample_stream(adapter_name, n_chunks):
+    if adapter_name == 'sse':
+        frames = [b'data: {"id":"x","choices":[{"index":0,"delta":{"role":"assistant"}}]}\n\n']
+        for i in range(n_chunks):
+            frames.append(b'data: ' + json.dumps(
+                {'id': 'x', 'choices': [{'index': 0, 'delta': {'content': '夜色渐深，'}}]},
+                ensure_ascii=False).encode('utf-8') + b'\n\n')
+            if i % 50 == 0:
+                frames.append(b': keep-alive\n\n')
+        frames.append(b'data: {"choices":[],"usage":{"prompt_tokens":10,"completion_tokens":20,"total_tokens":30}}\n\n')
+        frames.append(b'data: [DONE]\n\n')
+    else:
+        frames = []
+        for _ in range(n_chunks):
+            frames.append(json.dumps({'model': 'm', 'message': {'role': 'assistant', 'content': '夜色渐深，'},
+                                      'done': False}, ensure_ascii=False).encode('utf-8') + b'\n')
+        frames.append(b'{"model":"m","done":true,"prompt_eval_count":10,"eval_count":20}\n')
+    return b''.join(frames)
+
+
+def benchmark_adapters(n_chunks=20000, read_size=1024):
+    """按 read_size 切分模拟网络读，测量每个解析器的 chunks/s。"""
+    results = {}
+    for adapter_cls in (SSEStreamAdapter, NDJSONStreamAdapter):
+        raw = _sample_stream(adapter_cls.name, n_chunks)
+        reads = [raw[i:i + read_size] for i in range(0, len(raw), read_size)]
+        adapter = adapter_cls()
+        started = time.perf_counter()
+        produced = 0
+        for data in reads:
+            produced += len(adapter.feed(data))
+        produced += len(adapter.close())
+        elapsed = time.perf_counter() - started
+        results[adapter_cls.name] = {
+            'chunks': produced,
+            'seconds': round(elapsed, 4),
+            'chunks_per_second': int(produced / elapsed) if elapsed else None,
+            'decoded_frames': adapter.decoded_frames,
+            'skipped_frames': adapter.frames - adapter.decoded_frames,
+            'usage': dict(adapter.usage),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    # python -m app.stream_parsers
+    for name, result in benchmark_adapters().items():
+        print(f"{name:7s} {result['chunks_per_second']:>10} chunks/s  "
+              f"({result['chunks']} chunks in {result['seconds']}s, "
+              f"decoded {result['decoded_frames']}, skipped {result['skipped_frames']}, usage {result['usage']})")
@@ -1,6 +1,8 @@
 from app import db, scheduler # Import scheduler instance
 from app.models.subscription_config import SubscriptionConfig
 from app.models.user import User
+from app.points_ledger import get_balances, grant_points, snapshot_balances
+from app.generation_jobs import recover_stale_jobs
 from datetime import datetime, time
 import logging
 import json # For JSON logging
@@ -37,6 +39,7 @@ def distribute_subscription_points_job(app):
                 task_logger.error(f"Error creating log directory {log_dir}: {e}")
 
         new_log_entries = []
+        running_balances = {} # 同一用户可能在多个目标组中，按本次发放累计
 
         for config in active_configs:
             task_logger.debug(f"Processing config ID: {config.id}, Name: {config.name}")
@@ -92,12 +95,15 @@ def distribute_subscription_points_job(app):
                     if not users_in_group:
                         task_logger.debug(f"    Group {group.name} (ID: {group.id}) has no users.")
                         continue
+                    current_balances = get_balances([u.id for u in users_in_group if u.id not in running_balances])
                     for user in users_in_group:
-                        balance_before = user.points or 0
-                        user.points = balance_before + config.points_to_distribute
-                        db.session.add(user)
+                        balance_before = running_balances.get(user.id, current_balances.get(user.id, 0))
+                        # 追加一条发放流水，不再原地修改 User.points
+                        grant_points(user.id, config.points_to_distribute, 'subscription', reference=f'subscription:{config.id}')
+                        balance_after = balance_before + config.points_to_distribute
+                        running_balances[user.id] = balance_after
                         points_distributed_to_users += 1
-                        task_logger.debug(f"    Granted {config.points_to_distribute} points to User ID: {user.id} ({user.username}). New balance: {user.points}")
+                        task_logger.debug(f"    Granted {config.points_to_distribute} points to User ID: {user.id} ({user.username}). New balance: {balance_after}")
 
                         # Create log entry
                         log_entry = {
@@ -110,7 +116,7 @@ def distribute_subscription_points_job(app):
                             "username": user.username,
                             "points_distributed": config.points_to_distribute,
                             "balance_before": balance_before,
-                            "balance_after": user.points
+                            "balance_after": balance_after
                         }
                         new_log_entries.append(log_entry)
 
@@ -164,4 +170,28 @@ def initialize_scheduler(app, scheduler_instance):
         )
         task_logger.info("Scheduled 'distribute_points_job' to run every 1 minute.")
     else:
-        task_logger.info("'distribute_points_job' is already scheduled.") 
\ No newline at end of file
+        task_logger.info("'distribute_points_job' is already scheduled.")
+
+    # 点数余额快照：把流水尾部折叠进 User.points，并清理过期的点数预留
+    if not scheduler_instance.get_job('snapshot_points_job'):
+        minutes = app.config.get('AI_POINTS_SNAPSHOT_MINUTES', 10)
+        scheduler_instance.add_job(
+            id='snapshot_points_job',
+            func=snapshot_balances,
+            args=[app],
+            trigger='interval',
+            minutes=minutes,
+            misfire_grace_time=60
+        )
+        task_logger.info(f"Scheduled 'snapshot_points_job' to run every {minutes} minute(s).") 
+    # 后台生成作业：回收 worker 崩溃遗留的 running 作业，清理过期的作业结果
+    if not scheduler_instance.get_job('generation_jobs_maintenance_job'):
+        scheduler_instance.add_job(
+            id='generation_jobs_maintenance_job',
+            func=recover_stale_jobs,
+            args=[app],
+            trigger='interval',
+            minutes=1,
+            misfire_grace_time=60
+        )
+        task_logger.info("Scheduled 'generation_jobs_maintenance_job' to run every 1 minute.")
@@ -0,0 +1,103 @@
+"""
+本地 token 估算 (不依赖服务商的 tokenizer)。
+
+计费原来完全依赖服务商返回的 usage，点数预检查也只判断 points < 1，用户在付费之前
+看不到提示词有多大。这里提供一个快速、面向中文的估算器:
+
+- 汉字、假名、韩文和全角标点按每字 AI_TOKENS_PER_CJK_CHAR 个 token 计
+- 连续的拉丁字母按每 AI_CHARS_PER_LATIN_TOKEN 个字符 1 个 token 计 (不足按 1 个)
+- 连续的数字按每 3 位 1 个 token 计
+- 其他非空白符号每个 1 个 token，空白不计
+
+结果按文本的 BLAKE2 摘要缓存 (LRU)，同一段前文/设定反复估算时不必重新扫描。
+
+用途:
+- /api/generate-with-template/dry-run 预览最终提示词及各占位符的 token 数
+- 生成路由的点数预检查 (提示词本身就需要的点数)
+- 服务商没有返回 usage 时的兜底用量 (estimate_usage)
+- 按目标字数换算 max_tokens (chars_to_tokens，见 app/length_control.py)
+"""
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+
+# CJK 统一表意文字 (含扩展 A)、兼容表意文字、假名、韩文、CJK 标点、全角字符
+_CJK_CLASS = '　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯'
+_TOKEN_RE = re.compile(rf'([{_CJK_CLASS}]+)|([A-Za-z]+)|([0-9]+)|(\s+)|(.)', re.S)
+
+_settings = {
+    'tokens_per_cjk_char': 1.0,
+    'chars_per_latin_token': 4.0,
+    'cache_size': 4096,
+}
+_cache = OrderedDict()  # digest -> tokens
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _count(text):
+    cjk_chars = 0
+    tokens = 0
+    chars_per_latin_token = _settings['chars_per_latin_token']
+    for cjk, latin, digits, space, other in _TOKEN_RE.findall(text):
+        if cjk:
+            cjk_chars += len(cjk)
+        elif latin:
+            tokens += math.ceil(len(latin) / chars_per_latin_token)
+        elif digits:
+            tokens += math.ceil(len(digits) / 3)
+        elif other:
+            tokens += 1
+    return tokens + math.ceil(cjk_chars * _settings['tokens_per_cjk_char'])
+
+
+def estimate_tokens(text):
+    """估算一段文本的 token 数 (按文本摘要缓存)。"""
+    if not text:
+        return 0
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _lock:
+        cached = _cache.get(digest)
+        if cached is not None:
+            _cache.move_to_end(digest)
+            _stats['hits'] += 1
+            return cached
+        _stats['misses'] += 1
+    tokens = _count(text)
+    with _lock:
+        _cache[digest] = tokens
+        while len(_cache) > _settings['cache_size']:
+            _cache.popitem(last=False)
+    return tokens
+
+
+def chars_to_tokens(chars):
+    """按汉字换算字数对应的 token 数 (小说正文以汉字为主)，用于按目标字数设置 max_tokens。"""
+    return math.ceil(chars * _settings['tokens_per_cjk_char'])
+
+
+def estimate_usage(prompt, completion):
+    """服务商没有返回 usage 时的兜底用量，格式与 StreamAdapter.usage 一致。"""
+    prompt_tokens = estimate_tokens(prompt)
+    completion_tokens = estimate_tokens(completion)
+    return {'prompt': prompt_tokens, 'completion': completion_tokens,
+            'total': prompt_tokens + completion_tokens, 'cached': 0}
+
+
+def cache_stats():
+    with _lock:
+        return {'entries': len(_cache), **_stats, **_settings}
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+def init_app(app):
+    _settings['tokens_per_cjk_char'] = app.config.get('AI_TOKENS_PER_CJK_CHAR', 1.0)
+    _settings['chars_per_latin_token'] = app.config.get('AI_CHARS_PER_LATIN_TOKEN', 4.0)
+    _settings['cache_size'] = app.config.get('AI_TOKEN_ESTIMATOR_CACHE_SIZE', 4096)
+    clear_cache()
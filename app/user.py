@@ -15,6 +15,7 @@ from app import scheduler # Import the scheduler instance
 from datetime import timezone, timedelta # For timezone-aware datetimes
 from app.models.app_settings import get_setting, set_setting # Import settings helpers
 import pytz # Import pytz for timezone handling
+from app.points_ledger import get_balances # 用户列表显示实时余额
 
 user = Blueprint('user', __name__, url_prefix='/user')
 
@@ -56,7 +57,8 @@ def manage():
             db.session.commit()
             flash('用户添加成功', 'success')
         return redirect(url_for('user.manage'))
-    return render_template('user_manage.html', users=users, groups=groups)
+    balances = get_balances([u.id for u in users])
+    return render_template('user_manage.html', users=users, groups=groups, balances=balances)
 
 @user.route('/delete/<int:user_id>')
 @login_required
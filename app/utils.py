@@ -1,5 +1,24 @@
 import re
 
+# 支持的通用占位符 (@[markdown] 单独处理，对应 data['markdown指令'])
+SUPPORTED_PLACEHOLDERS = ['前文', '后文', '提示词', '字数', '风格', '设定']
+
+# 正则表达式匹配 @[任意字符除了]]
+GENERIC_PLACEHOLDER_PATTERN = re.compile(r'@\[([^\]]+)\]')
+
+
+def format_placeholder_value(placeholder, value):
+    """把占位符的值转换成插入提示词的文本。"""
+    if value is None:
+        return "" # 如果值为 None，替换为空字符串
+    # 对列表类型的 '设定' 进行特殊格式化 (如果需要)
+    if placeholder == '设定' and isinstance(value, list):
+        # 示例：将设定列表转换为以换行符分隔的字符串
+        # 您可以根据需要调整这里的格式化逻辑
+        return "\n".join([f"- {s.get('text', '')}" for s in value if s.get('text') and s.get('enabled', True)])
+    return str(value) # 其他情况直接转为字符串
+
+
 def process_prompt_template(template_string, data):
     """
     根据提供的模板字符串和数据，替换占位符生成最终提示词。
@@ -20,35 +39,19 @@ def process_prompt_template(template_string, data):
     processed_prompt = processed_prompt.replace('@[markdown]', markdown_template_content)
 
     # 2. 处理其他通用的 @[占位符]
-    # 定义支持的通用占位符 (从 'markdown指令' 移除，因为它已被特殊处理)
-    supported_placeholders = ['前文', '后文', '提示词', '字数', '风格', '设定']
-
     # 使用正则表达式查找并替换所有剩余的 @[占位符]
     def replace_generic_match(match):
         placeholder = match.group(1) # 获取括号内的占位符名称
         if placeholder == 'markdown': # 已被特殊处理，避免重复或冲突
             return match.group(0) # 如果由于某种原因正则匹配到它，则不替换
         
-        if placeholder in supported_placeholders and placeholder in data:
-            value = data[placeholder]
-            if value is None:
-                return "" # 如果值为 None，替换为空字符串
-            
-            # 对列表类型的 '设定' 进行特殊格式化 (如果需要)
-            if placeholder == '设定' and isinstance(value, list):
-                # 示例：将设定列表转换为以换行符分隔的字符串
-                # 您可以根据需要调整这里的格式化逻辑
-                settings_text = "\n".join([f"- {s.get('text', '')}" for s in value if s.get('text') and s.get('enabled', True)])
-                return settings_text
-            
-            return str(value) # 其他情况直接转为字符串
+        if placeholder in SUPPORTED_PLACEHOLDERS and placeholder in data:
+            return format_placeholder_value(placeholder, data[placeholder])
         else:
             print(f"警告：模板中的通用占位符 '@[{placeholder}]' 未在数据中找到或不支持。")
             return match.group(0) # 保留原样
 
-    # 正则表达式匹配 @[任意字符除了]]
-    generic_pattern = re.compile(r'@\[([^\]]+)\]')
-    processed_prompt = generic_pattern.sub(replace_generic_match, processed_prompt)
+    processed_prompt = GENERIC_PLACEHOLDER_PATTERN.sub(replace_generic_match, processed_prompt)
 
     # 3. (可选) 如果您还想支持 {{双大括号}} 占位符，可以在这里添加逻辑
     # 例如，与您之前的 process_prompt_template 版本类似的逻辑：
@@ -63,6 +66,78 @@ def process_prompt_template(template_string, data):
 
     return processed_prompt
 
+
+def collect_placeholder_values(template_string, data):
+    """
+    列出模板中实际会被替换的占位符及其替换文本 (用于 dry-run 预览各占位符的大小)。
+
+    Returns:
+        dict: {占位符名: {'text': 替换文本, 'occurrences': 出现次数}}，@[markdown] 记为 'markdown'.
+    """
+    values = {}
+    occurrences = template_string.count('@[markdown]')
+    if occurrences:
+        values['markdown'] = {'text': data.get('markdown指令', '') or '', 'occurrences': occurrences}
+    for match in GENERIC_PLACEHOLDER_PATTERN.finditer(template_string.replace('@[markdown]', '')):
+        placeholder = match.group(1)
+        if placeholder not in SUPPORTED_PLACEHOLDERS or placeholder not in data:
+            continue
+        entry = values.get(placeholder)
+        if entry is None:
+            values[placeholder] = {'text': format_placeholder_value(placeholder, data[placeholder]), 'occurrences': 1}
+        else:
+            entry['occurrences'] += 1
+    return values
+
+# --- 前缀稳定的提示词组装 (利用服务商的提示词前缀缓存) ---
+# 占位符按变化频率排序：设定/风格/markdown 指令在一本书里很少变化，放在前面；
+# 后文、前文、提示词、字数 每次生成都可能不同，放在最后
+STABLE_PLACEHOLDERS = ['设定', '风格', 'markdown']
+VOLATILE_PLACEHOLDERS = ['后文', '前文', '提示词', '字数']
+
+PREFIX_STABLE_SYSTEM_NOTE = "（说明：上文中用〈名称〉标注的内容在用户消息中以【名称】为标题分段给出。）"
+
+
+def build_prefix_stable_messages(template_string, data):
+    """
+    把模板组装成 [system, user] 两条消息，使请求的前缀尽量在多次生成之间保持不变。
+
+    - system 消息是模板本身，占位符替换为〈名称〉引用，同一模板每次都完全相同
+    - user 消息按 STABLE_PLACEHOLDERS + VOLATILE_PLACEHOLDERS 的顺序列出模板中用到的占位符内容
+
+    OpenAI 兼容服务会对重复的前缀 (system 消息 + 设定等) 命中提示词缓存，降低首字延迟和费用。
+
+    Returns:
+        list: [{'role': 'system', 'content': ...}, {'role': 'user', 'content': ...}]
+    """
+    values = collect_placeholder_values(template_string, data)
+
+    def reference(match):
+        placeholder = match.group(1)
+        if placeholder == 'markdown' or placeholder in values:
+            return f"〈{'格式要求' if placeholder == 'markdown' else placeholder}〉"
+        return match.group(0)
+
+    system_content = GENERIC_PLACEHOLDER_PATTERN.sub(reference, template_string).strip()
+    system_content = f"{system_content}\n\n{PREFIX_STABLE_SYSTEM_NOTE}"
+
+    sections = []
+    for placeholder in STABLE_PLACEHOLDERS + VOLATILE_PLACEHOLDERS:
+        entry = values.get(placeholder)
+        if entry is None:
+            continue
+        title = '格式要求' if placeholder == 'markdown' else placeholder
+        sections.append(f"【{title}】\n{entry['text'] or '无'}")
+    return [
+        {'role': 'system', 'content': system_content},
+        {'role': 'user', 'content': "\n\n".join(sections)},
+    ]
+
+
+def flatten_messages(messages):
+    """把消息列表拼成一段文本 (用于日志、长度统计、token 估算和合并键)。"""
+    return "\n\n".join(message['content'] for message in messages)
+
 # --- 示例用法 (可以注释掉或移除，如果不需要在 utils 文件中直接运行) ---
 if __name__ == '__main__':
     template_sys = (
@@ -7,7 +7,7 @@ main = Blueprint('main', __name__)
 @login_required
 def index():
     auto_save_setting = current_user.auto_save_on_navigate
-    user_points = current_user.points
+    user_points = current_user.balance
     return render_template('index.html', user_auto_save_setting=auto_save_setting, user_points=user_points)
 
 @main.route('/logout')
@@ -7,4 +7,95 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:/// novel_editor.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    # 其他配置... 
\ No newline at end of file
+    # 其他配置...
+
+    # --- AI 服务 HTTP 连接池 (见 app/http_pool.py) ---
+    AI_HTTP_POOL_CONNECTIONS = int(os.environ.get('AI_HTTP_POOL_CONNECTIONS', 4))
+    AI_HTTP_POOL_MAXSIZE = int(os.environ.get('AI_HTTP_POOL_MAXSIZE', 20))
+    AI_HTTP_POOL_IDLE_SECONDS = int(os.environ.get('AI_HTTP_POOL_IDLE_SECONDS', 300))
+    # 启动时预热默认系统 AI 服务的连接
+    AI_HTTP_PREWARM = os.environ.get('AI_HTTP_PREWARM', 'false').lower() in ('1', 'true', 'yes')
+
+    # --- 异步流式网关 (见 app/async_gateway.py) ---
+    # 设置后流式生成交由网关处理，例如 '/agw' (经反向代理挂到同一域名下)
+    AI_ASYNC_GATEWAY_URL = os.environ.get('AI_ASYNC_GATEWAY_URL') or None
+    AI_ASYNC_GATEWAY_TICKET_TTL = int(os.environ.get('AI_ASYNC_GATEWAY_TICKET_TTL', 60))
+    AI_ASYNC_GATEWAY_MAX_CONNECTIONS = int(os.environ.get('AI_ASYNC_GATEWAY_MAX_CONNECTIONS', 500))
+
+    # --- 非流式 AI 生成结果缓存 (见 app/result_cache.py) ---
+    AI_RESULT_CACHE_ENABLED = os.environ.get('AI_RESULT_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    AI_RESULT_CACHE_BACKEND = os.environ.get('AI_RESULT_CACHE_BACKEND', 'memory') # 'memory' 或 'sqlite'
+    AI_RESULT_CACHE_PATH = os.environ.get('AI_RESULT_CACHE_PATH') or None # sqlite 后端文件路径，默认 instance/ai_result_cache.db
+    AI_RESULT_CACHE_TTL = int(os.environ.get('AI_RESULT_CACHE_TTL', 3600))
+    AI_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('AI_RESULT_CACHE_MAX_ENTRIES', 1000))
+    AI_RESULT_CACHE_MAX_BYTES = int(os.environ.get('AI_RESULT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+    # --- AI 调用准入控制与公平排队 (见 app/admission.py) ---
+    AI_SERVICE_MAX_CONCURRENCY = int(os.environ.get('AI_SERVICE_MAX_CONCURRENCY', 8)) # 每个服务 (服务池按每个成员) 的并发上游调用数
+    AI_USER_MAX_CONCURRENCY = int(os.environ.get('AI_USER_MAX_CONCURRENCY', 2))
+    AI_ADMISSION_MAX_WAIT = float(os.environ.get('AI_ADMISSION_MAX_WAIT', 2)) # 排队最长等待秒数 (期间占用 Web worker)，超过后返回 429
+    AI_ADMISSION_MAX_QUEUE = int(os.environ.get('AI_ADMISSION_MAX_QUEUE', 200))
+    AI_ADMISSION_GROUP_WEIGHTS = os.environ.get('AI_ADMISSION_GROUP_WEIGHTS', '') # 例如 "VIP=4,付费用户=2"
+
+    # --- 本地 token 估算 (见 app/token_estimator.py) ---
+    AI_TOKENS_PER_CJK_CHAR = float(os.environ.get('AI_TOKENS_PER_CJK_CHAR', 1.0))
+    AI_CHARS_PER_LATIN_TOKEN = float(os.environ.get('AI_CHARS_PER_LATIN_TOKEN', 4.0))
+    AI_TOKEN_ESTIMATOR_CACHE_SIZE = int(os.environ.get('AI_TOKEN_ESTIMATOR_CACHE_SIZE', 4096))
+    # 前文/后文/设定 合计的默认 token 预算，AI 服务未单独设置时使用 (<= 0 不裁剪，默认不裁剪；见 app/context_packer.py)
+    AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET', 0))
+
+    # --- 流式输出合并 (见 app/stream_flush.py) ---
+    # 第一块立即输出，之后累计到 N 字节或距上次输出 M 毫秒时输出一次；AI_STREAM_FLUSH_BYTES <= 0 关闭合并
+    AI_STREAM_FLUSH_BYTES = int(os.environ.get('AI_STREAM_FLUSH_BYTES', 96))
+    AI_STREAM_FLUSH_MS = int(os.environ.get('AI_STREAM_FLUSH_MS', 60))
+
+    # --- 多候选生成 (见 app/candidates.py) ---
+    # 请求中 candidates 的上限，一次请求最多并发这么多个上游生成
+    AI_MAX_CANDIDATES = int(os.environ.get('AI_MAX_CANDIDATES', 4))
+
+    # --- 计费与调用日志的后台批量写入 (见 app/billing_writer.py) ---
+    AI_BILLING_WRITE_BEHIND = os.environ.get('AI_BILLING_WRITE_BEHIND', 'true').lower() in ('1', 'true', 'yes')
+    AI_BILLING_BATCH_SIZE = int(os.environ.get('AI_BILLING_BATCH_SIZE', 100))
+    AI_BILLING_FLUSH_MS = int(os.environ.get('AI_BILLING_FLUSH_MS', 200)) # 第一条事件最多等待这么久就提交
+    AI_BILLING_SPOOL_DIR = os.environ.get('AI_BILLING_SPOOL_DIR') or None # 默认 instance/billing_spool
+    AI_BILLING_SPOOL_FSYNC = os.environ.get('AI_BILLING_SPOOL_FSYNC', 'true').lower() in ('1', 'true', 'yes')
+    AI_BILLING_SPOOL_STALE_SECONDS = int(os.environ.get('AI_BILLING_SPOOL_STALE_SECONDS', 300)) # 超过该时间未修改的 spool 段视为崩溃遗留并重放
+
+    # --- 点数流水与预留 (见 app/points_ledger.py) ---
+    AI_POINTS_SNAPSHOT_MINUTES = int(os.environ.get('AI_POINTS_SNAPSHOT_MINUTES', 10)) # 余额快照 (折叠流水尾部) 的间隔
+    AI_POINTS_RESERVATION_TTL = int(os.environ.get('AI_POINTS_RESERVATION_TTL', 600)) # 预留未结算时自动过期的秒数
+    # 预留点数时假设的输出 token 数 (加上提示词的估算 token 数，多候选时乘以候选数)
+    AI_POINTS_RESERVATION_COMPLETION_TOKENS = int(os.environ.get('AI_POINTS_RESERVATION_COMPLETION_TOKENS', 1000))
+
+    # --- AI 服务熔断与健康探测 (见 app/circuit_breaker.py) ---
+    AI_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('AI_CIRCUIT_FAILURE_THRESHOLD', 3)) # 连续失败多少次后熔断
+    AI_CIRCUIT_OPEN_SECONDS = int(os.environ.get('AI_CIRCUIT_OPEN_SECONDS', 30)) # 熔断后多久开始探测 (探测失败时加倍，最多 300 秒)
+    AI_CIRCUIT_PROBE_INTERVAL = int(os.environ.get('AI_CIRCUIT_PROBE_INTERVAL', 5)) # 后台探测线程的检查间隔，0 表示不探测
+    AI_CIRCUIT_PROBE_TIMEOUT = int(os.environ.get('AI_CIRCUIT_PROBE_TIMEOUT', 3)) # 单次探测的超时秒数
+
+    # --- AIService / 提示词模板配置缓存 (见 app/config_cache.py) ---
+    AI_CONFIG_CACHE_CHECK_SECONDS = float(os.environ.get('AI_CONFIG_CACHE_CHECK_SECONDS', 1.0)) # 多久检查一次数据库中的版本号 (其他 worker 的修改最多延迟这么久生效)，0 表示每次都检查
+    AI_CONFIG_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CONFIG_CACHE_MAX_ENTRIES', 2000))
+
+    # --- 可续传的流式生成 (见 app/single_flight.py) ---
+    AI_STREAM_REPLAY_TTL = int(os.environ.get('AI_STREAM_REPLAY_TTL', 120)) # 流结束后缓冲区保留的秒数
+    AI_STREAM_REPLAY_MAX_CHARS = int(os.environ.get('AI_STREAM_REPLAY_MAX_CHARS', 20_000_000)) # 所有保留的流合计的字数上限
+    AI_STREAM_RESUME_GRACE_SECONDS = int(os.environ.get('AI_STREAM_RESUME_GRACE_SECONDS', 15)) # 客户端全部断开后等待重连的秒数，之后才中止上游，0 表示立即中止
+    AI_SSE_HEARTBEAT_SECONDS = int(os.environ.get('AI_SSE_HEARTBEAT_SECONDS', 15)) # SSE 模式下超过这么久没有输出时发送 heartbeat 事件 (见 app/sse.py)
+
+    # --- 按目标字数控制生成长度 (见 app/length_control.py) ---
+    AI_LENGTH_MAX_TOKENS_FACTOR = float(os.environ.get('AI_LENGTH_MAX_TOKENS_FACTOR', 2.0)) # max_tokens = 目标字数 × 该倍数换算的 token 数，0 表示不发送 max_tokens
+    AI_LENGTH_MIN_MAX_TOKENS = int(os.environ.get('AI_LENGTH_MIN_MAX_TOKENS', 256)) # max_tokens 的下限 (目标字数很小时)
+    AI_LENGTH_GOVERNOR_MULTIPLE = float(os.environ.get('AI_LENGTH_GOVERNOR_MULTIPLE', 0)) # 大于 0 时，流式输出超过 目标字数 × 该倍数 后在句子边界处截止 (例如 1.5)；默认关闭
+    AI_LENGTH_GOVERNOR_GRACE_CHARS = int(os.environ.get('AI_LENGTH_GOVERNOR_GRACE_CHARS', 200)) # 超出后这么多字内仍没有句子边界时直接截止
+
+    # --- 服务端按 book_id + 光标组装 前文/后文/设定 (见 app/book_context.py) ---
+    AI_BOOK_CONTEXT_CACHE_MAX_CHARS = int(os.environ.get('AI_BOOK_CONTEXT_CACHE_MAX_CHARS', 50_000_000)) # 进程内缓存的书籍纯文本与设定合计字数上限 (按版本号校验，超出时按 LRU 淘汰)
+
+    # --- 后台生成作业 (见 app/generation_jobs.py) ---
+    AI_GENERATION_JOB_WORKERS = int(os.environ.get('AI_GENERATION_JOB_WORKERS', 2)) # Web 进程的生成 worker 线程数 (处理第一个请求时启动)，0 表示不在 Web 进程运行 (另行运行 flask generation-worker)
+    AI_GENERATION_JOB_POLL_SECONDS = float(os.environ.get('AI_GENERATION_JOB_POLL_SECONDS', 2.0)) # 空闲 worker 查询排队作业的间隔 (本进程提交的作业会立即唤醒)
+    AI_GENERATION_JOB_CHECKPOINT_SECONDS = float(os.environ.get('AI_GENERATION_JOB_CHECKPOINT_SECONDS', 1.0)) # 运行中的作业把已生成部分写回数据库的间隔
+    AI_GENERATION_JOB_STALE_SECONDS = int(os.environ.get('AI_GENERATION_JOB_STALE_SECONDS', 600)) # running 作业超过这么久没有心跳视为 worker 已崩溃
+    AI_GENERATION_JOB_RETENTION_DAYS = int(os.environ.get('AI_GENERATION_JOB_RETENTION_DAYS', 7)) # 结束的作业 (及其结果) 保留天数
+    AI_GENERATION_JOB_RESERVATION_TTL = int(os.environ.get('AI_GENERATION_JOB_RESERVATION_TTL', 3600)) # 作业的点数预留有效期 (包含排队时间)
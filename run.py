@@ -30,6 +30,104 @@ def clear_users():
         db.session.rollback()
         print(f"清空用户时出错: {e}")
 
+@app.cli.command("ai-gateway")
+@click.option('--host', default='0.0.0.0', help='监听地址')
+@click.option('--port', default=5001, type=int, help='监听端口')
+def run_ai_gateway(host, port):
+    """启动异步流式生成网关 (ASGI)，需配合 AI_ASYNC_GATEWAY_URL 使用。"""
+    import uvicorn
+    from app import scheduler
+    from app.async_gateway import AsyncStreamGateway
+
+    # 网关进程不运行定时任务，避免与 Web 进程重复发放点数
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    uvicorn.run(AsyncStreamGateway(app), host=host, port=port)
+
+@app.cli.command("generation-worker")
+@click.option('--workers', default=4, type=int, help='生成 worker 线程数')
+def run_generation_worker(workers):
+    """单独运行后台生成作业的 worker (Web 进程可设 AI_GENERATION_JOB_WORKERS=0)。"""
+    from app import scheduler
+    from app.billing import start_billing_writer
+    from app.generation_jobs import start_runner
+
+    # worker 进程不运行定时任务，避免与 Web 进程重复发放点数；
+    # create_app() 不会在 CLI 命令中启动 worker 和计费写入线程 (见 app/generation_jobs.py、app/billing.py)，这里启动
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    start_billing_writer(app)
+    runner = start_runner(app, workers)
+    try:
+        while True:
+            time.sleep(60)
+            print(f"[Generation Jobs] {runner.stats()}")
+    except KeyboardInterrupt:
+        print("Stopping generation workers, waiting for running jobs to finish...")
+        runner.stop()
+
+@app.cli.command("mock-ai-provider")
+@click.option('--host', default='127.0.0.1', help='监听地址')
+@click.option('--port', default=5002, type=int, help='监听端口')
+@click.option('--ttft-ms', default=300, type=int, help='首字延迟 (毫秒)')
+@click.option('--tokens-per-second', default=50.0, type=float, help='输出速度 (按 1 字 = 1 token)')
+@click.option('--chunk-chars', default=2, type=int, help='每个流式块的字数')
+@click.option('--completion-tokens', default=200, type=int, help='请求未指定 max_tokens 时的输出长度')
+@click.option('--error-rate', default=0.0, type=float, help='直接返回错误的概率 (0~1)')
+@click.option('--error-status', default=500, type=int, help='返回错误时的状态码')
+@click.option('--disconnect-rate', default=0.0, type=float, help='流式输出中途断开连接的概率 (0~1)')
+@click.option('--usage/--no-usage', default=True, help='是否报告 usage')
+@click.option('--prefix-cache/--no-prefix-cache', default=True, help='是否模拟提示词前缀缓存 (cached_tokens)')
+@click.option('--seed', default=None, type=int, help='随机数种子 (错误/断开可复现)')
+def run_mock_ai_provider(host, port, ttft_ms, tokens_per_second, chunk_chars, completion_tokens,
+                         error_rate, error_status, disconnect_rate, usage, prefix_cache, seed):
+    """启动本地模拟 AI 服务 (OpenAI 兼容 SSE + Ollama /api/chat)，用于压测，不消耗真实额度。"""
+    from app import scheduler
+    from app.mock_provider import MockProviderSettings, create_mock_provider_app
+
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    settings = MockProviderSettings(
+        ttft_ms=ttft_ms, tokens_per_second=tokens_per_second, chunk_chars=chunk_chars,
+        completion_tokens=completion_tokens, error_rate=error_rate, error_status=error_status,
+        disconnect_rate=disconnect_rate, report_usage=usage, prefix_cache=prefix_cache, seed=seed)
+    print(f"Mock AI provider on http://{host}:{port} with {settings.to_dict()}")
+    create_mock_provider_app(settings).run(host=host, port=port, threaded=True)
+
+@app.cli.command("benchmark-generation")
+@click.option('--concurrency', default='1,8', help='并发客户端数，逗号分隔')
+@click.option('--prompt-chars', default='500,8000', help='前文字数，逗号分隔')
+@click.option('--requests', 'requests_per_scenario', default=20, type=int, help='每个场景的请求数')
+@click.option('--modes', default='stream,non-stream', help='生成模式: stream / non-stream，逗号分隔')
+@click.option('--inputs', default='template,raw', help='输入方式: template / raw，逗号分隔')
+@click.option('--service-type', default='openai', type=click.Choice(['openai', 'ollama']), help='模拟服务的接入方式')
+@click.option('--ttft-ms', default=300, type=int, help='模拟服务的首字延迟 (毫秒)')
+@click.option('--tokens-per-second', default=50.0, type=float, help='模拟服务的输出速度')
+@click.option('--chunk-chars', default=2, type=int, help='模拟服务每个流式块的字数')
+@click.option('--completion-tokens', default=200, type=int, help='模拟服务的输出长度')
+@click.option('--database-uri', default=None, help='基准测试使用的数据库 (默认临时 SQLite)')
+@click.option('--output', default='benchmark-results.json', help='结果 JSON 文件路径')
+def run_benchmark_generation(concurrency, prompt_chars, requests_per_scenario, modes, inputs, service_type,
+                             ttft_ms, tokens_per_second, chunk_chars, completion_tokens, database_uri, output):
+    """端到端基准测试：对本地模拟服务压测 /api/generate-with-template，结果写成 JSON。"""
+    from app import scheduler
+    from app.benchmark import run_benchmark
+    from app.mock_provider import MockProviderSettings
+
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+    def split(value):
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    settings = MockProviderSettings(ttft_ms=ttft_ms, tokens_per_second=tokens_per_second,
+                                    chunk_chars=chunk_chars, completion_tokens=completion_tokens, seed=0)
+    run_benchmark(concurrency_levels=[int(c) for c in split(concurrency)],
+                  prompt_sizes=[int(c) for c in split(prompt_chars)],
+                  requests_per_scenario=requests_per_scenario, modes=split(modes), inputs=split(inputs),
+                  service_type=service_type, provider_settings=settings, database_uri=database_uri,
+                  output_path=output)
+
 if __name__ == '__main__':
     # 注意：运行 app.run() 会阻塞，无法直接在此处接收 'clr' 输入。
     # clr 命令需要通过 'flask clr' 在单独的终端中运行。